@@ -0,0 +1,235 @@
+import argparse
+import base64
+import hashlib
+import ipaddress
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import logger
+import profiles
+import resources
+import rpc
+import utils
+import vnc
+import watcher
+from filestore import file_store
+from globals import Globals
+from iserver import State
+from snapshot import HostSnapshot
+
+
+class Agent:
+    """
+    Runs VNC instances on behalf of a manager on another host (see remote.py), which reaches it over a TCP RPC. The
+    agent keeps no pool logic of its own: it starts and stops the instances it is asked to, reports their state (and
+    its capacity) whenever the manager asks for it, and launches SUMO on an instance as soon as the connection it was
+    told to expect is detected.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.pool = {}
+        self.expected = set()
+        self.recycling = set()
+        self.reclaimed = {"sessions": 0, "cpu_percent": 0, "rss_bytes": 0}
+        self.profiles = profiles.load_profiles()
+        self.resources = resources.ResourceMonitor()
+        self.lock = threading.RLock()
+        self.watcher = watcher.ConnectionWatcher(self.on_vnc_connected)
+        self.executor = ThreadPoolExecutor(max_workers=Globals.PROVISION_WORKERS, thread_name_prefix="Provisioner")
+
+    def start(self):
+        self.watcher.start()
+        print("Node agent started with capacity for %d instances" % self.capacity)
+
+    def stop(self):
+        self.watcher.stop()
+        with self.lock:
+            for vnc_id in list(self.pool):
+                self.destroy(vnc_id)
+        self.executor.shutdown(wait=True)
+        print("Node agent stopped")
+
+    # starts a new instance of a given profile (blocks until its server has been spawned) and returns where it is,
+    # along with its state (checked right away, so that the manager can hand it out without waiting for the next
+    # report); the profiles of the agent are those of the manager, as both share the same settings
+    def create(self, vnc_id, profile=Globals.VNC_DEFAULT_PROFILE):
+        vnc_instance = vnc.VNC(profile=self.profiles.get(profile, self.profiles[Globals.VNC_DEFAULT_PROFILE]))
+        with self.lock:
+            self.pool[vnc_id] = vnc_instance
+        vnc_instance.start()
+        if vnc_instance.state != State.Dead and vnc_instance.is_listening():
+            with self.lock:
+                vnc_instance.mark_ready()
+        return {"display_index": vnc_instance.display_index, "port": vnc_instance.port,
+                "state": vnc_instance.state.name}
+
+    def destroy(self, vnc_id):
+        with self.lock:
+            self.expected.discard(vnc_id)
+            self.watcher.unwatch(vnc_id)
+            vnc_instance = self.pool.pop(vnc_id, None)
+        if vnc_instance:
+            self.executor.submit(vnc_instance.stop)
+
+    # updates the state and resource usage of every instance from a new snapshot of the host and returns them, along
+    # with the capacity of this node, whether it has headroom for more instances and the capacity reclaimed from idle
+    # sessions; SUMO is stopped on instances that are no longer serving, those whose session has ended are recycled
+    # and those whose session has been idle for too long are disconnected
+    def report(self):
+        snapshot = HostSnapshot.take()
+        with self.lock:
+            roots = {vnc_id: vnc_instance.get_pids() for vnc_id, vnc_instance in self.pool.items()}
+        usages = self.resources.sample(roots)
+        instances = {}
+        with self.lock:
+            for vnc_id, vnc_instance in self.pool.items():
+                if vnc_id in usages:
+                    vnc_instance.usage = usages[vnc_id]
+                vnc_instance.check_state(snapshot)
+                if vnc_instance.state == State.Serving and vnc_id in self.expected:
+                    self.on_vnc_connected(vnc_id, None)
+                elif vnc_instance.state == State.Recycling and vnc_id not in self.recycling:
+                    self.recycling.add(vnc_id)
+                    self.executor.submit(self.recycle, vnc_id, vnc_instance)
+                elif vnc_instance.state not in [State.Serving, State.Recycling]:
+                    vnc_instance.stop_command()
+                if vnc_instance.has_stale_warning():
+                    self.executor.submit(vnc_instance.stop_warning)
+                if vnc_instance.check_idle_warning():
+                    self.executor.submit(vnc_instance.show_warning)
+                if vnc_instance.check_idle():
+                    self.executor.submit(self.reclaim, vnc_id, vnc_instance)
+                instances[vnc_id] = {"state": vnc_instance.state.name, "port": vnc_instance.port,
+                                     "sessions": vnc_instance.sessions, "usage": vnc_instance.usage.to_dict(),
+                                     "idle_secs": vnc_instance.get_idle_secs()}
+            reclaimed = dict(self.reclaimed)
+        return {"capacity": self.capacity, "load": os.getloadavg()[0], "headroom": self.resources.has_headroom(),
+                "instances": instances, "reclaimed": reclaimed}
+
+    # recycles an instance whose session has ended, or marks it as dead (for the manager to replace it) if it could
+    # not be recycled
+    def recycle(self, vnc_id, vnc_instance):
+        if not vnc_instance.recycle():
+            vnc_instance.mark_dead()
+        with self.lock:
+            self.recycling.discard(vnc_id)
+
+    # disconnects an idle session, which is then recycled once the next report finds it has ended
+    def reclaim(self, vnc_id, vnc_instance):
+        usage = vnc_instance.usage
+        if not vnc_instance.disconnect():
+            print("VNC ID = %s could not be disconnected after being idle" % vnc_id)
+            return
+        with self.lock:
+            self.reclaimed["sessions"] += 1
+            self.reclaimed["cpu_percent"] += usage.cpu_percent
+            self.reclaimed["rss_bytes"] += usage.rss_bytes
+        print("VNC ID = %s was disconnected after being idle for %d seconds" % (vnc_id, Globals.IDLE_TIMEOUT_SECS))
+
+    # expects a connection to a given instance, on which SUMO is launched as soon as it is detected
+    def watch(self, vnc_id):
+        with self.lock:
+            if vnc_id in self.pool:
+                self.expected.add(vnc_id)
+                self.watcher.watch(vnc_id, self.pool[vnc_id].port)
+
+    def unwatch(self, vnc_id):
+        with self.lock:
+            self.expected.discard(vnc_id)
+            self.watcher.unwatch(vnc_id)
+
+    def on_vnc_connected(self, vnc_id, detected_at):
+        with self.lock:
+            if vnc_id not in self.expected or vnc_id not in self.pool:
+                return
+            self.expected.discard(vnc_id)
+            self.watcher.unwatch(vnc_id)
+            vnc_instance = self.pool[vnc_id]
+            vnc_instance.mark_serving()
+            vnc_instance.run_command(vnc_instance.profile.sumo_cmd)
+        print("VNC ID = %s was connected to and SUMO was launched" % vnc_id)
+
+    # returns which of the given file hashes are not in the file store of this node
+    @staticmethod
+    def missing_files(file_hashes):
+        return [file_hash for file_hash in file_hashes if not file_store.has(file_hash)]
+
+    # adds a file, sent as base64, to the file store of this node
+    @staticmethod
+    def put_file(file_hash, data):
+        content = base64.b64decode(data)
+        if hashlib.sha256(content).hexdigest() != file_hash:
+            raise ValueError("File content does not match hash %s" % file_hash)
+        os.makedirs(Globals.STAGING_DIR, exist_ok=True)
+        fd, path = tempfile.mkstemp(dir=Globals.STAGING_DIR)
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+        file_store.adopt(path, file_hash, len(content))
+        os.remove(path)
+
+    # links the files with the given hashes (by name) from the file store into the directory of a given instance
+    def adopt_files(self, vnc_id, file_hashes):
+        with self.lock:
+            vnc_instance = self.pool[vnc_id]
+        os.makedirs(Globals.STAGING_DIR, exist_ok=True)
+        staging_dir = tempfile.mkdtemp(dir=Globals.STAGING_DIR)
+        try:
+            for name, file_hash in file_hashes.items():
+                if name not in Globals.VNC_SUMO_FILES:
+                    raise ValueError("Unknown file %s" % name)
+                file_store.link(file_hash, os.path.join(staging_dir, "%s.xml" % name))
+            vnc_instance.adopt_files_dir(staging_dir)
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+    def get_ops(self):
+        return {"create": self.create, "destroy": self.destroy, "report": self.report, "watch": self.watch,
+                "unwatch": self.unwatch, "missing_files": Agent.missing_files, "put_file": Agent.put_file,
+                "adopt_files": self.adopt_files}
+
+
+# several agents can run on the same host (e.g. for testing), as long as each one has its own port and display range
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Runs VNC instances on behalf of a VNC instance manager")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+    parser.add_argument("--port", type=int, default=Globals.AGENT_PORT)
+    parser.add_argument("--token", default=os.environ.get("AGENT_TOKEN", Globals.AGENT_TOKEN),
+                        help="secret shared with the manager (AGENT_TOKEN, also read from the environment), required "
+                             "to listen on a public address")
+    parser.add_argument("--capacity", type=int, default=Globals.AGENT_MAX_INSTANCES,
+                        help="maximum amount of instances to run on this node")
+    parser.add_argument("--display-base", type=int, default=Globals.BASE_DISPLAY_INDEX,
+                        help="first X display index to use")
+    parser.add_argument("--port-offset", type=int, default=0, help="offset added to the VNC port of every display")
+    args = parser.parse_args()
+    if not args.token and not ipaddress.ip_address(socket.gethostbyname(args.host)).is_loopback:
+        parser.error("a --token is required to listen on %s, as anyone reaching it could run commands" % args.host)
+    Globals.BASE_DISPLAY_INDEX = args.display_base
+    Globals.VNC_BASE_PORT += args.port_offset
+    Globals.VNC_FILES_DIR = "%s-agent-%d" % (Globals.VNC_FILES_DIR, args.port)
+    Globals.STAGING_DIR = "%s-agent-%d" % (Globals.STAGING_DIR, args.port)
+    logger.redirect_std_streams("agent-%d" % args.port)
+
+    agent = Agent(args.capacity)
+    server = rpc.RpcServer((args.host, args.port), agent.get_ops(), args.token)
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stopping.set())
+    try:
+        utils.clear_dir(Globals.VNC_FILES_DIR)
+        utils.ensure_dir_exists(Globals.VNC_FILES_DIR)
+        utils.clear_dir(Globals.STAGING_DIR)
+        agent.start()
+        server.start()
+        stopping.wait()
+    except BaseException as e:
+        print("Error: ", e)
+    server.stop()
+    agent.stop()
+    utils.clear_and_remove_dir(Globals.VNC_FILES_DIR)
@@ -0,0 +1,81 @@
+import glob
+import os
+import re
+import threading
+from collections import deque
+
+from globals import Globals
+
+
+class DisplayAllocator:
+    """
+    In-process allocator of X display indexes (and their VNC ports). Indexes are reserved atomically, freed indexes are
+    recycled, and the X lock files and sockets of the host are only scanned once, on the first allocation.
+    """
+
+    def __init__(self, base_index=None):
+        self.base_index = base_index
+        self.lock = threading.Lock()
+        self.next_index = Globals.NA
+        self.free = deque()
+        self.reserved = set()
+        self.taken = set()
+        self.reconciled = False
+
+    # collects the display indexes already in use on the host, according to its X lock files and sockets
+    def reconcile(self):
+        if self.base_index is None:
+            self.base_index = Globals.BASE_DISPLAY_INDEX
+        paths = glob.glob(os.path.join(Globals.X_LOCK_DIR, ".X*-lock")) + \
+            glob.glob(os.path.join(Globals.X_SOCKET_DIR, "X*"))
+        for path in paths:
+            match = re.search(r"X(\d+)(-lock)?$", os.path.basename(path))
+            if match:
+                self.taken.add(int(match.group(1)))
+        self.next_index = self.base_index
+        self.reconciled = True
+        print("Display allocator reconciled, %d display indexes are already taken" % len(self.taken))
+
+    # reserves and returns the next available display index
+    def acquire(self):
+        with self.lock:
+            if not self.reconciled:
+                self.reconcile()
+            while True:
+                if self.free:
+                    display_index = self.free.popleft()
+                else:
+                    display_index = self.next_index
+                    self.next_index += 1
+                if display_index not in self.taken and display_index not in self.reserved and \
+                        not DisplayAllocator.is_locked(display_index):
+                    self.reserved.add(display_index)
+                    return display_index
+
+    # reserves a given display index, in use by an adopted server
+    def reserve(self, display_index):
+        with self.lock:
+            if not self.reconciled:
+                self.reconcile()
+            self.taken.discard(display_index)
+            self.reserved.add(display_index)
+
+    # releases a reserved display index so that it can be recycled
+    def release(self, display_index):
+        with self.lock:
+            if display_index in self.reserved:
+                self.reserved.remove(display_index)
+                self.free.append(display_index)
+
+    # returns the VNC port used by a given display index
+    @staticmethod
+    def get_port(display_index):
+        return Globals.VNC_BASE_PORT + display_index
+
+    # checks if the X lock file of a given display index exists
+    @staticmethod
+    def is_locked(display_index):
+        return os.path.exists(os.path.join(Globals.X_LOCK_DIR, ".X%d-lock" % display_index))
+
+
+allocator = DisplayAllocator()
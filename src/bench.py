@@ -0,0 +1,224 @@
+import argparse
+import json
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import metrics
+from allocator import DisplayAllocator
+from globals import Globals
+from iserver import State
+from manager import Manager
+
+STUBS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stubs")
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+CLAIM_ROUNDS = 3
+# measurements taken at each pool size, and whether a higher value is better
+MEASUREMENTS = {
+    "warm_up_secs": False,
+    "provisioning_secs": False,
+    "tick_secs": False,
+    "claims_per_sec": True,
+    "connect_secs": False,
+    "acquire_us": False
+}
+
+
+# measures the manager with a pool of a given size, run against the stubs in STUBS_DIR (a stub host stands in for the
+# VNC servers, see stubs/stubhost.py) with every file and socket in the current directory's parent, where the results
+# are written to results.json
+def run_size(size, ticks, claims, sessions):
+    work_dir = os.path.abspath("..")
+    Globals.POOL_BASE_SIZE = size
+    Globals.POOL_MAX_SIZE = size
+    Globals.VNC_PROFILES = {Globals.VNC_DEFAULT_PROFILE: {}}
+    Globals.X_LOCK_DIR = work_dir
+    Globals.X_SOCKET_DIR = os.path.join(work_dir, ".X11-unix")
+    Globals.VNC_BASE_PORT = 20000
+    Globals.WEBSOCKIFY_PORT = get_free_port()
+    Globals.SCALING_TRACE_PATH = None
+    os.environ["PATH"] = "%s%s%s" % (STUBS_DIR, os.pathsep, os.environ["PATH"])
+    os.environ["STUB_HOST_SOCKET"] = os.path.join(work_dir, "stubhost.sock")
+    stub_host = subprocess.Popen([sys.executable, os.path.join(STUBS_DIR, "stubhost.py"),
+                                  os.environ["STUB_HOST_SOCKET"], work_dir])
+    try:
+        while not os.path.exists(os.environ["STUB_HOST_SOCKET"]):
+            time.sleep(0.01)
+        # the output of the manager (including that of its threads, which outlive the benchmark) goes to bench.log
+        sys.stdout = open(os.path.join(work_dir, "bench.log"), "w")
+        results = measure(size, ticks, claims, sessions)
+        with open(os.path.join(work_dir, "results.json"), "w") as f:
+            json.dump(results, f)
+    finally:
+        stub_host.terminate()
+        stub_host.wait()
+
+
+def measure(size, ticks, claims, sessions) -> dict:
+    results = {}
+    manager = Manager()
+    manager.start()
+    deadline = time.monotonic() + 30 + size
+    while not manager.get_health()["warm"]:
+        if time.monotonic() > deadline:
+            raise TimeoutError("Pool of %d instances did not warm up" % size)
+        time.sleep(0.05)
+    results["warm_up_secs"] = manager.get_health()["warm_up_secs"]
+    results["provisioning_secs"] = metrics.provisioning_seconds.sum / sum(metrics.provisioning_seconds.counts)
+
+    # health checks are run by hand from now on
+    manager.scheduler.pause()
+    durations = []
+    for i in range(ticks):
+        started_at = time.perf_counter()
+        manager.check_state()
+        durations.append(time.perf_counter() - started_at)
+    results["tick_secs"] = statistics.median(durations)
+
+    # the best of a few rounds, as a single round is short enough to be skewed by other processes
+    rates = []
+    for round_index in range(CLAIM_ROUNDS):
+        staging_dirs = [create_staging_dir() for i in range(claims)]
+        started_at = time.perf_counter()
+        for i, staging_dir in enumerate(staging_dirs):
+            ticket = manager.request_vnc_instance("127.0.0.1", i, staging_dir, {})
+            if not ticket.vnc_url:
+                raise RuntimeError("Request %d was not served right away" % i)
+            manager.release_ticket(ticket.id)
+        rates.append(claims / (time.perf_counter() - started_at))
+    results["claims_per_sec"] = max(rates)
+
+    # time from a request to SUMO being launched on its instance, once it is connected to
+    durations = []
+    connections = []
+    for i in range(min(sessions, size)):
+        started_at = time.perf_counter()
+        ticket = manager.request_vnc_instance("127.0.0.1", i, create_staging_dir(), {})
+        vnc_instance = manager.pool[ticket.vnc_id]
+        connections.append(socket.create_connection(("localhost", vnc_instance.port)))
+        while vnc_instance.state != State.Serving or not vnc_instance.running_process:
+            if time.perf_counter() - started_at > 10:
+                raise TimeoutError("SUMO was not launched on VNC ID = %s" % ticket.vnc_id)
+            time.sleep(0.001)
+        durations.append(time.perf_counter() - started_at)
+    results["connect_secs"] = statistics.median(durations) if durations else 0
+    for connection in connections:
+        connection.close()
+
+    allocator = DisplayAllocator(base_index=Globals.BASE_DISPLAY_INDEX + 10 * size)
+    started_at = time.perf_counter()
+    display_indexes = [allocator.acquire() for i in range(size)]
+    for display_index in display_indexes:
+        allocator.release(display_index)
+    for i in range(size):
+        allocator.acquire()
+    results["acquire_us"] = (time.perf_counter() - started_at) / (3 * size) * 10 ** 6
+
+    for vnc_instance in list(manager.pool.values()):
+        vnc_instance.stop_command()
+    manager.stop(detach=True)
+    manager.websockify.stop()
+    return results
+
+
+# creates a staging directory holding the files of a request
+def create_staging_dir():
+    os.makedirs(Globals.STAGING_DIR, exist_ok=True)
+    staging_dir = tempfile.mkdtemp(dir=Globals.STAGING_DIR)
+    for name in Globals.VNC_SUMO_FILES:
+        with open(os.path.join(staging_dir, "%s.xml" % name), "w") as f:
+            f.write("<%s/>\n" % name)
+    return staging_dir
+
+
+def get_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+# runs the benchmark of a given pool size in a new process, in a new working directory, and returns its results
+def run_size_process(size, args) -> dict:
+    work_dir = tempfile.mkdtemp(prefix="vnc-bench-")
+    run_dir = os.path.join(work_dir, "run")
+    os.makedirs(run_dir)
+    try:
+        command = [sys.executable, os.path.abspath(__file__), "--run-size", "%d" % size, "--ticks", "%d" % args.ticks,
+                   "--claims", "%d" % args.claims, "--sessions", "%d" % args.sessions]
+        subprocess.run(command, cwd=run_dir)
+        results_path = os.path.join(work_dir, "results.json")
+        if not os.path.exists(results_path):
+            with open(os.path.join(work_dir, "bench.log"), "rb") as log:
+                log.seek(max(os.path.getsize(log.name) - 4000, 0))
+                print(log.read().decode(errors="replace"))
+            raise RuntimeError("Benchmark of a pool of %d instances failed" % size)
+        with open(results_path) as f:
+            return json.load(f)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+# compares results with a baseline, printing every measurement, and returns the measurements that regressed by more
+# than a given tolerance (e.g. 0.5 for 50% slower)
+def compare(results, baseline, tolerance):
+    regressions = []
+    print("%-6s %-18s %14s %14s %9s" % ("Size", "Measurement", "Result", "Baseline", "Change"))
+    for size, measurements in results.items():
+        for name, value in measurements.items():
+            base_value = baseline.get(size, {}).get(name)
+            change = ""
+            if base_value:
+                ratio = value / base_value if value else 0
+                change = "%+.1f%%" % ((ratio - 1) * 100)
+                worse = ratio < 1 / (1 + tolerance) if MEASUREMENTS[name] else ratio > 1 + tolerance
+                if worse:
+                    regressions.append((size, name))
+                    change += " REGRESSION"
+            base_info = "%14.6f" % base_value if base_value else "%14s" % "-"
+            print("%-6s %-18s %14.6f %s %9s" % (size, name, value, base_info, change))
+    return regressions
+
+
+# measures how the manager scales with the size of its pool, against stand-ins for vncserver, Xvnc, websockify and
+# sumo-gui, and fails (with exit status 1) if any measurement regressed with respect to the stored baseline, which is
+# written with --save (on the machine where the benchmark is meant to be compared)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks the VNC instance manager with stub VNC servers")
+    parser.add_argument("--sizes", default="10,100,1000", help="comma-separated pool sizes to measure")
+    parser.add_argument("--ticks", type=int, default=20, help="health checks to time at each size")
+    parser.add_argument("--claims", type=int, default=500, help="requests to claim (and release) at each size")
+    parser.add_argument("--sessions", type=int, default=10, help="sessions to connect to at each size")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="json file with the results to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.5,
+                        help="relative slowdown over the baseline that counts as a regression")
+    parser.add_argument("--save", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--run-size", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run_size:
+        run_size(args.run_size, args.ticks, args.claims, args.sessions)
+        sys.exit(0)
+    results = {}
+    for pool_size in [int(s) for s in args.sizes.split(",")]:
+        results["%d" % pool_size] = run_size_process(pool_size, args)
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=4)
+        compare(results, {}, args.tolerance)
+        print("Stored the results as the baseline in %s" % args.baseline)
+        sys.exit(0)
+    stored = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            stored = json.load(f)
+    else:
+        print("No baseline in %s (store one with --save)" % args.baseline)
+    found = compare(results, stored, args.tolerance)
+    if found:
+        print("%d measurements regressed by more than %.0f%%: %s" %
+              (len(found), args.tolerance * 100, ", ".join("%s at %s" % (name, size) for size, name in found)))
+        sys.exit(1)
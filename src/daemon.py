@@ -0,0 +1,92 @@
+import signal
+import threading
+
+from dotenv import load_dotenv, find_dotenv
+
+import logger
+import metrics
+import rpc
+import utils
+from globals import Globals
+from manager import Manager
+
+load_dotenv(find_dotenv())
+
+manager = Manager()
+
+
+# queues a request for an instance of a given profile, whose files were already received (and hashed) into a staging
+# directory, and waits up to a given amount of seconds for it to be served; returns the status of its ticket, or None
+# if the waiting queue is full
+def claim(source_ip, source_port, staging_dir, file_hashes, wait_secs=0, profile=Globals.VNC_DEFAULT_PROFILE):
+    ticket = manager.request_vnc_instance(source_ip, source_port, staging_dir, file_hashes, profile)
+    if ticket is None:
+        return None
+    ticket.wait(wait_secs)
+    return manager.describe_ticket(ticket)
+
+
+# waits up to a given amount of seconds for a ticket to be served and returns its status, or None if it is unknown
+def poll(ticket_id, wait_secs=0):
+    ticket = manager.get_ticket(ticket_id)
+    if ticket is None:
+        return None
+    ticket.wait(wait_secs)
+    return manager.describe_ticket(ticket)
+
+
+# gives up a ticket, whether it is still waiting or was already served
+def release(ticket_id):
+    manager.release_ticket(ticket_id)
+
+
+def status():
+    return manager.get_status()
+
+
+def health():
+    return manager.get_health()
+
+
+def get_metrics():
+    return metrics.registry.render()
+
+
+server = rpc.RpcServer(Globals.MANAGER_SOCKET_PATH, {"claim": claim, "poll": poll, "release": release,
+                                                        "status": status, "health": health,
+                                                        "metrics": get_metrics})
+
+
+# setup (the files of the instances are kept, as the manager adopts the instances that are still running); the pool
+# is warmed up in the background, so requests are accepted as soon as the RPC server is listening
+def init():
+    utils.clear_dir(Globals.STAGING_DIR)
+    manager.start()
+    server.start()
+
+
+# teardown: either stops every instance or detaches from them, leaving them running for the next daemon to adopt
+def terminate(detach=False):
+    server.stop()
+    manager.stop(detach)
+    if not detach:
+        utils.clear_and_remove_dir(Globals.VNC_FILES_DIR)
+
+
+# the daemon owns the one and only pool of instances, which any amount of API workers (see main.py) share through
+# the RPC server on MANAGER_SOCKET_PATH
+# SIGTERM (e.g. a restart by the service manager) detaches from the pool, so that active sessions survive until the
+# next daemon adopts them, while SIGINT tears the pool down
+if __name__ == '__main__':
+    logger.redirect_std_streams()
+    stopping = threading.Event()
+    detaching = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: (detaching.set(), stopping.set()))
+    signal.signal(signal.SIGINT, lambda signum, frame: stopping.set())
+    try:
+        init()
+        stopping.wait()
+        terminate(detaching.is_set())
+    except BaseException as e:
+        print("Error: ", e)
+        terminate()
@@ -0,0 +1,150 @@
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+from globals import Globals
+
+
+class FileStore:
+    """
+    Content-addressed store of uploaded files: each file is kept once, named by the SHA-256 hash of its content, and
+    the least recently used files are evicted once the store holds more than FILE_CACHE_MAX_BYTES. Files are handed
+    out as hard links, so evicting a file does not affect the directories it was linked into. The store may be shared
+    by several processes (e.g. API workers), so it is re-indexed from disk before files are evicted.
+    """
+
+    def __init__(self, path=None, max_bytes=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.files = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.loaded = False
+
+    # indexes the files already in the store, from the least to the most recently used
+    def load(self):
+        if self.path is None:
+            self.path = Globals.FILE_CACHE_DIR
+        if self.max_bytes is None:
+            self.max_bytes = Globals.FILE_CACHE_MAX_BYTES
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        entries = []
+        for name in os.listdir(self.path):
+            file_path = os.path.join(self.path, name)
+            if FileStore.is_hash(name) and os.path.isfile(file_path):
+                stat = os.stat(file_path)
+                entries.append((stat.st_atime, name, stat.st_size))
+        for atime, name, size in sorted(entries):
+            self.files[name] = size
+            self.total_bytes += size
+        self.loaded = True
+
+    # adds a file, whose hash and size are already known, to the store while keeping it in place: if the store already
+    # holds the same content, the file is replaced by a link to it, otherwise the store links to the file
+    def adopt(self, file_path, file_hash, size):
+        self.ensure_loaded()
+        with self.lock:
+            if file_hash in self.files and os.path.exists(self.get_path(file_hash)):
+                self.files.move_to_end(file_hash)
+                tmp_path = "%s.link" % file_path
+                try:
+                    os.link(self.get_path(file_hash), tmp_path)
+                    os.replace(tmp_path, file_path)
+                except OSError:
+                    pass
+                return file_hash
+            try:
+                os.link(file_path, self.get_path(file_hash))
+            except FileExistsError:
+                pass
+            except OSError:
+                shutil.copyfile(file_path, self.get_path(file_hash))
+            self.files[file_hash] = size
+            self.total_bytes += size
+            if self.total_bytes > self.max_bytes:
+                self.sync()
+                self.evict()
+        return file_hash
+
+    # checks if a file with a given hash is in the store, marking it as recently used
+    def has(self, file_hash):
+        self.ensure_loaded()
+        with self.lock:
+            if file_hash not in self.files:
+                # the file may have been added by another process sharing the store
+                if not FileStore.is_hash(file_hash) or not os.path.isfile(self.get_path(file_hash)):
+                    return False
+                self.files[file_hash] = os.path.getsize(self.get_path(file_hash))
+                self.total_bytes += self.files[file_hash]
+                return True
+            if not os.path.exists(self.get_path(file_hash)):
+                self.total_bytes -= self.files.pop(file_hash)
+                return False
+            self.files.move_to_end(file_hash)
+            return True
+
+    # makes the file with a given hash available at a given path, as a hard link if possible or as a copy otherwise
+    # raises KeyError if the store does not hold the file, including if it is evicted (e.g. by another process) while
+    # being linked
+    def link(self, file_hash, dest_path):
+        if not self.has(file_hash):
+            raise KeyError(file_hash)
+        if os.path.exists(dest_path):
+            os.remove(dest_path)
+        try:
+            os.link(self.get_path(file_hash), dest_path)
+        except OSError:
+            try:
+                shutil.copyfile(self.get_path(file_hash), dest_path)
+            except FileNotFoundError:
+                if os.path.exists(self.get_path(file_hash)):
+                    raise
+                self.has(file_hash)     # forgets the evicted file
+                raise KeyError(file_hash)
+
+    # re-indexes the store from disk, as other processes sharing it add and evict files too: the files that are gone
+    # are forgotten, and those added by other processes are indexed as the least recently used ones
+    def sync(self):
+        added = []
+        sizes = {}
+        for entry in os.scandir(self.path):
+            if FileStore.is_hash(entry.name) and entry.is_file():
+                stat = entry.stat()
+                sizes[entry.name] = stat.st_size
+                if entry.name not in self.files:
+                    added.append((stat.st_atime, entry.name))
+        for file_hash in [file_hash for file_hash in self.files if file_hash not in sizes]:
+            del self.files[file_hash]
+        for atime, file_hash in sorted(added, reverse=True):
+            self.files[file_hash] = sizes[file_hash]
+            self.files.move_to_end(file_hash, last=False)
+        self.total_bytes = sum(self.files.values())
+
+    # removes the least recently used files until the store fits its maximum size (the newest file is always kept)
+    def evict(self):
+        while self.total_bytes > self.max_bytes and len(self.files) > 1:
+            file_hash, size = self.files.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(self.get_path(file_hash))
+            except FileNotFoundError:
+                pass
+            print("Evicted file %s (%d bytes) from the file store" % (file_hash, size))
+
+    def ensure_loaded(self):
+        if not self.loaded:
+            with self.lock:
+                if not self.loaded:
+                    self.load()
+
+    def get_path(self, file_hash):
+        return os.path.join(self.path, file_hash)
+
+    @staticmethod
+    def is_hash(name):
+        return len(name) == 64 and all(c in "0123456789abcdef" for c in name)
+
+
+file_store = FileStore()
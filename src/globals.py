@@ -9,19 +9,112 @@ class Globals:
         "height": 600
     }
     VNC_SUMO_FILES = ["gui-settings", "net-file", "route-files"]
-    VNC_SUMO_CMD = "sumo-gui --gui-settings-file gui-settings.xml " \
-                   "--net-file net-file.xml " \
-                   "--route-files route-files.xml " \
-                   "--device.emissions.probability 1.0 " \
-                   "--collision.action warn " \
-                   "--window-size 800,600 " \
-                   "--window-pos 0,0"
+    FILE_CACHE_DIR = os.path.join("..", "file_cache")
+    FILE_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+    FILE_CHUNK_SIZE = 64 * 1024
+    # uploads are staged here before being moved into an instance directory, so it should be on the same filesystem
+    # as VNC_FILES_DIR and FILE_CACHE_DIR (ideally a tmpfs) for that move and the file store links to be zero-copy
+    STAGING_DIR = os.path.join("..", "staging")
+    UPLOAD_MAX_FILE_BYTES = 64 * 1024 * 1024
+    UPLOAD_MAX_TOTAL_BYTES = 128 * 1024 * 1024
+    UPLOAD_MAX_FIELD_BYTES = 1024
+    UPLOAD_MAX_PARTS = 16
+    VNC_DEPTH = 24
+    # run with "--window-size <width>,<height>" appended, from the geometry of each profile, unless it sets a "sumo_cmd"
+    VNC_SUMO_BASE_CMD = "sumo-gui --gui-settings-file gui-settings.xml " \
+                        "--net-file net-file.xml " \
+                        "--route-files route-files.xml " \
+                        "--device.emissions.probability 1.0 " \
+                        "--collision.action warn " \
+                        "--window-pos 0,0"
     WEBSOCKIFY_PORT = 6080
-    TOKENS_FILE_DIR = os.path.join("..", "vnc_tokens")
+    WEBSOCKIFY_WORKERS = None       # workers sharing WEBSOCKIFY_PORT, one per core if None
+    WEBSOCKIFY_BACKLOG = 128
+    WEBSOCKIFY_VERBOSE = False      # logs every frame, which slows the proxying of every session down
+    WEBSOCKIFY_PLUGINS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "plugins")
+    MANAGER_SOCKET_PATH = os.path.join("..", "vnc_manager.sock")
+    RPC_POOL_SIZE = 16
+    RPC_TIMEOUT_SECS = 30
+    RPC_MAX_MESSAGE_BYTES = 2 * UPLOAD_MAX_FILE_BYTES      # large enough for a file sent to a node agent as base64
+    TOKENS_SOCKET_PATH = os.path.join("..", "vnc_tokens.sock")
     BASE_DISPLAY_INDEX = 21     # 1
+    VNC_BASE_PORT = 5900
+    X_LOCK_DIR = "/tmp"
+    X_SOCKET_DIR = os.path.join("/tmp", ".X11-unix")
     POOL_BASE_SIZE = 10
     POOL_EXPAND_SIZE = POOL_BASE_SIZE // 2
+    POOL_MAX_SIZE = 100
+    # named instance profiles, each with a warm sub-pool of its own: the geometry ("width" and "height") and colour
+    # "depth" of its VNC servers, the "sumo_cmd" run on them, and the "base_size", "max_size" and
+    # "prewarm_schedule" (see SCALING_PREWARM_SCHEDULE) of its sub-pool; requests pick one with their "profile" query
+    # parameter, VNC_DEFAULT_PROFILE otherwise
+    # settings left out of VNC_DEFAULT_PROFILE are taken from VNC_RESOLUTION, VNC_DEPTH, POOL_BASE_SIZE, POOL_MAX_SIZE
+    # and SCALING_PREWARM_SCHEDULE; those left out of any other profile from VNC_DEFAULT_PROFILE, except for the base
+    # size and pre-warm schedule of its sub-pool, which is then only sized on demand; the "sumo_cmd" of any profile
+    # that leaves it out is VNC_SUMO_BASE_CMD with a window the size of its own geometry; e.g.
+    #     "mobile": {"width": 480, "height": 360, "depth": 16, "base_size": 2, "max_size": 20},
+    #     "projector": {"width": 1920, "height": 1080, "max_size": 5}
+    VNC_DEFAULT_PROFILE = "default"
+    VNC_PROFILES = {
+        "default": {}
+    }
     REQUEST_TIMEOUT_SECS = 20
+    RECYCLE_MAX_SESSIONS = 20       # instances are restarted, instead of recycled, after this many sessions
+    RECYCLE_TIMEOUT_SECS = 2
+    TEARDOWN_TIMEOUT_SECS = 10
+    # a session is idle while its client sends at most IDLE_MIN_INPUT_BYTES_PER_SEC to its VNC server (input events
+    # and framebuffer update requests, so a client still refreshing an animated screen counts as active); its user is
+    # warned IDLE_WARNING_SECS before it is disconnected, after IDLE_TIMEOUT_SECS, and its instance recycled (None
+    # disables idle sessions from being reclaimed)
+    IDLE_TIMEOUT_SECS = 1800
+    IDLE_WARNING_SECS = 120
+    IDLE_MIN_INPUT_BYTES_PER_SEC = 0
+    IDLE_WARNING_CMD = "xmessage -center -timeout %(secs)d This session has been idle and will be closed in %(secs)d " \
+                       "seconds unless it is used"
+    IDLE_DISCONNECT_CMD = "vncconfig -disconnect"
+    JOURNAL_PATH = os.path.join("..", "vnc_pool.json")
+    QUEUE_MAX_SIZE = 200
+    QUEUE_TIMEOUT_SECS = 120
+    QUEUE_LONG_POLL_SECS = 20       # must be lower than RPC_TIMEOUT_SECS
+    WATCHER_INTERVAL_SECS = 0.05
+    SUPERVISOR_POLL_SECS = 1
+    PROVISION_WORKERS = 4
+    HEALTH_CHECK_INTERVAL_SECS = 2
+    # no instances are added while the host (or node) is above either threshold
+    RESOURCES_MAX_CPU_PERCENT = 85
+    RESOURCES_MAX_MEMORY_PERCENT = 85
+    # optional limits of each SUMO session: a nice value and, with a delegated cgroup v2 directory (e.g.
+    # "/sys/fs/cgroup/mobiwise", with +cpu +memory in its cgroup.subtree_control), a cgroup per session with a CPU
+    # limit (in % of one core) and a memory limit (in bytes)
+    SESSION_NICE = None
+    SESSION_CGROUP_DIR = None
+    SESSION_CPU_MAX_PERCENT = None
+    SESSION_MEMORY_MAX_BYTES = None
+    # addresses ("host:port") of the node agents (see agent.py) on which instances are placed; if there are none, the
+    # manager runs every instance on its own host
+    AGENTS = []
+    AGENT_PORT = 7000
+    # secret shared by the manager and its node agents, which every call to an agent must carry; agents refuse to
+    # listen on anything but a loopback address without one
+    AGENT_TOKEN = None
+    AGENT_MAX_INSTANCES = 20
+    AGENT_TIMEOUT_SECS = 2
+    AGENT_MAX_MISSED_REPORTS = 3
+
+    SCALING_POLICY = "forecast"     # "forecast" or "threshold"
+    SCALING_WINDOW_SECS = 300
+    SCALING_BURST_WINDOW_SECS = 30
+    SCALING_EWMA_ALPHA = 0.2
+    SCALING_MISS_PROBABILITY = 0.01
+    SCALING_MIN_SPARE = 1
+    SCALING_HYSTERESIS = POOL_EXPAND_SIZE
+    SCALING_COOLDOWN_SECS = 60
+    SCALING_INITIAL_SESSION_SECS = 600
+    SCALING_INITIAL_PROVISIONING_SECS = 5
+    # (weekdays, start hour, end hour, minimum pool size), e.g. ([0, 2], 9, 11.5, 30) for Mondays and Wednesdays
+    # from 9:00 to 11:30; an empty list of weekdays matches every day
+    SCALING_PREWARM_SCHEDULE = []
+    SCALING_TRACE_PATH = None       # if set, requests are appended to this csv file to be replayed by simulate.py
 
     LOGS_OLD_NAME = "old logs"
     LOGS_DIR = os.path.join("..", "logs")
@@ -30,4 +123,10 @@ class Globals:
     LOGS_LEVEL_WARN = "WARN"
     LOGS_LEVEL_ERROR = "ERROR"
     LOGS_FILE_TYPE = "log"
+    LOGS_QUEUE_SIZE = 10000
+    LOGS_BATCH_SIZE = 500
+    LOGS_FLUSH_INTERVAL_SECS = 1
+    LOGS_FLUSH_SIZE = 64 * 1024
+    LOGS_MAX_FILE_BYTES = 10 * 1024 * 1024
+    LOGS_BLOCK_TIMEOUT_SECS = 0.1
 
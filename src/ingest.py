@@ -0,0 +1,137 @@
+import hashlib
+import os
+import shutil
+import tempfile
+
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData
+
+from filestore import file_store
+from globals import Globals
+
+
+class IngestError(Exception):
+    def __init__(self, message, status, data=None):
+        super().__init__(message)
+        self.status = status
+        self.data = data if data else {}
+
+
+class Upload:
+    def __init__(self, staging_dir):
+        self.staging_dir = staging_dir
+        self.fields = {}
+        self.file_hashes = {}
+        self.part_names = set()
+
+    # removes the staging directory (if it was not moved into an instance directory)
+    def discard(self):
+        shutil.rmtree(self.staging_dir, ignore_errors=True)
+
+
+# parses a multipart request body incrementally, writing each of the VNC_SUMO_FILES straight into a new staging
+# directory (as "<name>.xml") while hashing it, and returns the resulting upload once every file is present, either
+# uploaded or referenced by the hash of a previous upload (in a "<name>-hash" field)
+def ingest(stream, content_type, content_length) -> Upload:
+    if content_length and content_length > Globals.UPLOAD_MAX_TOTAL_BYTES:
+        raise IngestError("Request body is larger than %d bytes" % Globals.UPLOAD_MAX_TOTAL_BYTES, 413)
+    mimetype, options = parse_options_header(content_type)
+    if mimetype != "multipart/form-data" or "boundary" not in options:
+        raise IngestError("Request body is not multipart/form-data", 400)
+    os.makedirs(Globals.STAGING_DIR, exist_ok=True)
+    upload = Upload(tempfile.mkdtemp(dir=Globals.STAGING_DIR))
+    try:
+        try:
+            receive(upload, stream, options["boundary"].encode())
+        except RequestEntityTooLarge:
+            raise IngestError("Request body has more than %d parts" % Globals.UPLOAD_MAX_PARTS, 413)
+        except ValueError as e:
+            raise IngestError("Malformed multipart body: %s" % e, 400)
+        missing = []
+        for name in Globals.VNC_SUMO_FILES:
+            if name in upload.file_hashes:
+                continue
+            file_hash = upload.fields.get("%s-hash" % name, "")
+            try:
+                file_store.link(file_hash, os.path.join(upload.staging_dir, "%s.xml" % name))
+                upload.file_hashes[name] = file_hash
+            except KeyError:
+                missing.append(name)
+        if missing:
+            raise IngestError("Missing files: %s" % ", ".join(missing), 409, {"missing_files": missing})
+        return upload
+    except BaseException:
+        upload.discard()
+        raise
+
+
+# feeds the request body to the multipart decoder chunk by chunk, enforcing the per-file and total size limits (form
+# fields larger than UPLOAD_MAX_FIELD_BYTES are truncated)
+def receive(upload: Upload, stream, boundary):
+    decoder = MultipartDecoder(boundary, max_parts=Globals.UPLOAD_MAX_PARTS)
+    total_bytes = 0
+    part = None
+    while True:
+        chunk = stream.read(Globals.FILE_CHUNK_SIZE)
+        decoder.receive_data(chunk if chunk else None)
+        event = decoder.next_event()
+        while not isinstance(event, (NeedData, Epilogue)):
+            if isinstance(event, (Field, File)):
+                if event.name in upload.part_names:
+                    raise IngestError("Part %s is sent more than once" % event.name, 400)
+                upload.part_names.add(event.name)
+                part = Part(upload, event)
+            elif isinstance(event, Data) and part:
+                total_bytes += len(event.data)
+                if total_bytes > Globals.UPLOAD_MAX_TOTAL_BYTES:
+                    raise IngestError("Request body is larger than %d bytes" % Globals.UPLOAD_MAX_TOTAL_BYTES, 413)
+                part.write(event.data)
+                if not event.more_data:
+                    part.close()
+            event = decoder.next_event()
+        if isinstance(event, Epilogue) or not chunk:
+            return
+
+
+class Part:
+    """
+    Part of a multipart request body being received. Uploaded files are written to a new file of their own and only
+    moved into place once complete, as the file already in place may be a link into the file store (see
+    FileStore.adopt) that must never be written to.
+    """
+
+    def __init__(self, upload: Upload, event):
+        self.upload = upload
+        self.name = event.name
+        self.size = 0
+        self.file = None
+        self.digest = None
+        self.value = b""
+        self.path = None
+        self.partial_path = None
+        if isinstance(event, File) and self.name in Globals.VNC_SUMO_FILES:
+            self.path = os.path.join(upload.staging_dir, "%s.xml" % self.name)
+            fd, self.partial_path = tempfile.mkstemp(dir=upload.staging_dir, suffix=".part")
+            self.file = os.fdopen(fd, "wb")
+            self.digest = hashlib.sha256()
+
+    def write(self, data):
+        self.size += len(data)
+        if self.file:
+            if self.size > Globals.UPLOAD_MAX_FILE_BYTES:
+                self.file.close()
+                raise IngestError("File %s is larger than %d bytes" % (self.name, Globals.UPLOAD_MAX_FILE_BYTES), 413)
+            self.digest.update(data)
+            self.file.write(data)
+        elif self.size <= Globals.UPLOAD_MAX_FIELD_BYTES:
+            self.value += data
+
+    # completes the part: uploaded files are added to the file store, fields are kept as strings
+    def close(self):
+        if self.file:
+            self.file.close()
+            os.replace(self.partial_path, self.path)
+            self.upload.file_hashes[self.name] = file_store.adopt(self.path, self.digest.hexdigest(), self.size)
+        else:
+            self.upload.fields[self.name] = self.value.decode(errors="replace")
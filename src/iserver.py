@@ -1,11 +1,15 @@
 from enum import Enum
 
+from snapshot import HostSnapshot
+
 
 class State(Enum):
     Dead = -1
     Unavailable = 0
     Ready = 1
     Serving = 2
+    Provisioning = 3
+    Recycling = 4
 
 
 class IServer:
@@ -15,7 +19,7 @@ class IServer:
     def stop(self):
         raise NotImplementedError
 
-    def check_state(self) -> bool:
+    def check_state(self, snapshot: HostSnapshot) -> bool:
         raise NotImplementedError
 
     def describe_state(self) -> str:
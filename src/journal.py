@@ -0,0 +1,46 @@
+import json
+import os
+
+from globals import Globals
+
+
+class Journal:
+    """
+    Small file recording the state of the pool (the id, display index, port and pids of each instance, and the pid of
+    websockify) so that a restarted manager can adopt the servers that outlived the previous one. It is rewritten
+    atomically, and only when its content changes.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.last_state = None
+
+    def write(self, state: dict):
+        if state == self.last_state:
+            return
+        tmp_path = "%s.tmp" % self.get_path()
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.get_path())
+            self.last_state = state
+        except OSError as e:
+            print("Error: ", e)
+
+    # returns the last state written, or an empty one if there is none (or it cannot be read)
+    def read(self) -> dict:
+        try:
+            with open(self.get_path()) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def clear(self):
+        if os.path.exists(self.get_path()):
+            os.remove(self.get_path())
+        self.last_state = None
+
+    def get_path(self):
+        return self.path if self.path else Globals.JOURNAL_PATH
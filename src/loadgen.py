@@ -0,0 +1,413 @@
+import argparse
+import base64
+import http.client
+import json
+import math
+import os
+import random
+import shutil
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+from globals import Globals
+import simulate
+
+STUBS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stubs")
+ARRIVAL_CURVES = ["constant", "poisson", "ramp", "spike"]
+
+
+class WebSocket:
+    """
+    Minimal websocket client, just enough to carry an RFB session through websockify: binary frames are sent masked
+    (as the protocol requires from clients) and the payloads received are read as a single stream of bytes.
+    """
+
+    def __init__(self, host, port, path, timeout):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.stream = self.sock.makefile("rb")
+        self.buffer = b""
+        key = base64.b64encode(os.urandom(16)).decode()
+        request = "GET %s HTTP/1.1\r\nHost: %s:%d\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n" \
+                  "Sec-WebSocket-Key: %s\r\nSec-WebSocket-Version: 13\r\nSec-WebSocket-Protocol: binary\r\n\r\n"
+        self.sock.sendall((request % (path, host, port, key)).encode())
+        status_line = self.stream.readline().decode(errors="replace")
+        while self.stream.readline().strip():
+            pass
+        if " 101 " not in status_line:
+            self.close()
+            raise OSError("Websocket handshake failed: %s" % status_line.strip())
+
+    def send(self, data):
+        mask = os.urandom(4)
+        payload = bytes(b ^ mask[i % 4] for i, b in enumerate(data))
+        if len(payload) < 126:
+            header = struct.pack(">BB", 0x82, 0x80 | len(payload))
+        else:
+            header = struct.pack(">BBH", 0x82, 0x80 | 126, len(payload))
+        self.sock.sendall(header + mask + payload)
+
+    # returns exactly the given amount of bytes from the payloads received, reading as many frames as needed
+    def recv(self, size):
+        while len(self.buffer) < size:
+            header = self.read(2)
+            opcode = header[0] & 0x0F
+            length = header[1] & 0x7F
+            if length == 126:
+                length = struct.unpack(">H", self.read(2))[0]
+            elif length == 127:
+                length = struct.unpack(">Q", self.read(8))[0]
+            payload = self.read(length)
+            if opcode == 0x8:
+                raise EOFError("Websocket was closed")
+            if opcode in [0x0, 0x1, 0x2]:
+                self.buffer += payload
+        data = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return data
+
+    def read(self, size):
+        data = self.stream.read(size)
+        if len(data) < size:
+            raise EOFError("Websocket was closed")
+        return data
+
+    def close(self):
+        try:
+            self.sock.sendall(struct.pack(">BB", 0x88, 0x80) + os.urandom(4))
+        except OSError:
+            pass
+        self.stream.close()
+        self.sock.close()
+
+
+class User:
+    """
+    A simulated user: uploads the files of a scenario, waits for an instance (polling its ticket if the request was
+    queued), connects to it through websockify, goes through the RFB handshake until its first frame and holds the
+    session for a while before disconnecting.
+    """
+
+    def __init__(self, index, arrives_at, hold_secs, profile=Globals.VNC_DEFAULT_PROFILE):
+        self.index = index
+        self.arrives_at = arrives_at
+        self.hold_secs = hold_secs
+        self.profile = profile
+        self.started_at = None
+        self.served_at = None
+        self.first_frame_at = None
+        self.ended_at = None
+        self.queued = False
+        self.error = None
+
+    def run(self, api, ws, timeout):
+        self.started_at = time.monotonic()
+        try:
+            vnc_url = self.request(api, timeout)
+            self.served_at = time.monotonic()
+            token = parse_qs(urlparse(vnc_url).query)["token"][0]
+            websocket = WebSocket(ws[0], ws[1], "/?token=%s" % token, timeout)
+            try:
+                rfb_handshake(websocket)
+                self.first_frame_at = time.monotonic()
+                time.sleep(self.hold_secs)
+            finally:
+                websocket.close()
+        except (OSError, EOFError, ValueError, KeyError, struct.error) as e:
+            self.error = str(e) or type(e).__name__
+        self.ended_at = time.monotonic()
+
+    # posts the request and returns the url of its instance, polling its ticket until it is served if it was queued
+    # (the request itself is not held waiting, so that a request that found no ready instance is counted as a miss)
+    def request(self, api, timeout):
+        boundary = "----loadgen%d" % self.index
+        body = b""
+        for name in Globals.VNC_SUMO_FILES:
+            part_info = (boundary, name, name, name, self.index)
+            body += ("--%s\r\nContent-Disposition: form-data; name=\"%s\"; filename=\"%s.xml\"\r\n"
+                     "Content-Type: text/xml\r\n\r\n<%s user=\"%d\"/>\r\n" % part_info).encode()
+        body += ("--%s--\r\n" % boundary).encode()
+        status, data = call_api(api, "POST", "/api/vnc/request?wait=0&profile=%s" % self.profile, timeout, body,
+                                {"Content-Type": "multipart/form-data; boundary=%s" % boundary})
+        while status == 202:
+            self.queued = True
+            status, data = call_api(api, "GET", data["data"]["ticket_url"], timeout)
+        if status != 200:
+            raise ValueError("HTTP %d: %s" % (status, data.get("error")))
+        return data["data"]["vnc_url"]
+
+
+# goes through the RFB 3.8 handshake (without security) and requests a frame, returning once it starts arriving
+def rfb_handshake(websocket):
+    version = websocket.recv(12)
+    if not version.startswith(b"RFB "):
+        raise ValueError("Not an RFB server")
+    websocket.send(b"RFB 003.008\n")
+    security_types = websocket.recv(websocket.recv(1)[0])
+    if 1 not in security_types:
+        raise ValueError("Server requires authentication")
+    websocket.send(b"\x01")
+    if struct.unpack(">I", websocket.recv(4))[0] != 0:
+        raise ValueError("Security handshake failed")
+    websocket.send(b"\x01")
+    width, height = struct.unpack(">HH", websocket.recv(4))
+    websocket.recv(16)
+    websocket.recv(struct.unpack(">I", websocket.recv(4))[0])
+    websocket.send(struct.pack(">BBHHHH", 3, 0, 0, 0, width, height))
+    while True:
+        message_type = websocket.recv(1)[0]
+        if message_type == 0:
+            return
+        if message_type == 1:
+            websocket.recv(6 * struct.unpack(">xHH", websocket.recv(5))[1])
+        elif message_type == 3:
+            websocket.recv(struct.unpack(">xxxI", websocket.recv(7))[0])
+        elif message_type != 2:
+            raise ValueError("Unexpected RFB message type %d" % message_type)
+
+
+# calls the API and returns the status and json body of its response
+def call_api(api, method, path, timeout, body=None, headers=None):
+    connection = http.client.HTTPConnection(api[0], api[1], timeout=timeout)
+    try:
+        connection.request(method, path, body=body, headers=headers if headers else {})
+        response = connection.getresponse()
+        data = response.read()
+        try:
+            return response.status, json.loads(data)
+        except ValueError:
+            return response.status, {"error": data[:200].decode(errors="replace")}
+    finally:
+        connection.close()
+
+
+# returns the arrival time (in seconds since the start of the run) of each user, for a given arrival curve at a given
+# mean rate (users per second) over a given duration
+# constant: evenly spaced | poisson: exponential inter-arrival times | ramp: the rate grows linearly from 0 to twice
+# the given rate | spike: a quarter of the users arrive within the middle tenth of the run, the rest evenly spaced
+def get_arrival_times(curve, rate, duration_secs):
+    count = int(rate * duration_secs)
+    if curve == "constant":
+        return [i / rate for i in range(count)]
+    if curve == "poisson":
+        times = []
+        now = random.expovariate(rate)
+        while now < duration_secs:
+            times.append(now)
+            now += random.expovariate(rate)
+        return times
+    if curve == "ramp":
+        return [math.sqrt(i * duration_secs / rate) for i in range(count)]
+    spike_count = count // 4
+    spread = [i * duration_secs / (count - spike_count) for i in range(count - spike_count)]
+    spike = [duration_secs * (0.45 + 0.1 * i / max(spike_count, 1)) for i in range(spike_count)]
+    return sorted(spread + spike)
+
+
+# polls the status of the pool every second, until stopped, and returns the samples taken
+def sample_pool(api, timeout, stopping: threading.Event, samples: list):
+    while not stopping.wait(1):
+        try:
+            status, data = call_api(api, "GET", "/api/vnc/status", timeout)
+            if status == 200:
+                samples.append(data["data"])
+        except OSError:
+            pass
+
+
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[max(int(math.ceil(fraction * len(values))) - 1, 0)]
+
+
+# runs the users (each on a thread of its own, started at its arrival time) and returns a summary of the run
+def run_load(users, api, ws, timeout):
+    samples = []
+    stopping = threading.Event()
+    sampler = threading.Thread(target=sample_pool, args=(api, timeout, stopping, samples), daemon=True)
+    sampler.start()
+    threads = []
+    started_at = time.monotonic()
+    for user in users:
+        delay = started_at + user.arrives_at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        thread = threading.Thread(target=user.run, args=(api, ws, timeout), daemon=True)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    stopping.set()
+    sampler.join()
+    return summarize(users, samples, time.monotonic() - started_at)
+
+
+def summarize(users, samples, duration_secs):
+    served = [user for user in users if user.first_frame_at]
+    errors = {}
+    for user in users:
+        if user.error:
+            errors[user.error] = errors.get(user.error, 0) + 1
+    events = sorted([(user.first_frame_at, 1) for user in served] + [(user.ended_at, -1) for user in served])
+    concurrent = 0
+    max_concurrent = 0
+    for timestamp, delta in events:
+        concurrent += delta
+        max_concurrent = max(max_concurrent, concurrent)
+    first_frame_secs = [user.first_frame_at - user.started_at for user in served]
+    served_secs = [user.served_at - user.started_at for user in served]
+    sizes = [sample["size"] for sample in samples]
+    return {
+        "users": len(users),
+        "duration_secs": round(duration_secs, 1),
+        "sessions": len(served),
+        "failed": len(users) - len(served),
+        "miss_rate": sum(1 for user in users if user.queued or not user.first_frame_at) / max(len(users), 1),
+        "max_concurrent_sessions": max_concurrent,
+        "time_to_url_p50_secs": percentile(served_secs, 0.5),
+        "time_to_url_p99_secs": percentile(served_secs, 0.99),
+        "time_to_first_frame_p50_secs": percentile(first_frame_secs, 0.5),
+        "time_to_first_frame_p99_secs": percentile(first_frame_secs, 0.99),
+        "pool_size_min": min(sizes) if sizes else None,
+        "pool_size_max": max(sizes) if sizes else None,
+        "pool_ready_min": min(sample["states"]["Ready"] for sample in samples) if samples else None,
+        "waiting_max": max(sample["waiting"] for sample in samples) if samples else None,
+        "errors": errors
+    }
+
+
+# runs the whole stack (daemon and API) on this host against the stubs in STUBS_DIR, in the parent of the current
+# directory, and writes where it can be reached to stack.json; runs until terminated
+def serve_local(pool_size):
+    work_dir = os.path.abspath("..")
+    Globals.POOL_BASE_SIZE = pool_size
+    Globals.X_LOCK_DIR = work_dir
+    Globals.X_SOCKET_DIR = os.path.join(work_dir, ".X11-unix")
+    Globals.VNC_BASE_PORT = 20000
+    Globals.WEBSOCKIFY_PORT = get_free_port()
+    os.environ["PATH"] = "%s%s%s" % (STUBS_DIR, os.pathsep, os.environ["PATH"])
+    os.environ["STUB_HOST_SOCKET"] = os.path.join(work_dir, "stubhost.sock")
+    sys.stdout = open(os.path.join(work_dir, "stack.log"), "w")
+    sys.stderr = sys.stdout
+    # imported once Globals has been set up, as the daemon creates its manager on import
+    import daemon
+    import main
+    from werkzeug.serving import make_server
+
+    stub_host = subprocess.Popen([sys.executable, os.path.join(STUBS_DIR, "stubhost.py"),
+                                  os.environ["STUB_HOST_SOCKET"], work_dir])
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    api = make_server("localhost", get_free_port(), main.app, threaded=True)
+    try:
+        while not os.path.exists(os.environ["STUB_HOST_SOCKET"]):
+            time.sleep(0.01)
+        daemon.init()
+        threading.Thread(target=api.serve_forever, daemon=True).start()
+        with open(os.path.join(work_dir, "stack.json"), "w") as f:
+            json.dump({"api": ["localhost", api.server_port], "ws": ["localhost", Globals.WEBSOCKIFY_PORT]}, f)
+        stopping.wait()
+    finally:
+        api.shutdown()
+        daemon.terminate()
+        stub_host.terminate()
+        stub_host.wait()
+
+
+# starts the local stack in a new process and work directory, and returns it with the addresses of its API and
+# websockify once it is up
+def start_local_stack(pool_size):
+    work_dir = tempfile.mkdtemp(prefix="vnc-loadgen-")
+    run_dir = os.path.join(work_dir, "run")
+    os.makedirs(run_dir)
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve-local", "--pool-size",
+                                "%d" % pool_size], cwd=run_dir)
+    stack_path = os.path.join(work_dir, "stack.json")
+    while not os.path.exists(stack_path):
+        if process.poll() is not None:
+            raise RuntimeError("Local stack exited, see %s" % os.path.join(work_dir, "stack.log"))
+        time.sleep(0.05)
+    time.sleep(0.05)
+    with open(stack_path) as f:
+        stack = json.load(f)
+    return process, work_dir, tuple(stack["api"]), tuple(stack["ws"])
+
+
+# waits for the API to report that it can serve requests right away
+def wait_until_healthy(api, timeout_secs):
+    deadline = time.monotonic() + timeout_secs
+    while time.monotonic() < deadline:
+        try:
+            if call_api(api, "GET", "/api/health", 5)[0] == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise TimeoutError("API at %s:%d is not healthy" % api)
+
+
+def get_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def parse_address(address):
+    host, _, port = address.rpartition(":")
+    return host or "localhost", int(port)
+
+
+# drives simulated users through the whole path (request, websockify, RFB, SUMO launch) either against a running
+# deployment (--api and --ws) or, with --local, against a stack started on this host with stubs in place of TigerVNC,
+# websockify and SUMO; users arrive following a curve, or the timestamps and durations of a recorded trace
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generates end-to-end load on the VNC instance manager")
+    parser.add_argument("--local", action="store_true", help="run against a local stack of stubs")
+    parser.add_argument("--pool-size", type=int, default=Globals.POOL_BASE_SIZE, help="base pool size with --local")
+    parser.add_argument("--api", default="localhost:5001", help="address of the API")
+    parser.add_argument("--ws", default="localhost:%d" % Globals.WEBSOCKIFY_PORT,
+                        help="address of websockify (plain ws, as TLS is not supported)")
+    parser.add_argument("--curve", choices=ARRIVAL_CURVES, default="poisson")
+    parser.add_argument("--rate", type=float, default=1, help="mean arrival rate, in users per second")
+    parser.add_argument("--duration-secs", type=float, default=60, help="time over which users arrive")
+    parser.add_argument("--hold-secs", type=float, default=30, help="how long each user holds its session")
+    parser.add_argument("--profile", default=Globals.VNC_DEFAULT_PROFILE, help="instance profile the users request")
+    parser.add_argument("--trace", help="csv file of \"timestamp,duration\" rows to replay instead of a curve")
+    parser.add_argument("--timeout-secs", type=float, default=Globals.QUEUE_TIMEOUT_SECS + 10,
+                        help="timeout of each call made by a user")
+    parser.add_argument("--serve-local", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve_local:
+        serve_local(args.pool_size)
+        sys.exit(0)
+    if args.trace:
+        trace = sorted(simulate.read_trace(args.trace))
+        simulated_users = [User(i, timestamp - trace[0][0], duration if duration is not None else args.hold_secs,
+                                args.profile) for i, (timestamp, duration) in enumerate(trace)]
+    else:
+        simulated_users = [User(i, arrives_at, args.hold_secs, args.profile)
+                           for i, arrives_at in enumerate(get_arrival_times(args.curve, args.rate, args.duration_secs))]
+    stack = None
+    api_address = parse_address(args.api)
+    ws_address = parse_address(args.ws)
+    try:
+        if args.local:
+            stack, stack_dir, api_address, ws_address = start_local_stack(args.pool_size)
+        wait_until_healthy(api_address, 60)
+        print("Running %d users against %s:%d" % ((len(simulated_users),) + api_address))
+        summary = run_load(simulated_users, api_address, ws_address, args.timeout_secs)
+        for key in summary:
+            print("%s = %s" % (key, summary[key]))
+    finally:
+        if stack:
+            stack.terminate()
+            stack.wait()
+            shutil.rmtree(stack_dir, ignore_errors=True)
@@ -1,7 +1,12 @@
+import atexit
+import gzip
 import os
+import queue
+import shutil
 import sys
-from datetime import datetime
 import threading
+import time
+from datetime import datetime
 
 from globals import Globals
 
@@ -15,17 +20,28 @@ class Logger:
             self.source = source
             self.message = message
 
-    def __init__(self):
-        self.logs = []
-        self.logs_rlock = threading.RLock()
-
-    def log(self, level, source, message, direct_write=False):
+    def __init__(self, name):
+        self.name = name
+        self.queue = queue.Queue(maxsize=Globals.LOGS_QUEUE_SIZE)
+        self.files = {}
+        self.writer = None
+        self.writer_lock = threading.Lock()
+        self.dropped = 0
+        self.dropped_lock = threading.Lock()
+
+    # queues a log record for the writer thread without blocking
+    # when the queue is full, warnings and errors wait a little for space while other records are dropped
+    def log(self, level, source, message):
+        self.ensure_writer()
         log = Logger.Log(datetime.now(), level, threading.current_thread().name, source, message)
-        with self.logs_rlock:
-            if direct_write:
-                Logger.write(log)
+        try:
+            if level in [Globals.LOGS_LEVEL_WARN, Globals.LOGS_LEVEL_ERROR]:
+                self.queue.put(log, timeout=Globals.LOGS_BLOCK_TIMEOUT_SECS)
             else:
-                self.logs.append(log)
+                self.queue.put_nowait(log)
+        except queue.Full:
+            with self.dropped_lock:
+                self.dropped += 1
 
     def info(self, source, message):
         self.log(Globals.LOGS_LEVEL_INFO, source, message)
@@ -39,26 +55,140 @@ class Logger:
     def error(self, source, message):
         self.log(Globals.LOGS_LEVEL_ERROR, source, message)
 
-    def flush(self):
-        with self.logs_rlock:
-            for log in self.logs:
-                Logger.write(log)
-            self.logs.clear()
-
-    @staticmethod
-    def write(log: Log):
-        if not os.path.exists(Globals.LOGS_DIR):
-            os.makedirs(Globals.LOGS_DIR)
-        file_name = os.path.join(Globals.LOGS_DIR, "%s.%s" % (log.thread, Globals.LOGS_FILE_TYPE))
+    # blocks until every record queued so far has been written to disk (or the timeout expires)
+    def flush(self, timeout=None):
+        if not self.writer:
+            return
+        written = threading.Event()
+        try:
+            self.queue.put(written, timeout=timeout)
+        except queue.Full:
+            return
+        written.wait(timeout)
+
+    # flushes and stops the writer thread, closing every open log file
+    def close(self):
+        if not self.writer:
+            return
+        self.queue.put(None)
+        self.writer.join()
+        self.writer = None
+
+    # starts the writer thread, if it is not running yet
+    def ensure_writer(self):
+        if self.writer:
+            return
+        with self.writer_lock:
+            if not self.writer:
+                self.writer = threading.Thread(target=self.run, name="Logger", daemon=True)
+                self.writer.start()
+
+    # writer thread: takes batches of records from the queue, writes them through persistent file handles, and
+    # flushes those handles on an interval or once enough bytes have been written
+    def run(self):
+        self.rotate_all()
+        last_flush = time.monotonic()
+        unflushed = 0
+        running = True
+        while running:
+            batch = []
+            try:
+                batch.append(self.queue.get(timeout=Globals.LOGS_FLUSH_INTERVAL_SECS))
+                while len(batch) < Globals.LOGS_BATCH_SIZE:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            markers = []
+            for item in batch:
+                if item is None:
+                    running = False
+                elif isinstance(item, threading.Event):
+                    markers.append(item)
+                else:
+                    unflushed += self.write(item)
+            dropped = self.take_dropped()
+            if dropped:
+                log = Logger.Log(datetime.now(), Globals.LOGS_LEVEL_WARN, "Logger", "Logger",
+                                 "Dropped %d log records as the queue was full" % dropped)
+                unflushed += self.write(log)
+            now = time.monotonic()
+            if markers or not running or unflushed >= Globals.LOGS_FLUSH_SIZE or \
+                    now - last_flush >= Globals.LOGS_FLUSH_INTERVAL_SECS:
+                self.flush_files()
+                last_flush = now
+                unflushed = 0
+            for marker in markers:
+                marker.set()
+        for file_name in list(self.files):
+            self.files.pop(file_name).close()
+
+    # returns and resets the amount of records dropped since the last call
+    def take_dropped(self):
+        with self.dropped_lock:
+            dropped = self.dropped
+            self.dropped = 0
+        return dropped
+
+    # writes a record to the (buffered) file of its thread and returns the amount of characters written
+    def write(self, log: Log):
+        file_name = os.path.join(Globals.LOGS_DIR, "%s-%s.%s" % (self.name, log.thread, Globals.LOGS_FILE_TYPE))
         timestamp = str(log.timestamp)
         sep = "  "
         spaces = (" " * len(timestamp)) + sep
         message = log.message.replace("\n", "\n" + spaces).rstrip()
-        with open(file_name, "a") as file:
-            file.write("%s%s[%s][%s] %s\n" % (timestamp, sep, log.level, log.source, message))
+        line = "%s%s[%s][%s] %s\n" % (timestamp, sep, log.level, log.source, message)
+        try:
+            file = self.get_file(file_name)
+            file.write(line)
+            if file.tell() >= Globals.LOGS_MAX_FILE_BYTES:
+                self.files.pop(file_name).close()
+                Logger.rotate(file_name)
+        except OSError as e:
+            sys.__stderr__.write("Error writing to %s: %s\n" % (file_name, e))
+        return len(line)
+
+    # returns the open handle of a given log file, opening it if necessary
+    def get_file(self, file_name):
+        if file_name not in self.files:
+            if not os.path.exists(Globals.LOGS_DIR):
+                os.makedirs(Globals.LOGS_DIR)
+            self.files[file_name] = open(file_name, "a")
+        return self.files[file_name]
+
+    def flush_files(self):
+        for file in self.files.values():
+            try:
+                file.flush()
+            except OSError as e:
+                sys.__stderr__.write("Error flushing %s: %s\n" % (file.name, e))
+
+    # rotates the log files left behind by a previous run of this process, leaving those of other processes (e.g. the
+    # node agents and API workers sharing LOGS_DIR) alone
+    def rotate_all(self):
+        if os.path.isdir(Globals.LOGS_DIR):
+            for name in os.listdir(Globals.LOGS_DIR):
+                if name.startswith("%s-" % self.name) and name.endswith(".%s" % Globals.LOGS_FILE_TYPE):
+                    Logger.rotate(os.path.join(Globals.LOGS_DIR, name))
+
+    # compresses a given log file into the old logs directory and removes it
+    @staticmethod
+    def rotate(file_name):
+        old_logs_dir = os.path.join(Globals.LOGS_DIR, Globals.LOGS_OLD_NAME)
+        timestamp = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        old_name = os.path.join(old_logs_dir, "%s.%s.gz" % (os.path.basename(file_name), timestamp))
+        try:
+            if not os.path.exists(old_logs_dir):
+                os.makedirs(old_logs_dir)
+            with open(file_name, "rb") as src, gzip.open(old_name, "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(file_name)
+        except OSError as e:
+            sys.__stderr__.write("Error rotating %s: %s\n" % (file_name, e))
 
 
-logger = Logger()
+# the files of each process are named after it (its script by default, see redirect_std_streams)
+logger = Logger(os.path.splitext(os.path.basename(sys.argv[0]))[0] or "python")
+atexit.register(logger.close)
 
 
 class StreamRedirect(object):
@@ -70,14 +200,28 @@ class StreamRedirect(object):
     def __init__(self, source, level):
         self.source = source
         self.level = level
-        self.linebuf = ''
+        self.local = threading.local()
 
+    # buffers writes per thread until a line is complete, so each print becomes a single record
     def write(self, buf):
-        logger.log(self.level, self.source, buf, direct_write=True)
+        linebuf = getattr(self.local, "linebuf", "") + buf
+        if linebuf.endswith("\n"):
+            logger.log(self.level, self.source, linebuf[:-1])
+            linebuf = ""
+        self.local.linebuf = linebuf
 
     def flush(self):
-        pass
-
-
-sys.stdout = StreamRedirect("STDOUT", Globals.LOGS_LEVEL_INFO)
-sys.stderr = StreamRedirect("STDERR", Globals.LOGS_LEVEL_ERROR)
+        linebuf = getattr(self.local, "linebuf", "")
+        if linebuf:
+            logger.log(self.level, self.source, linebuf)
+            self.local.linebuf = ""
+
+
+# redirects stdout and stderr to the logger, so that every print ends up in the log files, named after a given process
+# name if set (e.g. to tell apart the node agents of a host); importing this module has no side effects on the standard
+# streams: only entry points should call this
+def redirect_std_streams(name=None):
+    if name:
+        logger.name = name
+    sys.stdout = StreamRedirect("STDOUT", Globals.LOGS_LEVEL_INFO)
+    sys.stderr = StreamRedirect("STDERR", Globals.LOGS_LEVEL_ERROR)
@@ -1,10 +1,13 @@
+import os
+
 from dotenv import load_dotenv, find_dotenv
 from flask import Flask, request
 from flask_cors import CORS
 
-import utils
+import ingest
+import rpc
+from filestore import file_store
 from globals import Globals
-from manager import Manager
 
 load_dotenv(find_dotenv())
 
@@ -12,43 +15,182 @@ app = Flask(__name__)
 
 CORS(app, resources={r"/api/*": {"origins": "*"}})
 
-manager = Manager()
-
-
-# setup
-def init():
-    utils.clear_dir(Globals.VNC_FILES_DIR)
-    utils.ensure_dir_exists(Globals.VNC_FILES_DIR)
-    manager.start()
+# the pool itself lives in the manager daemon (see daemon.py): this process only parses requests, so it holds no state
+# of its own and can be served by any amount of workers (e.g. "gunicorn -w 8 main:app"), each with its own connections
+client = rpc.RpcClient(Globals.MANAGER_SOCKET_PATH)
 
 
-# teardown
-def terminate():
-    manager.stop()
-    utils.clear_and_remove_dir(Globals.VNC_FILES_DIR)
+# returns which of the given file hashes are already in the file store (and thus do not need to be uploaded again)
+@app.route("/api/files/check", methods=["POST"])
+def files_check():
+    hashes = (request.get_json(silent=True) or {}).get("hashes", [])
+    return {
+               "success": True,
+               "data":
+                   {
+                       "known": [file_hash for file_hash in hashes if file_store.has(file_hash)]
+                   }
+           }, 200
 
 
+# each of the VNC_SUMO_FILES is either uploaded as a file or referenced by the hash of a previous upload, in a form
+# field named "<name>-hash"; the request body is streamed into a staging directory, and an instance is only claimed
+# once every file has been received
+# if no instance is ready, the request waits in a fifo queue: the response is held for up to "wait" seconds (at most
+# QUEUE_LONG_POLL_SECS, the default) and, if the request is still waiting by then, it carries a ticket to be polled
+# the "profile" query parameter picks the kind of instance (see VNC_PROFILES), VNC_DEFAULT_PROFILE by default
 @app.route("/api/vnc/request", methods=["POST"])
 def vnc_request():
     source_ip = request.environ['REMOTE_ADDR']
     source_port = request.environ['REMOTE_PORT']
-    url = manager.request_vnc_instance(source_ip, source_port, request.files)
+    profile = request.args.get("profile", Globals.VNC_DEFAULT_PROFILE)
+    if profile != Globals.VNC_DEFAULT_PROFILE and profile not in Globals.VNC_PROFILES:
+        return {
+                   "success": False,
+                   "error": "Unknown profile %s" % profile,
+                   "data": {"profiles": sorted(set(Globals.VNC_PROFILES) | {Globals.VNC_DEFAULT_PROFILE})}
+               }, 400
+    try:
+        upload = ingest.ingest(request.stream, request.content_type, request.content_length)
+    except ingest.IngestError as e:
+        return {
+                   "success": False,
+                   "error": str(e),
+                   "data": e.data
+               }, e.status
+    try:
+        status = client.call("claim", source_ip=source_ip, source_port=source_port,
+                             staging_dir=os.path.abspath(upload.staging_dir), file_hashes=upload.file_hashes,
+                             wait_secs=get_wait_secs(), profile=profile)
+    except rpc.RpcError as e:
+        upload.discard()
+        return manager_unavailable(e)
+    if status is None:
+        upload.discard()
+        return {
+                   "success": False,
+                   "error": "No VNC instance is available and the waiting queue is full",
+                   "data": {}
+               }, 503, {"Retry-After": "%d" % Globals.QUEUE_LONG_POLL_SECS}
+    return ticket_response(status)
 
+
+# waits (long-polls) for a queued request to be served, for up to "wait" seconds
+@app.route("/api/vnc/ticket/<ticket_id>", methods=["GET"])
+def vnc_ticket(ticket_id):
+    try:
+        status = client.call("poll", ticket_id=ticket_id, wait_secs=get_wait_secs())
+    except rpc.RpcError as e:
+        return manager_unavailable(e)
+    if status is None:
+        return {
+                   "success": False,
+                   "error": "Unknown or expired ticket",
+                   "data": {}
+               }, 404
+    return ticket_response(status)
+
+
+# gives up a queued request, or the instance it was served with if it has not been connected to yet
+@app.route("/api/vnc/ticket/<ticket_id>", methods=["DELETE"])
+def vnc_ticket_release(ticket_id):
+    try:
+        client.call("release", ticket_id=ticket_id)
+    except rpc.RpcError as e:
+        return manager_unavailable(e)
+    return {
+               "success": True,
+               "data": {}
+           }, 200
+
+
+# returns the size of the pool and how many of its instances are in each state
+@app.route("/api/vnc/status", methods=["GET"])
+def vnc_status():
+    try:
+        status = client.call("status")
+    except rpc.RpcError as e:
+        return manager_unavailable(e)
+    return {
+               "success": True,
+               "data": status
+           }, 200
+
+
+# returns the metrics of the manager (counters, latency histograms and gauges) in the Prometheus text format
+@app.route("/api/metrics", methods=["GET"])
+def vnc_metrics():
+    try:
+        text = client.call("metrics")
+    except rpc.RpcError as e:
+        return manager_unavailable(e)
+    return text, 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
+# reports whether requests can be served right away (200) or not (503), while the manager is unreachable or its pool
+# is still warming up without any ready instance, along with the progress of the warm-up
+@app.route("/api/health", methods=["GET"])
+def health():
+    try:
+        health_info = client.call("health")
+    except rpc.RpcError as e:
+        return manager_unavailable(e)
+    return {
+               "success": True,
+               "data": health_info
+           }, 200 if health_info["warm"] or health_info["ready"] else 503
+
+
+# returns the response for the status of a ticket: the instance url, and the resolution of the profile it was
+# assigned, once it is served (200), its position in the queue of its profile and estimated wait while it is waiting
+# (202) or the reason why it failed (410)
+def ticket_response(status):
+    if status["vnc_url"]:
+        return {
+                   "success": True,
+                   "data":
+                       {
+                           "vnc_url": status["vnc_url"],
+                           "vnc_resolution": status["vnc_resolution"],
+                           "profile": status["profile"]
+                       }
+               }, 200
+    if status["error"]:
+        return {
+                   "success": False,
+                   "error": status["error"],
+                   "data": {}
+               }, 410
     return {
                "success": True,
                "data":
                    {
-                       "vnc_url": url,
-                       "vnc_resolution": Globals.VNC_RESOLUTION
+                       "vnc_url": None,
+                       "queued": True,
+                       "ticket": status["ticket"],
+                       "ticket_url": "/api/vnc/ticket/%s" % status["ticket"],
+                       "profile": status["profile"],
+                       "position": status["position"],
+                       "estimated_wait_secs": status["estimated_wait_secs"]
                    }
-           }, 200
+           }, 202
 
 
-if __name__ == '__main__':
+def manager_unavailable(error):
+    return {
+               "success": False,
+               "error": "VNC instance manager is unavailable: %s" % error,
+               "data": {}
+           }, 503
+
+
+# returns how long a request may be held waiting for an instance, from its "wait" query parameter
+def get_wait_secs():
     try:
-        init()
-        app.run(port=5001)
-        terminate()
-    except BaseException as e:
-        print("Error: ", e)
-        terminate()
+        return min(float(request.args.get("wait", Globals.QUEUE_LONG_POLL_SECS)), Globals.QUEUE_LONG_POLL_SECS)
+    except ValueError:
+        return Globals.QUEUE_LONG_POLL_SECS
+
+
+if __name__ == '__main__':
+    app.run(port=5001, threaded=True)
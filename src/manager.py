@@ -1,201 +1,837 @@
 import os
 import random
+import shutil
+import threading
+import time
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime
 
 from apscheduler.schedulers.background import BackgroundScheduler
 
+import journal
+import metrics
+import profiles
+import remote
+import resources
+import scaling
+import tokens
+import utils
+import watcher
 import websockify
 
 from globals import Globals
 from iserver import IServer, State
+from scaling import PoolStats
+from snapshot import HostSnapshot
 import vnc
 
 
 class Manager(IServer):
     def __init__(self):
         self.websockify = websockify.Websockify()
+        self.tokens = tokens.TokenServer()
+        self.watcher = watcher.ConnectionWatcher(self.on_vnc_connected)
+        self.lock = threading.RLock()
         self.pool = {}
+        self.profiles = profiles.load_profiles()
+        self.ready = {name: deque() for name in self.profiles}
+        self.ready_ids = set()
         self.requested = {}
+        self.serving = set()
+        self.serving_since = {}
+        self.tickets = {}
+        self.waiting = OrderedDict()
+        self.last_stats = {name: PoolStats(0, 0, 0, 0, 0) for name in self.profiles}
+        self.scaling = {name: scaling.create_policy(profile) for name, profile in self.profiles.items()}
+        self.resources = resources.ResourceMonitor()
         self.scheduler = BackgroundScheduler()
+        self.executor = ThreadPoolExecutor(max_workers=Globals.PROVISION_WORKERS, thread_name_prefix="Provisioner")
+        self.transfers = ThreadPoolExecutor(max_workers=Globals.PROVISION_WORKERS, thread_name_prefix="Transfer")
+        self.recycler = ThreadPoolExecutor(max_workers=Globals.PROVISION_WORKERS, thread_name_prefix="Recycler")
+        self.recycling = set()
+        self.reclaimed = {"sessions": 0, "cpu_percent": 0, "rss_bytes": 0}
+        self.nodes = [remote.RemoteNode(address) for address in Globals.AGENTS]
+        self.journal = journal.Journal()
         self.last_count = Globals.NA
+        self.started_at = None
+        self.warmup = None
+        self.warmed_up_at = None
         self.is_shutting_down = False
+        metrics.instances.set_function(self.count_states)
+        metrics.waiting.set_function(lambda: len(self.waiting))
 
-    # initialize a pool of VNC instances
+    # initialize a pool of VNC instances in the background (see warm_up), so that requests are accepted, and queued,
+    # right away and each instance can be claimed as soon as it is ready
     def start(self):
         print("Starting VNC instance manager...")
+        self.started_at = time.monotonic()
+        self.tokens.start()
+        self.watcher.start()
+        self.warmup = threading.Thread(target=self.warm_up, name="Warmup", daemon=True)
+        self.warmup.start()
+        print("VNC instance manager started, warming up the pool in the background")
+
+    # adopts the servers (and websockify) left running by a previous manager, starts the health checks and tops the
+    # sub-pool of each profile up to its base size
+    def warm_up(self):
+        state = self.journal.read()
+        self.websockify.adopt(state.get("websockify_pids", []))
         self.websockify.start()
-        for i in range(Globals.POOL_BASE_SIZE):
-            self.create_vnc_instance()
-        self.scheduler.add_job(self.check_state, 'interval', seconds=2)
+        entries = state.get("instances", {})
+        # the nodes are asked for their reports in parallel, as adopting their instances needs them
+        wait([node.request_report() for node in self.nodes])
+        for node in self.nodes:
+            known_ids = [vnc_id for vnc_id, entry in entries.items() if entry.get("node") == node.address]
+            for vnc_id in node.take_unknown_ids(known_ids):
+                self.executor.submit(node.destroy, vnc_id)
+        self.adopt_vnc_instances(entries)
+        if self.is_shutting_down:
+            return
+        self.scheduler.add_job(self.check_state, 'interval', seconds=Globals.HEALTH_CHECK_INTERVAL_SECS,
+                               next_run_time=datetime.now())
         self.scheduler.start()
-        print("VNC instance manager started")
+        for profile in self.profiles.values():
+            for i in range(profile.base_size - self.count_profile_instances(profile)):
+                if self.is_shutting_down:
+                    return
+                self.create_vnc_instance(profile)
+        print("Pool warm-up submitted after %.2f seconds" % (time.monotonic() - self.started_at))
 
-    # terminate the pool of VNC instances
-    def stop(self):
+    # terminate the pool of VNC instances, in parallel and within TEARDOWN_TIMEOUT_SECS, or detach from it, leaving
+    # its servers (and websockify) running for the next manager to adopt, so that their sessions survive a restart
+    def stop(self, detach=False):
         print("Stopping VNC instance manager...")
         self.is_shutting_down = True
-        self.scheduler.shutdown()
-        os.remove(Globals.TOKENS_FILE_DIR)
+        if self.warmup:
+            self.warmup.join(Globals.TEARDOWN_TIMEOUT_SECS)
+        if self.scheduler.running:
+            self.scheduler.shutdown()
+        self.watcher.stop()
+        for node in self.nodes:
+            node.stop()
+        with self.lock:
+            for ticket in self.waiting.values():
+                ticket.fail("VNC instance manager is shutting down")
+            self.waiting.clear()
+        if detach:
+            with self.lock:
+                journal_state = self.get_journal_state()
+            self.journal.write(journal_state)
+            self.websockify.detach()
+            self.tokens.stop()
+            for executor in [self.transfers, self.recycler, self.executor]:
+                executor.shutdown(wait=False, cancel_futures=True)
+            print("VNC instance manager detached from %d instances" % len(self.pool))
+            return
         self.websockify.stop()
-        for vnc_id in list(self.pool):
-            self.destroy_vnc_instance(vnc_id)
+        self.tokens.stop()
+        with self.lock:
+            vnc_instances = list(self.pool.values())
+            self.pool.clear()
+        for executor in [self.transfers, self.recycler, self.executor]:
+            executor.shutdown(wait=False, cancel_futures=True)
+        teardown = ThreadPoolExecutor(max_workers=max(len(vnc_instances), 1), thread_name_prefix="Teardown")
+        futures = [teardown.submit(vnc_instance.stop) for vnc_instance in vnc_instances]
+        not_done = wait(futures, timeout=Globals.TEARDOWN_TIMEOUT_SECS).not_done
+        teardown.shutdown(wait=False)
+        if not_done:
+            print("%d instances did not stop within %d seconds" % (len(not_done), Globals.TEARDOWN_TIMEOUT_SECS))
+        self.journal.clear()
         print("VNC instance manager stopped")
 
-    # starts a new VNC instance and adds it to the pool
-    def create_vnc_instance(self):
-        vnc_instance = vnc.VNC()
-        vnc_instance.start()
-        vnc_id = self.create_unique_id()
-        self.pool[vnc_id] = vnc_instance
+    # adopts the instances recorded in the journal by a previous manager whose servers are still running, and
+    # removes the files left behind by every other instance
+    def adopt_vnc_instances(self, entries):
+        snapshot = HostSnapshot.take()
+        nodes = {node.address: node for node in self.nodes}
+        with self.lock:
+            for vnc_id, entry in entries.items():
+                profile = self.get_profile(entry.get("profile"))
+                if "node" in entry:
+                    node = nodes.get(entry["node"])
+                    vnc_instance = remote.RemoteVNC.adopt(node, vnc_id, entry, profile) if node else None
+                else:
+                    on_dead = (lambda dead_id: lambda: self.on_vnc_dead(dead_id))(vnc_id)
+                    vnc_instance = vnc.VNC.adopt(entry, snapshot, on_dead, profile)
+                if vnc_instance:
+                    self.pool[vnc_id] = vnc_instance
+            kept = ["%d" % vnc_instance.display_index for vnc_instance in self.pool.values()
+                    if isinstance(vnc_instance, vnc.VNC)]
+        utils.ensure_dir_exists(Globals.VNC_FILES_DIR)
+        for name in os.listdir(Globals.VNC_FILES_DIR):
+            if name not in kept:
+                shutil.rmtree(os.path.join(Globals.VNC_FILES_DIR, name), ignore_errors=True)
+        if entries:
+            print("Adopted %d of the %d instances left by the previous manager" % (len(self.pool), len(entries)))
+
+    # adds a new VNC instance of a given profile (VNC_DEFAULT_PROFILE if None) to the pool, in the provisioning
+    # state, and starts it on the provisioning executor
+    # with node agents, the instance is placed on the node with the most free capacity (if none has any, no instance
+    # is created and None is returned)
+    def create_vnc_instance(self, profile=None):
+        profile = profile or self.get_profile(Globals.VNC_DEFAULT_PROFILE)
+        with self.lock:
+            node = self.select_node() if self.nodes else None
+            if self.nodes and node is None:
+                return None
+            vnc_id = self.create_unique_id()
+            if node:
+                vnc_instance = remote.RemoteVNC(node, vnc_id, profile)
+            else:
+                vnc_instance = vnc.VNC(on_dead=lambda: self.on_vnc_dead(vnc_id), profile=profile)
+            self.pool[vnc_id] = vnc_instance
+        self.executor.submit(self.start_vnc_instance, vnc_id, vnc_instance)
         return vnc_id
 
-    # stops an existing VNC instance and removes it from the pool
+    # starts a VNC instance (on the provisioning executor) and reports how long it took to the scaling policy
+    # a local instance is checked right away, so that it can be claimed without waiting for the next health check
+    def start_vnc_instance(self, vnc_id, vnc_instance):
+        started_at = time.monotonic()
+        vnc_instance.start()
+        if vnc_instance.state == State.Dead:
+            return
+        duration_secs = time.monotonic() - started_at
+        metrics.provisioning_seconds.observe(duration_secs)
+        # only the port of the new instance is checked, its pid is found by the next health check
+        listening = isinstance(vnc_instance, vnc.VNC) and vnc_instance.is_listening()
+        with self.lock:
+            self.scaling[vnc_instance.profile.name].record_provisioning(duration_secs)
+            if self.is_shutting_down or self.pool.get(vnc_id) is not vnc_instance:
+                return
+            if listening:
+                vnc_instance.mark_ready()
+            self.index_vnc_instance(vnc_id)
+
+    # removes an existing VNC instance from the pool and stops it on the provisioning executor
     def destroy_vnc_instance(self, vnc_id):
-        if vnc_id in self.requested:
-            self.requested.pop(vnc_id)
-        self.pool.pop(vnc_id).stop()
+        with self.lock:
+            self.requested.pop(vnc_id, None)
+            self.get_watcher(vnc_id).unwatch(vnc_id)
+            self.end_session(vnc_id)
+            self.tokens.remove(vnc_id)
+            vnc_instance = self.pool.pop(vnc_id)
+        self.executor.submit(vnc_instance.stop)
+
+    # updates the ready, requested and serving indexes, as well as the token map, according to the current state of a
+    # given VNC instance
+    def index_vnc_instance(self, vnc_id):
+        with self.lock:
+            vnc_instance = self.pool[vnc_id]
+            state = vnc_instance.state
+            if state == State.Ready:
+                self.tokens.add(vnc_id, vnc_instance.host, vnc_instance.port)
+            else:
+                self.tokens.remove(vnc_id)
+            if state == State.Ready and vnc_id not in self.requested and vnc_id not in self.ready_ids:
+                self.ready[vnc_instance.profile.name].append(vnc_id)
+                self.ready_ids.add(vnc_id)
+                self.serve_waiting_tickets()
+                self.check_warm_up()
+            if state == State.Serving and vnc_id not in self.serving:
+                self.serving.add(vnc_id)
+                self.serving_since[vnc_id] = time.time()
+            elif state != State.Serving:
+                self.end_session(vnc_id)
+
+    # records when the sub-pool of every profile first holds as many instances that are ready or serving as its base
+    # size
+    def check_warm_up(self):
+        with self.lock:
+            if self.warmed_up_at is not None:
+                return
+            counts = {name: 0 for name in self.profiles}
+            for vnc_instance in self.pool.values():
+                if vnc_instance.state in [State.Ready, State.Serving]:
+                    counts[vnc_instance.profile.name] += 1
+            if all(counts[name] >= profile.base_size for name, profile in self.profiles.items()):
+                self.warmed_up_at = time.monotonic()
+                print("Pool warmed up in %.2f seconds" % (self.warmed_up_at - self.started_at))
+
+    # removes a given VNC instance from the serving index, if it is there, and reports the duration of its session
+    def end_session(self, vnc_id):
+        with self.lock:
+            if vnc_id in self.serving:
+                self.serving.remove(vnc_id)
+                started_at = self.serving_since.pop(vnc_id)
+                duration_secs = time.time() - started_at
+                self.scaling[self.pool[vnc_id].profile.name].record_session(duration_secs)
+                metrics.session_seconds.observe(duration_secs)
+                self.record_trace(started_at, duration_secs)
+
+    # atomically claims a ready VNC instance of a given profile, if any, and returns its id
+    # ids in the ready queue that are no longer ready are discarded as they are popped
+    def claim_vnc_instance(self, source_ip, source_port, profile_name):
+        with self.lock:
+            while self.ready[profile_name]:
+                vnc_id = self.pop_ready_vnc_instance(profile_name)
+                if vnc_id in self.pool and self.pool[vnc_id].state == State.Ready and vnc_id not in self.requested:
+                    self.requested[vnc_id] = Request(vnc_id, source_ip, source_port)
+                    return vnc_id
+        return None
+
+    # pops the next id from the ready queue of a given profile: the oldest one or, with node agents, the oldest one on
+    # the node with the most free capacity for new sessions
+    def pop_ready_vnc_instance(self, profile_name):
+        with self.lock:
+            ready = self.ready[profile_name]
+            vnc_id = ready[0]
+            if self.nodes:
+                busy = self.count_node_instances(busy_only=True)
+                vnc_id = max(ready, key=lambda ready_id: self.get_free_capacity(ready_id, busy))
+            ready.remove(vnc_id)
+            self.ready_ids.discard(vnc_id)
+            return vnc_id
+
+    # atomically releases a claimed VNC instance, making it available again if it is still ready
+    def release_vnc_instance(self, vnc_id):
+        with self.lock:
+            self.get_watcher(vnc_id).unwatch(vnc_id)
+            if self.requested.pop(vnc_id, None) and vnc_id in self.pool:
+                self.index_vnc_instance(vnc_id)
+
+    # fast path, called by the connection watcher as soon as a requested instance has an established connection:
+    # marks it as serving and launches SUMO without waiting for the next health check
+    def on_vnc_connected(self, vnc_id, detected_at):
+        with self.lock:
+            if vnc_id not in self.requested or vnc_id not in self.pool:
+                return
+            request = self.requested[vnc_id]
+            vnc_instance = self.pool[vnc_id]
+            vnc_instance.mark_serving()
+            self.release_vnc_instance(vnc_id)
+            vnc_instance.run_command(vnc_instance.profile.sumo_cmd)
+            launched_at = time.monotonic()
+        metrics.connect_seconds.observe(request.seconds_elapsed())
+        print_info = (vnc_id, request.seconds_elapsed(), (launched_at - detected_at) * 1000,
+                      Globals.WATCHER_INTERVAL_SECS * 1000)
+        print("VNC ID = %s connected %.2f seconds after being requested and SUMO was launched %.1f ms after the "
+              "connection was detected (detection interval = %d ms)" % print_info)
 
     def replace_vnc_instance(self, vnc_id):
         if not self.is_shutting_down:
+            profile = self.pool[vnc_id].profile
             self.destroy_vnc_instance(vnc_id)
-            new_vnc_id = self.create_vnc_instance()
-            print("VNC ID = %s has been replaced by VNC ID = %s" % (vnc_id, new_vnc_id))
+            new_vnc_id = self.create_vnc_instance(profile)
+            if new_vnc_id is None:
+                print("VNC ID = %s could not be replaced as no node has free capacity" % vnc_id)
+            else:
+                print("VNC ID = %s has been replaced by VNC ID = %s" % (vnc_id, new_vnc_id))
 
     # used to periodically check the state of the pool and its instances and make the necessary adjustments
-    def check_state(self):
+    def check_state(self, snapshot: HostSnapshot = None):
         if self.is_shutting_down:
             return
+        started_at = time.monotonic()
+        spawned = metrics.subprocesses.get_thread_value()
         count_serving = 0
         count_requested = 0
         count_ready = 0
         count_unavailable = 0
+        count_provisioning = 0
+        count_recycling = 0
+        count_idle = 0
         dead_instances = []
-        changes = [self.websockify.check_state()]
-        for vnc_id in self.pool:
-            changes.append(self.pool[vnc_id].check_state())
-            if vnc_id in self.requested:
-                delta_secs = self.requested[vnc_id].seconds_elapsed()
-                if self.pool[vnc_id].state == State.Serving:
-                    self.requested.pop(vnc_id)
-                    self.pool[vnc_id].run_command(Globals.VNC_SUMO_CMD)
-                    print_info = (vnc_id, self.pool[vnc_id].state)
-                    print("Removed VNC ID = %s from the requested list as its state is now %s" % print_info)
-                if self.pool[vnc_id].state in [State.Unavailable, State.Dead]:
-                    self.requested.pop(vnc_id)
-                    print_info = (vnc_id, self.pool[vnc_id].state)
-                    print("Removed VNC ID = %s from the requested list as its state changed to %s" % print_info)
-                if delta_secs >= Globals.REQUEST_TIMEOUT_SECS:
-                    self.requested.pop(vnc_id)
-                    print_info = (vnc_id, self.pool[vnc_id].state, delta_secs)
-                    print("Removed VNC ID = %s from the requested list as its state is still %s after %d seconds" % print_info)
-            if vnc_id in self.requested:
-                count_requested += 1
-            if self.pool[vnc_id].state == State.Serving:
-                count_serving += 1
-            if self.pool[vnc_id].state == State.Ready:
-                count_ready += 1
-            if self.pool[vnc_id].state == State.Unavailable:
-                count_unavailable += 1
-            if self.pool[vnc_id].state == State.Dead:
-                dead_instances.append(vnc_id)
-            if not self.pool[vnc_id].state == State.Serving:
-                self.pool[vnc_id].stop_command()
-        count_total = count_serving + count_requested
-        if self.last_count != count_total or any(changes):
-            self.last_count = count_total
-            print("Websockify status \t->\t %s" % (self.websockify.describe_state()))
-            print("Pool status:")
+        if snapshot is None:
+            snapshot = HostSnapshot.take()
+        # the nodes report in the background, and the health check goes on with the last report of each one
+        for node in self.nodes:
+            node.request_report()
+            for vnc_id in node.take_unknown_ids(self.get_node_instance_ids(node)):
+                self.executor.submit(node.destroy, vnc_id)
+        with self.lock:
+            roots = {vnc_id: vnc_instance.get_pids() for vnc_id, vnc_instance in self.pool.items()
+                     if isinstance(vnc_instance, vnc.VNC)}
+        usages = self.resources.sample(roots)
+        with self.lock:
+            changes = [self.websockify.check_state(snapshot)]
             for vnc_id in self.pool:
-                print("\tVNC ID = %s \t->\t %s" % (vnc_id, self.pool[vnc_id].describe_state()))
-            print_info = (len(self.pool), count_serving, State.Serving, count_ready, State.Ready, count_requested,
-                          count_unavailable, State.Unavailable, len(dead_instances), State.Dead)
-            print("Pool holds %d instances: %d in %s | %d in %s [%d requested] | %d in %s | %d in %s" % print_info)
-            self.update_vnc_ids()
-        for vnc_id in dead_instances:
-            print("VNC ID = %s has state %s and will be replaced" % (vnc_id, self.pool[vnc_id].state))
+                vnc_instance = self.pool[vnc_id]
+                if vnc_id in usages:
+                    vnc_instance.usage = usages[vnc_id]
+                changes.append(vnc_instance.check_state(snapshot))
+                if vnc_instance.state == State.Recycling and isinstance(vnc_instance, vnc.VNC) and \
+                        vnc_id not in self.recycling:
+                    self.recycling.add(vnc_id)
+                    self.recycler.submit(self.recycle_vnc_instance, vnc_id, vnc_instance)
+                # idle warnings are shown and taken down on the recycler, as they spawn and wait on processes
+                if isinstance(vnc_instance, vnc.VNC) and vnc_instance.has_stale_warning():
+                    self.recycler.submit(vnc_instance.stop_warning)
+                if isinstance(vnc_instance, vnc.VNC) and vnc_instance.check_idle_warning():
+                    self.recycler.submit(vnc_instance.show_warning)
+                if isinstance(vnc_instance, vnc.VNC) and vnc_instance.check_idle():
+                    self.recycler.submit(self.reclaim_vnc_instance, vnc_id, vnc_instance)
+                if vnc_id in self.requested:
+                    delta_secs = self.requested[vnc_id].seconds_elapsed()
+                    if vnc_instance.state == State.Serving:
+                        metrics.connect_seconds.observe(delta_secs)
+                        self.release_vnc_instance(vnc_id)
+                        vnc_instance.run_command(vnc_instance.profile.sumo_cmd)
+                        print_info = (vnc_id, vnc_instance.state)
+                        print("Removed VNC ID = %s from the requested list as its state is now %s" % print_info)
+                    elif vnc_instance.state in [State.Unavailable, State.Dead]:
+                        self.release_vnc_instance(vnc_id)
+                        print_info = (vnc_id, vnc_instance.state)
+                        print("Removed VNC ID = %s from the requested list as its state changed to %s" % print_info)
+                    elif delta_secs >= Globals.REQUEST_TIMEOUT_SECS:
+                        metrics.request_timeouts.inc()
+                        self.release_vnc_instance(vnc_id)
+                        print_info = (vnc_id, vnc_instance.state, delta_secs)
+                        print("Removed VNC ID = %s from the requested list as its state is still %s after %d seconds"
+                              % print_info)
+                self.index_vnc_instance(vnc_id)
+                if vnc_id in self.requested:
+                    count_requested += 1
+                if vnc_instance.state == State.Serving:
+                    count_serving += 1
+                if vnc_instance.state == State.Ready:
+                    count_ready += 1
+                if vnc_instance.state == State.Unavailable:
+                    count_unavailable += 1
+                if vnc_instance.state == State.Provisioning:
+                    count_provisioning += 1
+                if vnc_instance.state == State.Recycling:
+                    count_recycling += 1
+                if self.is_idle(vnc_instance):
+                    count_idle += 1
+                if vnc_instance.state == State.Dead:
+                    dead_instances.append(vnc_id)
+                if vnc_instance.state not in [State.Serving, State.Recycling]:
+                    vnc_instance.stop_command()
+            count_total = count_serving + count_requested
+            if self.last_count != count_total or any(changes):
+                self.last_count = count_total
+                print("Websockify status \t->\t %s" % (self.websockify.describe_state()))
+                print("Host status \t->\t %s" % self.resources.describe_state())
+                for node in self.nodes:
+                    print("Node status \t->\t %s" % node.describe_state())
+                print("Pool status:")
+                for vnc_id in self.pool:
+                    print("\tVNC ID = %s \t->\t %s" % (vnc_id, self.pool[vnc_id].describe_state()))
+                print_info = (len(self.pool), count_serving, State.Serving, count_ready, State.Ready, count_requested,
+                              count_unavailable, State.Unavailable, count_provisioning, State.Provisioning,
+                              count_recycling, State.Recycling, len(dead_instances), State.Dead, len(self.waiting),
+                              count_idle)
+                print("Pool holds %d instances: %d in %s | %d in %s [%d requested] | %d in %s | %d in %s | %d in %s"
+                      " | %d in %s | %d requests waiting | %d idle sessions" % print_info)
+                for name, stats in self.count_profile_stats().items():
+                    print_info = (name, stats.size, stats.serving, stats.ready, stats.waiting,
+                                  self.scaling[name].describe_state())
+                    print("Profile %s holds %d instances: %d serving | %d ready | %d requests waiting (%s)"
+                          % print_info)
+            for vnc_id in dead_instances:
+                print("VNC ID = %s has state %s and will be replaced" % (vnc_id, self.pool[vnc_id].state))
+                self.replace_vnc_instance(vnc_id)
+            self.expire_tickets(time.time())
+            journal_state = self.get_journal_state()
+            # the sub-pool of each profile is sized on its own, by its own policy
+            for name, stats in self.count_profile_stats().items():
+                self.last_stats[name] = stats
+                target_size = self.scaling[name].get_target_size(stats, time.time())
+                if target_size > stats.size:
+                    self.expand_pool_size(target_size - stats.size, self.profiles[name])
+                elif target_size < stats.size:
+                    self.reduce_pool_size(stats.size - target_size, self.profiles[name])
+        # the journal is written (and synced to disk) once the lock is released, so that claims do not wait on it
+        self.journal.write(journal_state)
+        # workers that exited are started again apart from the health check, which does not wait on them to spawn
+        self.executor.submit(self.websockify.restart)
+        metrics.health_check_seconds.observe(time.monotonic() - started_at)
+        metrics.health_check_subprocesses.observe(metrics.subprocesses.get_thread_value() - spawned)
+
+    # recycles an instance whose session has ended (on the recycling executor) and makes it available right away, or
+    # replaces it if it could not be recycled
+    def recycle_vnc_instance(self, vnc_id, vnc_instance):
+        started_at = time.monotonic()
+        recycled = vnc_instance.recycle()
+        with self.lock:
+            self.recycling.discard(vnc_id)
+            if self.pool.get(vnc_id) is not vnc_instance:
+                return
+            if recycled:
+                self.index_vnc_instance(vnc_id)
+                print_info = (vnc_id, (time.monotonic() - started_at) * 1000, vnc_instance.sessions)
+                print("VNC ID = %s was recycled in %.1f ms after %d sessions" % print_info)
+            else:
+                vnc_instance.mark_dead()
+                print("VNC ID = %s has state %s and will be replaced" % (vnc_id, State.Dead))
+                self.replace_vnc_instance(vnc_id)
+
+    # disconnects an idle session (on the recycling executor), whose instance is then recycled as soon as the next
+    # health check finds that its session has ended, and adds the resources it held to the reclaimed capacity
+    def reclaim_vnc_instance(self, vnc_id, vnc_instance):
+        usage = vnc_instance.usage
+        if not vnc_instance.disconnect():
+            print("VNC ID = %s could not be disconnected after being idle" % vnc_id)
+            return
+        metrics.idle_reclaims.inc()
+        with self.lock:
+            self.reclaimed["sessions"] += 1
+            self.reclaimed["cpu_percent"] += usage.cpu_percent
+            self.reclaimed["rss_bytes"] += usage.rss_bytes
+        print("VNC ID = %s was disconnected after being idle for %d seconds" % (vnc_id, Globals.IDLE_TIMEOUT_SECS))
+
+    # checks if the session of an instance has been idle long enough for its user to have been warned
+    @staticmethod
+    def is_idle(vnc_instance) -> bool:
+        return bool(Globals.IDLE_TIMEOUT_SECS) and vnc_instance.state == State.Serving and \
+            vnc_instance.get_idle_secs() >= Globals.IDLE_TIMEOUT_SECS - Globals.IDLE_WARNING_SECS
+
+    # called by the supervisor as soon as the server of a pool instance exits: marks it as dead and replaces it
+    # without waiting for the next health check
+    def on_vnc_dead(self, vnc_id):
+        with self.lock:
+            if vnc_id not in self.pool:
+                return
+            self.pool[vnc_id].mark_dead()
+            print("VNC ID = %s has state %s and will be replaced" % (vnc_id, State.Dead))
             self.replace_vnc_instance(vnc_id)
-        size_changed = False
-        if count_total >= self.get_expansion_threshold():
-            self.expand_pool_size()
-            size_changed = True
-        elif count_total < self.get_reduction_threshold() and len(self.pool) > Globals.POOL_BASE_SIZE:
-            self.reduce_pool_size()
-            size_changed = True
-        if size_changed:
-            if len(self.pool) > Globals.POOL_BASE_SIZE:
-                print("Next reduction at %d serving instances" % self.get_reduction_threshold())
-            print("Next expansion at %d serving instances" % self.get_expansion_threshold())
-
-    # returns the url of an available vnc instance
-    def request_vnc_instance(self, source_ip, source_port, files):
+
+    # queues a request, whose files were received into a staging directory (and hashed), for the next ready instance
+    # of a given profile and returns its ticket, which is served right away if there is a ready instance (and no
+    # earlier request for the same profile waiting); unknown profiles fall back to VNC_DEFAULT_PROFILE
+    # returns None, leaving the staging directory to the caller, if the waiting queue is full
+    def request_vnc_instance(self, source_ip, source_port, staging_dir, file_hashes,
+                             profile_name=Globals.VNC_DEFAULT_PROFILE):
         if self.is_shutting_down:
             return None
-        for vnc_id in self.pool:
-            if self.pool[vnc_id].state == State.Ready and vnc_id not in self.requested:
-                self.requested[vnc_id] = Request(vnc_id, source_ip, source_port)
-                print_info = (vnc_id, source_ip, source_port, Globals.REQUEST_TIMEOUT_SECS, State.Serving)
-                print("VNC ID = %s was requested by %s:%s and will be made available again after %d seconds if its"
-                      " state does not change to %s" % print_info)
-                self.pool[vnc_id].store_files_to_dir(files)
-                return "wss://mobiwise.dei.uc.pt/vnc?token=%s" % vnc_id
-        return None
+        profile = self.get_profile(profile_name)
+        with self.lock:
+            self.scaling[profile.name].record_request(time.time())
+            if len(self.waiting) >= Globals.QUEUE_MAX_SIZE:
+                print_info = (source_ip, source_port, len(self.waiting))
+                print("Request from %s:%s was rejected as %d requests are already waiting" % print_info)
+                metrics.claim_rejections.inc()
+                self.record_trace(time.time())
+                return None
+            ticket = Ticket(self.create_unique_ticket_id(), source_ip, source_port, staging_dir, file_hashes,
+                            profile.name)
+            self.tickets[ticket.id] = ticket
+            self.waiting[ticket.id] = ticket
+            self.serve_waiting_tickets()
+            if ticket.id in self.waiting:
+                metrics.claim_misses.inc()
+                print_info = (source_ip, source_port, ticket.id, len(self.waiting))
+                print("Request from %s:%s was queued with ticket %s at position %d" % print_info)
+        return ticket
 
-    # calculates the amount of serving instances above/at which to expand the pool size by pool_expand_size
-    def get_expansion_threshold(self):
-        return len(self.pool) - (Globals.POOL_EXPAND_SIZE // 2)
+    # hands out the ready instances of each profile to the waiting tickets for that profile, in the order in which
+    # they were queued
+    def serve_waiting_tickets(self):
+        with self.lock:
+            if not self.waiting or not any(self.ready.values()):
+                return
+            for ticket in list(self.waiting.values()):
+                if not self.ready[ticket.profile]:
+                    continue
+                vnc_id = self.claim_vnc_instance(ticket.source_ip, ticket.source_port, ticket.profile)
+                if vnc_id is None:
+                    continue
+                del self.waiting[ticket.id]
+                if isinstance(self.pool[vnc_id], remote.RemoteVNC):
+                    self.transfers.submit(self.assign_vnc_instance, vnc_id, ticket)
+                else:
+                    self.assign_vnc_instance(vnc_id, ticket)
 
-    # calculates the amount of serving instances below which to reduce the pool size by pool_expand_size
-    def get_reduction_threshold(self):
-        return self.get_expansion_threshold() - Globals.POOL_EXPAND_SIZE
+    # moves the files of the request of a given ticket into a claimed instance and serves the ticket with its url
+    # (files are sent to remote instances on the transfer executor, without holding the lock)
+    def assign_vnc_instance(self, vnc_id, ticket):
+        with self.lock:
+            vnc_instance = self.pool.get(vnc_id)
+            print_info = (vnc_id, ticket.source_ip, ticket.source_port, time.time() - ticket.created_at,
+                          Globals.REQUEST_TIMEOUT_SECS, State.Serving)
+            print("VNC ID = %s was requested by %s:%s (after waiting %.2f seconds) and will be made available again "
+                  "after %d seconds if its state does not change to %s" % print_info)
+        try:
+            if vnc_instance is None:
+                raise OSError("VNC ID = %s is no longer in the pool" % vnc_id)
+            vnc_instance.adopt_files_dir(ticket.staging_dir, ticket.file_hashes)
+        except OSError as e:
+            print("Error: ", e)
+            ticket.fail("Could not prepare the files of the request")
+            self.release_vnc_instance(vnc_id)
+            return
+        with self.lock:
+            if vnc_id not in self.requested:
+                ticket.fail("VNC instance was lost while preparing the files of the request")
+                return
+            self.get_watcher(vnc_id).watch(vnc_id, vnc_instance.port)
+            metrics.claim_seconds.observe(time.time() - ticket.created_at)
+            ticket.serve(vnc_id, "wss://mobiwise.dei.uc.pt/vnc?token=%s" % vnc_id)
+
+    # drops the tickets past their deadline: waiting tickets fail, served tickets are simply forgotten
+    def expire_tickets(self, now):
+        with self.lock:
+            for ticket in list(self.tickets.values()):
+                if ticket.deadline > now:
+                    continue
+                del self.tickets[ticket.id]
+                if self.waiting.pop(ticket.id, None):
+                    ticket.fail("Request timed out after waiting %d seconds" % Globals.QUEUE_TIMEOUT_SECS)
+                    self.record_trace(ticket.created_at)
+                    print("Ticket %s timed out after waiting %d seconds" % (ticket.id, Globals.QUEUE_TIMEOUT_SECS))
+
+    # gives up a ticket: a waiting ticket leaves the queue, while the instance of a served ticket is released (unless
+    # its session has already started)
+    def release_ticket(self, ticket_id):
+        with self.lock:
+            ticket = self.tickets.pop(ticket_id, None)
+            if ticket is None:
+                return
+            if self.waiting.pop(ticket_id, None):
+                ticket.fail("Request was cancelled")
+                print("Ticket %s was cancelled while waiting" % ticket_id)
+            elif ticket.vnc_id in self.requested:
+                self.release_vnc_instance(ticket.vnc_id)
+                print("Ticket %s was cancelled and VNC ID = %s was released" % (ticket_id, ticket.vnc_id))
+
+    def get_ticket(self, ticket_id):
+        with self.lock:
+            return self.tickets.get(ticket_id)
 
-    # expand the size of the pool by pool_expand_size
-    def expand_pool_size(self):
+    # returns the status of a given ticket, with its profile (and the resolution of its instance) and, while it is
+    # waiting, its position among the requests waiting for the same profile and its estimated wait
+    def describe_ticket(self, ticket):
+        with self.lock:
+            status = {"ticket": ticket.id, "vnc_url": ticket.vnc_url, "error": ticket.error, "profile": ticket.profile,
+                      "vnc_resolution": self.profiles[ticket.profile].get_resolution()}
+            if ticket.id in self.waiting:
+                queue = [ticket_id for ticket_id, waiting in self.waiting.items() if waiting.profile == ticket.profile]
+                position = queue.index(ticket.id) + 1
+                policy = self.scaling[ticket.profile]
+                status["position"] = position
+                status["estimated_wait_secs"] = round(policy.estimate_wait_secs(position,
+                                                                                self.last_stats[ticket.profile]), 1)
+            return status
+
+    # expand the sub-pool of a given profile (VNC_DEFAULT_PROFILE if None) by a given amount of instances (unless the
+    # host has no headroom for them)
+    def expand_pool_size(self, count=Globals.POOL_EXPAND_SIZE, profile=None):
         if self.is_shutting_down:
             return
-        old_size = len(self.pool)
-        for i in range(Globals.POOL_EXPAND_SIZE):
-            self.create_vnc_instance()
-        new_size = len(self.pool)
-        print("Pool was expanded by %d instances, from %d to %d" % (Globals.POOL_EXPAND_SIZE, old_size, new_size))
-
-    # reduce the size of the pool by pool_expand_size
-    def reduce_pool_size(self):
+        profile = profile or self.get_profile(Globals.VNC_DEFAULT_PROFILE)
+        if not self.nodes and not self.resources.has_headroom():
+            print("Pool of profile %s was not expanded by %d instances as the host has no headroom (%s)" %
+                  (profile.name, count, self.resources.describe_state()))
+            return
+        with self.lock:
+            old_size = self.count_profile_instances(profile)
+            for i in range(count):
+                if self.create_vnc_instance(profile) is None:
+                    break
+            new_size = self.count_profile_instances(profile)
+            if new_size == old_size:
+                print_info = (profile.name, count)
+                print("Pool of profile %s could not be expanded by %d instances as no node has free capacity"
+                      % print_info)
+                return
+            self.scaling[profile.name].record_resize(time.time())
+        print_info = (profile.name, new_size - old_size, old_size, new_size,
+                      self.scaling[profile.name].describe_state())
+        print("Pool of profile %s was expanded by %d instances, from %d to %d (%s)" % print_info)
+
+    # reduce the sub-pool of a given profile (VNC_DEFAULT_PROFILE if None) by a given amount of non-serving
+    # instances, evicting the most used ones first and, among those, the oldest ones
+    def reduce_pool_size(self, count=Globals.POOL_EXPAND_SIZE, profile=None):
         if self.is_shutting_down:
             return
-        non_serving = [vnc_id for vnc_id in self.pool if self.pool[vnc_id].state != State.Serving and
-                       vnc_id not in self.requested]
-        if len(non_serving) >= Globals.POOL_EXPAND_SIZE:
-            old_size = len(self.pool)
-            for i in range(Globals.POOL_EXPAND_SIZE):
-                self.destroy_vnc_instance(non_serving[i])
-            new_size = len(self.pool)
-            print("Pool was reduced by %d instances, from %d to %d" % (Globals.POOL_EXPAND_SIZE, old_size, new_size))
-        else:
-            print_info = (Globals.POOL_EXPAND_SIZE, len(non_serving))
-            print("Pool could not be reduced by %d instances as there are only %d non-serving instances" % print_info)
+        profile = profile or self.get_profile(Globals.VNC_DEFAULT_PROFILE)
+        with self.lock:
+            non_serving = [vnc_id for vnc_id, vnc_instance in self.pool.items() if vnc_instance.profile is profile and
+                           vnc_id not in self.serving and vnc_id not in self.requested]
+            non_serving.sort(key=self.get_eviction_order)
+            if not non_serving:
+                print_info = (profile.name, count)
+                print("Pool of profile %s could not be reduced by %d instances as there are no non-serving instances"
+                      % print_info)
+                return
+            old_size = self.count_profile_instances(profile)
+            for vnc_id in non_serving[:count]:
+                self.destroy_vnc_instance(vnc_id)
+            new_size = self.count_profile_instances(profile)
+            self.scaling[profile.name].record_resize(time.time())
+        print_info = (profile.name, old_size - new_size, old_size, new_size,
+                      self.scaling[profile.name].describe_state())
+        print("Pool of profile %s was reduced by %d instances, from %d to %d (%s)" % print_info)
+
+    # returns the size of the pool and how many of its instances are in each state
+    def get_status(self):
+        with self.lock:
+            return {
+                "size": len(self.pool),
+                "states": self.count_states(),
+                "requested": len(self.requested),
+                "waiting": len(self.waiting),
+                "websockify": self.websockify.state.name,
+                "host": self.resources.describe_state(),
+                "nodes": [node.describe_state() for node in self.nodes],
+                "profiles": self.get_profile_status(),
+                "idle": self.get_idle_status()
+            }
+
+    # returns the settings, size and state of the sub-pool of each profile, along with the state of its policy
+    def get_profile_status(self):
+        with self.lock:
+            return {
+                name: {
+                    "resolution": self.profiles[name].get_resolution(),
+                    "depth": self.profiles[name].depth,
+                    "base_size": self.profiles[name].base_size,
+                    "max_size": self.profiles[name].max_size,
+                    "size": stats.size,
+                    "serving": stats.serving,
+                    "requested": stats.requested,
+                    "ready": stats.ready,
+                    "starting": stats.provisioning,
+                    "waiting": stats.waiting,
+                    "scaling": self.scaling[name].describe_state()
+                } for name, stats in self.count_profile_stats().items()
+            }
+
+    # returns the stats of the sub-pool of each profile, as its policy sees them (recycling instances are about to be
+    # ready again, just like those being provisioned)
+    def count_profile_stats(self):
+        with self.lock:
+            stats = {name: PoolStats(0, 0, 0, 0, 0) for name in self.profiles}
+            for vnc_id, vnc_instance in self.pool.items():
+                profile_stats = stats[vnc_instance.profile.name]
+                profile_stats.size += 1
+                if vnc_instance.state == State.Serving:
+                    profile_stats.serving += 1
+                if vnc_id in self.requested:
+                    profile_stats.requested += 1
+                if vnc_instance.state == State.Ready:
+                    profile_stats.ready += 1
+                if vnc_instance.state in [State.Provisioning, State.Recycling]:
+                    profile_stats.provisioning += 1
+            for ticket in self.waiting.values():
+                stats[ticket.profile].waiting += 1
+            return stats
+
+    # counts the instances of a given profile in the pool
+    def count_profile_instances(self, profile):
+        with self.lock:
+            return sum(1 for vnc_instance in self.pool.values() if vnc_instance.profile is profile)
+
+    # returns the profile with a given name, or VNC_DEFAULT_PROFILE if there is none (e.g. for instances adopted from
+    # a manager with other profiles)
+    def get_profile(self, name):
+        return self.profiles.get(name, self.profiles[Globals.VNC_DEFAULT_PROFILE])
+
+    # returns how many sessions are idle (and about to be disconnected) and the capacity reclaimed so far from idle
+    # sessions, on this host and on every node: the sessions disconnected, and the CPU (in % of one core) and memory
+    # they held when they were
+    def get_idle_status(self):
+        with self.lock:
+            status = {"sessions": sum(1 for vnc_instance in self.pool.values() if self.is_idle(vnc_instance))}
+            for name in self.reclaimed:
+                total = self.reclaimed[name] + sum(node.reclaimed[name] for node in self.nodes)
+                status["reclaimed_%s" % name] = total
+        return status
+
+    # returns how many instances are in each state
+    def count_states(self):
+        with self.lock:
+            states = [vnc_instance.state for vnc_instance in self.pool.values()]
+        return {state.name: states.count(state) for state in State}
+
+    # returns the progress of the warm-up of the pool, which is warm once the sub-pool of every profile has held as many
+    # ready (or serving) instances as its base size; requests are served as soon as any instance of their profile is
+    # ready, and queued until then
+    def get_health(self):
+        with self.lock:
+            states = [vnc_instance.state for vnc_instance in self.pool.values()]
+            ready = [vnc_id for vnc_id, vnc_instance in self.pool.items()
+                     if vnc_instance.state == State.Ready and vnc_id not in self.requested]
+            return {
+                "uptime_secs": time.monotonic() - self.started_at if self.started_at else 0,
+                "warm": self.warmed_up_at is not None,
+                "warm_up_secs": self.warmed_up_at - self.started_at if self.warmed_up_at else None,
+                "target_size": sum(profile.base_size for profile in self.profiles.values()),
+                "size": len(self.pool),
+                "ready": len(ready),
+                "starting": states.count(State.Provisioning) + states.count(State.Unavailable),
+                "waiting": len(self.waiting),
+                "websockify": self.websockify.state.name
+            }
+
+    # returns the state of the pool to record in the journal (instances still being provisioned are left out)
+    def get_journal_state(self):
+        with self.lock:
+            return {
+                "websockify_pids": self.websockify.get_pids(),
+                "instances": {vnc_id: vnc_instance.to_journal() for vnc_id, vnc_instance in self.pool.items()
+                              if vnc_instance.display_index != Globals.NA}
+            }
+
+    # returns the live node with the most free capacity for new instances, or None if every node is full, gone or has
+    # no headroom
+    def select_node(self):
+        with self.lock:
+            counts = self.count_node_instances()
+            free = {node: node.capacity - counts.get(node, 0) for node in self.nodes
+                    if node.is_alive and node.has_headroom}
+            free = {node: capacity for node, capacity in free.items() if capacity > 0}
+            return max(free, key=free.get) if free else None
+
+    # counts the instances (or only the serving and requested ones) on each node
+    def count_node_instances(self, busy_only=False):
+        counts = {}
+        with self.lock:
+            for vnc_id, vnc_instance in self.pool.items():
+                if not isinstance(vnc_instance, remote.RemoteVNC):
+                    continue
+                if not busy_only or vnc_id in self.serving or vnc_id in self.requested:
+                    counts[vnc_instance.node] = counts.get(vnc_instance.node, 0) + 1
+        return counts
+
+    # returns how many more sessions the node of a given instance can take, given the amount of busy instances per node
+    def get_free_capacity(self, vnc_id, busy):
+        vnc_instance = self.pool.get(vnc_id)
+        if not isinstance(vnc_instance, remote.RemoteVNC):
+            return -1
+        return vnc_instance.node.capacity - busy.get(vnc_instance.node, 0)
+
+    def get_node_instance_ids(self, node):
+        with self.lock:
+            return [vnc_id for vnc_id, vnc_instance in self.pool.items()
+                    if isinstance(vnc_instance, remote.RemoteVNC) and vnc_instance.node is node]
+
+    # returns the sort key of a given instance among those to evict: first by sessions served (descending), then by
+    # age (descending, instances still being provisioned last)
+    def get_eviction_order(self, vnc_id):
+        vnc_instance = self.pool[vnc_id]
+        started_at = vnc_instance.started_at if vnc_instance.started_at is not None else float("inf")
+        return -vnc_instance.sessions, started_at
+
+    # returns what watches for the connection to a given instance: the node agent running it, or the local watcher
+    def get_watcher(self, vnc_id):
+        vnc_instance = self.pool.get(vnc_id)
+        if isinstance(vnc_instance, remote.RemoteVNC):
+            return vnc_instance.node
+        return self.watcher
+
+    # appends a request (and the duration of its session, if it had one) to the trace file, if enabled
+    def record_trace(self, timestamp, duration_secs=None):
+        if not Globals.SCALING_TRACE_PATH:
+            return
+        duration = "%.3f" % duration_secs if duration_secs is not None else ""
+        with open(Globals.SCALING_TRACE_PATH, "a") as f:
+            f.write("%.3f,%s\n" % (timestamp, duration))
 
     # creates a random, but unique, id for a given pool instance which is now serving
     def create_unique_id(self):
-        hash = None
-        unique = False
-        while not unique:
+        hash = "%x" % random.getrandbits(64)
+        while hash in self.pool:
             hash = "%x" % random.getrandbits(64)
-            unique = True
-            for vnc_id in self.pool:
-                if vnc_id == hash:
-                    unique = False
-                    break
         return hash
 
-    def update_vnc_ids(self):
-        if self.is_shutting_down:
-            return
-        path = Globals.TOKENS_FILE_DIR
-        print("Updating VNC tokens file %s" % path)
-        with open(path, "w") as f:
-            for vnc_id in self.pool:
-                if self.pool[vnc_id].state == State.Ready:
-                    f.write("%s: localhost:%d\n" % (vnc_id, self.pool[vnc_id].port))
+    # creates a random, but unique, id for a ticket
+    def create_unique_ticket_id(self):
+        hash = "%x" % random.getrandbits(64)
+        while hash in self.tickets:
+            hash = "%x" % random.getrandbits(64)
+        return hash
 
 
 class Request:
@@ -207,3 +843,41 @@ class Request:
 
     def seconds_elapsed(self):
         return (datetime.now() - self.timestamp).total_seconds()
+
+
+class Ticket:
+    """
+    A request waiting in the queue for an instance. It is served (or fails) exactly once, which wakes up anyone
+    waiting on it. Tickets expire QUEUE_TIMEOUT_SECS after being queued or, once served, REQUEST_TIMEOUT_SECS after
+    that, as by then the instance is either serving or has been made available again.
+    """
+
+    def __init__(self, ticket_id, source_ip, source_port, staging_dir, file_hashes, profile):
+        self.id = ticket_id
+        self.source_ip = source_ip
+        self.source_port = source_port
+        self.staging_dir = staging_dir
+        self.file_hashes = file_hashes
+        self.profile = profile
+        self.created_at = time.time()
+        self.deadline = self.created_at + Globals.QUEUE_TIMEOUT_SECS
+        self.vnc_id = None
+        self.vnc_url = None
+        self.error = None
+        self.done = threading.Event()
+
+    def serve(self, vnc_id, vnc_url):
+        self.vnc_id = vnc_id
+        self.vnc_url = vnc_url
+        self.deadline = time.time() + Globals.REQUEST_TIMEOUT_SECS
+        self.done.set()
+
+    # fails this ticket, removing the staging directory with the files of its request
+    def fail(self, error):
+        self.error = error
+        shutil.rmtree(self.staging_dir, ignore_errors=True)
+        self.done.set()
+
+    # blocks until this ticket is served or fails, for at most a given amount of seconds (up to QUEUE_LONG_POLL_SECS)
+    def wait(self, wait_secs):
+        return self.done.wait(max(0, min(wait_secs, Globals.QUEUE_LONG_POLL_SECS)))
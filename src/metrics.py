@@ -0,0 +1,153 @@
+import threading
+from bisect import bisect_left
+
+# histogram buckets (upper bounds) for latencies, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# histogram buckets for session durations, in seconds
+SESSION_BUCKETS = (10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200, 14400)
+# histogram buckets for small amounts (e.g. of subprocesses)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+
+class Counter:
+    """
+    Counter that also keeps what each thread has counted, so that a thread can tell its own increments (e.g. the
+    subprocesses spawned by a health check) from those made concurrently by other threads.
+    """
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.value = 0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+        self.local.value = getattr(self.local, "value", 0) + amount
+
+    # returns the amount counted so far by the calling thread
+    def get_thread_value(self):
+        return getattr(self.local, "value", 0)
+
+    def render(self):
+        return ["%s %s" % (self.name, format_value(self.value))]
+
+
+class Histogram:
+    """
+    Counts observations into cumulative buckets, as Prometheus histograms do. Observing a value costs a binary search
+    and a few additions under a lock; the cumulative counts are only computed when the histogram is rendered.
+    """
+
+    def __init__(self, name, description, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def render(self):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            lines.append("%s_bucket{le=\"%s\"} %d" % (self.name, format_value(bound), cumulative))
+        cumulative += counts[-1]
+        lines.append("%s_bucket{le=\"+Inf\"} %d" % (self.name, cumulative))
+        lines.append("%s_sum %s" % (self.name, format_value(total)))
+        lines.append("%s_count %d" % (self.name, cumulative))
+        return lines
+
+
+class Gauge:
+    """
+    Gauge whose values are read from a function when it is rendered, so that keeping it up to date costs nothing.
+    The function returns either a single value or, if the gauge has a label, a dict of values by label value.
+    """
+
+    def __init__(self, name, description, label=None):
+        self.name = name
+        self.description = description
+        self.label = label
+        self.function = None
+
+    def set_function(self, function):
+        self.function = function
+
+    def render(self):
+        if not self.function:
+            return []
+        values = self.function()
+        if not self.label:
+            return ["%s %s" % (self.name, format_value(values))]
+        return ["%s{%s=\"%s\"} %s" % (self.name, self.label, key, format_value(value)) for key, value in values.items()]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, description) -> Counter:
+        return self.register(Counter(name, description))
+
+    def histogram(self, name, description, buckets=LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, description, buckets))
+
+    def gauge(self, name, description, label=None) -> Gauge:
+        return self.register(Gauge(name, description, label))
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    # renders every metric in the Prometheus text exposition format
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            kind = type(metric).__name__.lower()
+            lines.append("# HELP %s %s" % (metric.name, metric.description))
+            lines.append("# TYPE %s %s" % (metric.name, kind))
+            try:
+                lines.extend(metric.render())
+            except BaseException as e:
+                print("Error: ", e)
+        return "\n".join(lines) + "\n"
+
+
+def format_value(value):
+    if isinstance(value, float) and not value.is_integer():
+        return repr(value)
+    return "%d" % value
+
+
+registry = Registry()
+
+claim_seconds = registry.histogram("vnc_claim_seconds", "Time from a request being queued to it being served")
+claim_misses = registry.counter("vnc_claim_misses_total", "Requests that found no ready instance and were queued")
+claim_rejections = registry.counter("vnc_claim_rejections_total", "Requests rejected as the waiting queue was full")
+request_timeouts = registry.counter("vnc_request_timeouts_total",
+                                    "Claimed instances made available again as they were not connected to in time")
+connect_seconds = registry.histogram("vnc_connect_seconds", "Time from an instance being claimed to it serving")
+session_seconds = registry.histogram("vnc_session_seconds", "Duration of the sessions of the instances",
+                                     SESSION_BUCKETS)
+provisioning_seconds = registry.histogram("vnc_provisioning_seconds", "Time taken to start an instance")
+health_check_seconds = registry.histogram("vnc_health_check_seconds", "Duration of the health checks")
+health_check_subprocesses = registry.histogram("vnc_health_check_subprocesses",
+                                               "Subprocesses spawned by each health check itself", COUNT_BUCKETS)
+idle_reclaims = registry.counter("vnc_idle_reclaims_total",
+                                 "Idle sessions disconnected for their instances to be reclaimed")
+subprocesses = registry.counter("vnc_subprocesses_total", "Subprocesses spawned by the manager")
+instances = registry.gauge("vnc_instances", "Instances in the pool in each state", label="state")
+waiting = registry.gauge("vnc_waiting_requests", "Requests waiting in the queue for an instance")
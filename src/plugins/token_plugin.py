@@ -0,0 +1,29 @@
+import socket
+
+# websockify imports this module on its own, with only this directory on its path, so it must not depend on the rest
+# of the code base (whose websockify.py would also shadow the websockify package)
+LOOKUP_TIMEOUT_SECS = 2
+
+
+class TokenPlugin:
+    """
+    Websockify token plugin (--token-plugin token_plugin.TokenPlugin --token-source <socket path>) that resolves tokens
+    by querying the manager's TokenServer instead of reading a tokens file.
+    """
+
+    def __init__(self, src):
+        self.source = src
+
+    def lookup(self, token):
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.settimeout(LOOKUP_TIMEOUT_SECS)
+                sock.connect(self.source)
+                sock.sendall(("%s\n" % token).encode())
+                target = sock.makefile().readline().strip()
+        except OSError as e:
+            print("Error: ", e)
+            return None
+        if not target:
+            return None
+        return target.rsplit(":", 1)
@@ -0,0 +1,56 @@
+from globals import Globals
+
+
+class Profile:
+    """
+    Named kind of instance (see VNC_PROFILES): the geometry and colour depth of its VNC server, the SUMO command run
+    on it, and the base size, maximum size and pre-warm schedule of its sub-pool. Smaller, shallower framebuffers cost
+    less memory on the host and less bandwidth per frame, so small-screen clients get their own sub-pool.
+    """
+
+    def __init__(self, name, width, height, depth, sumo_cmd, base_size, max_size, prewarm_schedule):
+        self.name = name
+        self.width = width
+        self.height = height
+        self.depth = depth
+        self.sumo_cmd = sumo_cmd
+        self.base_size = base_size
+        self.max_size = max_size
+        self.prewarm_schedule = prewarm_schedule
+
+    def get_resolution(self):
+        return {"width": self.width, "height": self.height}
+
+    def describe(self) -> str:
+        info = (self.name, self.width, self.height, self.depth, self.base_size, self.max_size)
+        return "Profile = %s | Geometry = %dx%d | Depth = %d | Sub-pool = %d to %d instances" % info
+
+
+# builds the profiles from VNC_PROFILES (which always holds VNC_DEFAULT_PROFILE) and returns them by name
+# they are built when needed, rather than on import, so that the settings they default to can be overridden first
+def load_profiles():
+    default_settings = Globals.VNC_PROFILES.get(Globals.VNC_DEFAULT_PROFILE, {})
+    width = default_settings.get("width", Globals.VNC_RESOLUTION["width"])
+    height = default_settings.get("height", Globals.VNC_RESOLUTION["height"])
+    default = Profile(Globals.VNC_DEFAULT_PROFILE, width, height,
+                      default_settings.get("depth", Globals.VNC_DEPTH),
+                      default_settings.get("sumo_cmd", get_sumo_cmd(width, height)),
+                      default_settings.get("base_size", Globals.POOL_BASE_SIZE),
+                      default_settings.get("max_size", Globals.POOL_MAX_SIZE),
+                      default_settings.get("prewarm_schedule", Globals.SCALING_PREWARM_SCHEDULE))
+    profiles = {default.name: default}
+    for name, settings in Globals.VNC_PROFILES.items():
+        if name == default.name:
+            continue
+        width = settings.get("width", default.width)
+        height = settings.get("height", default.height)
+        profiles[name] = Profile(name, width, height, settings.get("depth", default.depth),
+                                 settings.get("sumo_cmd", get_sumo_cmd(width, height)),
+                                 settings.get("base_size", 0), settings.get("max_size", default.max_size),
+                                 settings.get("prewarm_schedule", []))
+    return profiles
+
+
+# returns the SUMO command of a profile that does not set its own: VNC_SUMO_BASE_CMD, with a window of a given size
+def get_sumo_cmd(width, height):
+    return "%s --window-size %d,%d" % (Globals.VNC_SUMO_BASE_CMD, width, height)
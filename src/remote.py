@@ -0,0 +1,241 @@
+import base64
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import resources
+import rpc
+from globals import Globals
+from iserver import IServer, State
+from snapshot import HostSnapshot
+
+
+class RemoteNode:
+    """
+    Client of a node agent (see agent.py), through which the manager runs instances on another host (or on the same
+    host, with another range of displays). The agent is asked for a report of its capacity and the state of its
+    instances on every health check, on a thread of its own, and the health check uses the last report that arrived,
+    so that slow or unreachable agents do not hold it up. Once it misses AGENT_MAX_MISSED_REPORTS reports in a row it
+    is considered gone, so its instances are seen as dead (and replaced on other nodes) and no instances are placed on
+    it until it reports again. A node also stands in for the connection watcher of its instances, as they are watched
+    by the agent itself; as the manager watches and unwatches instances under its lock, those calls are made to the
+    agent in order on a thread of their own.
+    """
+
+    def __init__(self, address):
+        self.address = address
+        host, port = address.rsplit(":", 1)
+        self.host = host
+        self.client = rpc.RpcClient((host, int(port)), token=Globals.AGENT_TOKEN)
+        self.report_client = rpc.RpcClient((host, int(port)), timeout=Globals.AGENT_TIMEOUT_SECS,
+                                           token=Globals.AGENT_TOKEN)
+        self.watch_calls = ThreadPoolExecutor(max_workers=1, thread_name_prefix="NodeWatcher")
+        self.report_calls = ThreadPoolExecutor(max_workers=1, thread_name_prefix="NodeReporter")
+        self.pending_report = None
+        self.capacity = 0
+        self.load = 0
+        self.has_headroom = False
+        self.reclaimed = {"sessions": 0, "cpu_percent": 0, "rss_bytes": 0}
+        # when the last report was requested, along with the instances it holds, replaced as a whole by each report
+        self.last_report = (None, {})
+        self.has_new_report = False
+        self.missed_reports = 0
+        self.is_alive = False
+
+    # asks the agent for a new report on the reporting thread of this node, unless the last request is still pending,
+    # and returns the future of that request
+    def request_report(self):
+        if self.pending_report is None or self.pending_report.done():
+            self.pending_report = self.report_calls.submit(self.refresh)
+        return self.pending_report
+
+    # fetches a new report from the agent
+    def refresh(self):
+        requested_at = time.monotonic()
+        try:
+            report = self.report_client.call("report")
+        except rpc.RpcError as e:
+            self.missed_reports += 1
+            if self.is_alive and self.missed_reports >= Globals.AGENT_MAX_MISSED_REPORTS:
+                self.is_alive = False
+                print("Node agent at %s is gone after missing %d reports: %s" % (self.address, self.missed_reports, e))
+            return
+        if not self.is_alive:
+            print("Node agent at %s is available with capacity for %d instances" % (self.address, report["capacity"]))
+        self.is_alive = True
+        self.missed_reports = 0
+        self.capacity = report["capacity"]
+        self.load = report["load"]
+        self.has_headroom = report["headroom"]
+        self.reclaimed = report["reclaimed"]
+        self.last_report = (requested_at, report["instances"])
+        self.has_new_report = True
+
+    # returns the instances in the last report of the agent, by id
+    def get_instances(self):
+        return self.last_report[1]
+
+    # returns the ids of the instances in the last report that the manager does not know of (e.g. those left behind
+    # while the agent was unreachable), once per report, for the caller to destroy them apart from the health check
+    def take_unknown_ids(self, known_ids):
+        if not self.has_new_report:
+            return []
+        self.has_new_report = False
+        unknown_ids = set(self.get_instances()) - set(known_ids)
+        for vnc_id in unknown_ids:
+            print("VNC ID = %s is unknown and will be destroyed on node %s" % (vnc_id, self.address))
+        return list(unknown_ids)
+
+    # destroys an instance on the agent (if it is gone, the instance is destroyed once it reports again, as unknown)
+    def destroy(self, vnc_id):
+        if not self.is_alive:
+            return
+        try:
+            self.client.call("destroy", vnc_id=vnc_id)
+        except rpc.RpcError as e:
+            print("Error: ", e)
+
+    # asks the agent to launch SUMO on a given instance as soon as it is connected to (without waiting for the call)
+    def watch(self, vnc_id, port):
+        self.watch_calls.submit(self.call_watcher, "watch", vnc_id)
+
+    def unwatch(self, vnc_id):
+        self.watch_calls.submit(self.call_watcher, "unwatch", vnc_id)
+
+    # calls the watch or unwatch operation of the agent for a given instance
+    def call_watcher(self, op, vnc_id):
+        if self.is_alive:
+            try:
+                self.report_client.call(op, vnc_id=vnc_id)
+            except rpc.RpcError as e:
+                print("Error: ", e)
+
+    def stop(self):
+        self.watch_calls.shutdown(wait=False, cancel_futures=True)
+        self.report_calls.shutdown(wait=False, cancel_futures=True)
+
+    def describe_state(self) -> str:
+        info = (self.address, "Alive" if self.is_alive else "Gone", len(self.get_instances()), self.capacity, self.load,
+                "Yes" if self.has_headroom else "No")
+        return "Node = %s | %s | Instances = %d of %d | Load = %.2f | Headroom = %s" % info
+
+
+class RemoteVNC(IServer):
+    """
+    Stand-in for a VNC instance run by a node agent, with the same interface as VNC. Its state is taken from the last
+    report of its node, and SUMO is launched, stopped and recycled by the agent itself.
+    """
+
+    def __init__(self, node: RemoteNode, vnc_id, profile):
+        self.node = node
+        self.vnc_id = vnc_id
+        self.profile = profile
+        self.host = node.host
+        self.display_index = Globals.NA
+        self.port = Globals.NA
+        self.state = State.Provisioning
+        self.started_at = None
+        self.sessions = 0
+        self.usage = resources.Usage()
+        self.idle_secs = 0
+
+    # starts the instance on its node (blocks until the agent has spawned the server)
+    def start(self):
+        try:
+            result = self.node.client.call("create", vnc_id=self.vnc_id, profile=self.profile.name)
+        except rpc.RpcError as e:
+            print("Error: ", e)
+            self.state = State.Dead
+            return
+        self.display_index = result["display_index"]
+        self.port = result["port"]
+        self.started_at = time.monotonic()
+        self.state = State[result["state"]]
+
+    def stop(self):
+        self.state = State.Dead
+        self.node.destroy(self.vnc_id)
+
+    # updates the state of this instance from the last report of its node (instances missing from a report requested
+    # after they were started, and those of nodes that are gone, are dead)
+    def check_state(self, snapshot: HostSnapshot) -> bool:
+        if self.state == State.Provisioning:
+            return False
+        old_state = self.state
+        reported_at, instances = self.node.last_report
+        if not self.node.is_alive:
+            self.state = State.Dead
+        elif self.vnc_id in instances:
+            self.port = instances[self.vnc_id]["port"]
+            self.state = State[instances[self.vnc_id]["state"]]
+            self.usage = resources.Usage(**instances[self.vnc_id]["usage"])
+            self.sessions = instances[self.vnc_id]["sessions"]
+            self.idle_secs = instances[self.vnc_id]["idle_secs"]
+        elif reported_at is not None and reported_at > self.started_at:
+            self.state = State.Dead
+        if old_state != self.state:
+            print_info = (self.display_index, self.node.address, old_state, self.state)
+            print("Updated state of VNC server at index %d on node %s from %s to %s" % print_info)
+            return True
+        return False
+
+    # idle sessions are warned and disconnected by the agent (see VNC.check_idle)
+    def get_idle_secs(self):
+        return self.idle_secs if self.state == State.Serving else 0
+
+    # SUMO is launched by the agent as soon as it detects the connection (see RemoteNode.watch)
+    def run_command(self, command):
+        pass
+
+    # SUMO is stopped by the agent once the instance is no longer serving
+    def stop_command(self):
+        pass
+
+    # returns what a restarted manager needs to adopt this instance (see adopt)
+    def to_journal(self):
+        return {"node": self.node.address, "display_index": self.display_index, "port": self.port,
+                "sessions": self.sessions, "profile": self.profile.name}
+
+    # rebuilds an instance of a given profile from its journal entry if its node still runs it, or returns None
+    # otherwise
+    @staticmethod
+    def adopt(node: RemoteNode, vnc_id, entry, profile):
+        if not node.is_alive or vnc_id not in node.get_instances():
+            return None
+        vnc_instance = RemoteVNC(node, vnc_id, profile)
+        vnc_instance.display_index = entry["display_index"]
+        vnc_instance.port = entry["port"]
+        vnc_instance.sessions = entry["sessions"]
+        vnc_instance.started_at = time.monotonic()
+        vnc_instance.state = State.Unavailable
+        print("Adopted VNC ID = %s on node %s" % (vnc_id, node.address))
+        return vnc_instance
+
+    def mark_serving(self):
+        self.state = State.Serving
+
+    def mark_dead(self):
+        self.state = State.Dead
+
+    def describe_state(self) -> str:
+        info = (self.node.address, self.display_index, self.profile.name, self.port, self.state, self.get_idle_secs(),
+                self.usage.describe())
+        return "Node = %s | Display index = %d | Profile = %s | Port = %d | State = %s | Idle = %ds | %s" % info
+
+    # sends the files of a request to the node, skipping those its file store already holds, and has them moved into
+    # place as the directory of this instance
+    def adopt_files_dir(self, staging_dir, file_hashes=None):
+        try:
+            missing = self.node.client.call("missing_files", file_hashes=list(file_hashes.values()))
+            for name, file_hash in file_hashes.items():
+                if file_hash in missing:
+                    with open(os.path.join(staging_dir, "%s.xml" % name), "rb") as f:
+                        data = base64.b64encode(f.read()).decode()
+                    self.node.client.call("put_file", file_hash=file_hash, data=data)
+                    missing.remove(file_hash)
+            self.node.client.call("adopt_files", vnc_id=self.vnc_id, file_hashes=file_hashes)
+        except rpc.RpcError as e:
+            raise OSError("Could not send files to node %s: %s" % (self.node.address, e))
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
@@ -0,0 +1,118 @@
+import os
+import time
+
+import psutil
+
+from globals import Globals
+
+
+class Usage:
+    """
+    Resource usage of the process tree of an instance: CPU (in % of one core), resident memory and the bytes read and
+    written since its processes started.
+    """
+
+    def __init__(self, cpu_percent=0, rss_bytes=0, read_bytes=0, write_bytes=0):
+        self.cpu_percent = cpu_percent
+        self.rss_bytes = rss_bytes
+        self.read_bytes = read_bytes
+        self.write_bytes = write_bytes
+
+    def to_dict(self):
+        return {"cpu_percent": self.cpu_percent, "rss_bytes": self.rss_bytes, "read_bytes": self.read_bytes,
+                "write_bytes": self.write_bytes}
+
+    def describe(self) -> str:
+        info = (self.cpu_percent, self.rss_bytes / 2 ** 20, self.read_bytes / 2 ** 20, self.write_bytes / 2 ** 20)
+        return "CPU = %.1f%% | RSS = %.0f MB | I/O = %.1f MB read, %.1f MB written" % info
+
+
+class ResourceMonitor:
+    """
+    Samples the resource usage of the host, and of the process tree of each instance, in a single pass over the
+    process table per health check. The CPU usage of a process is measured between two consecutive samples, so it is
+    only known from its second sample onwards. The host has headroom for more instances while both its CPU and memory
+    usage are under RESOURCES_MAX_CPU_PERCENT and RESOURCES_MAX_MEMORY_PERCENT.
+    """
+
+    def __init__(self):
+        self.cpu_times = {}
+        self.sampled_at = None
+        self.cpu_percent = 0
+        self.memory_percent = 0
+
+    # samples the host and returns the usage of each instance (by id), given the pids at the root of its process trees
+    def sample(self, roots: dict) -> dict:
+        now = time.monotonic()
+        elapsed = now - self.sampled_at if self.sampled_at else 0
+        self.sampled_at = now
+        self.cpu_percent = psutil.cpu_percent(interval=None)
+        self.memory_percent = psutil.virtual_memory().percent
+        processes = {}
+        children = {}
+        for process in psutil.process_iter(["ppid", "cpu_times", "memory_info", "io_counters"]):
+            processes[process.pid] = process.info
+            children.setdefault(process.info["ppid"], []).append(process.pid)
+        cpu_times = {}
+        usages = {}
+        for vnc_id, pids in roots.items():
+            usage = Usage()
+            pending = [pid for pid in pids if pid in processes]
+            while pending:
+                pid = pending.pop()
+                pending.extend(children.get(pid, []))
+                info = processes[pid]
+                if info["cpu_times"]:
+                    cpu_times[pid] = info["cpu_times"].user + info["cpu_times"].system
+                    if elapsed and pid in self.cpu_times:
+                        usage.cpu_percent += max(cpu_times[pid] - self.cpu_times[pid], 0) / elapsed * 100
+                if info["memory_info"]:
+                    usage.rss_bytes += info["memory_info"].rss
+                if info["io_counters"]:
+                    usage.read_bytes += info["io_counters"].read_bytes
+                    usage.write_bytes += info["io_counters"].write_bytes
+            usages[vnc_id] = usage
+        self.cpu_times = cpu_times
+        return usages
+
+    def has_headroom(self) -> bool:
+        return self.cpu_percent < Globals.RESOURCES_MAX_CPU_PERCENT and \
+            self.memory_percent < Globals.RESOURCES_MAX_MEMORY_PERCENT
+
+    def describe_state(self) -> str:
+        info = (self.cpu_percent, self.memory_percent, "Yes" if self.has_headroom() else "No")
+        return "CPU = %.1f%% | Memory = %.1f%% | Headroom = %s" % info
+
+
+# applies the optional per-session limits to a newly launched process: a nice value and, with cgroups v2, a cgroup of
+# its own (with CPU and memory limits) under SESSION_CGROUP_DIR, which its children inherit
+def limit_session(pid, name):
+    if Globals.SESSION_NICE is not None:
+        try:
+            psutil.Process(pid).nice(Globals.SESSION_NICE)
+        except psutil.Error as e:
+            print("Error: ", e)
+    if not Globals.SESSION_CGROUP_DIR:
+        return
+    path = os.path.join(Globals.SESSION_CGROUP_DIR, name)
+    try:
+        os.makedirs(path, exist_ok=True)
+        if Globals.SESSION_CPU_MAX_PERCENT:
+            with open(os.path.join(path, "cpu.max"), "w") as f:
+                f.write("%d 100000" % (Globals.SESSION_CPU_MAX_PERCENT * 1000))
+        if Globals.SESSION_MEMORY_MAX_BYTES:
+            with open(os.path.join(path, "memory.max"), "w") as f:
+                f.write("%d" % Globals.SESSION_MEMORY_MAX_BYTES)
+        with open(os.path.join(path, "cgroup.procs"), "w") as f:
+            f.write("%d" % pid)
+    except OSError as e:
+        print("Error: ", e)
+
+
+# removes the cgroup of a session, if any (which only succeeds once its processes have exited)
+def release_session(name):
+    if Globals.SESSION_CGROUP_DIR:
+        try:
+            os.rmdir(os.path.join(Globals.SESSION_CGROUP_DIR, name))
+        except OSError:
+            pass
@@ -0,0 +1,180 @@
+import hmac
+import json
+import os
+import queue
+import socket
+import socketserver
+import struct
+import threading
+
+from globals import Globals
+
+# every message is a JSON object prefixed by its length, as a 4-byte big-endian unsigned integer
+HEADER = struct.Struct(">I")
+
+
+class RpcError(Exception):
+    pass
+
+
+# sends a message through a socket
+def send_message(sock, message):
+    payload = json.dumps(message, separators=(",", ":")).encode()
+    sock.sendall(HEADER.pack(len(payload)) + payload)
+
+
+# receives a message from a socket, returning None if the connection was closed
+def receive_message(stream):
+    header = stream.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return None
+    (length,) = HEADER.unpack(header)
+    if length > Globals.RPC_MAX_MESSAGE_BYTES:
+        raise RpcError("Message of %d bytes is too large" % length)
+    payload = stream.read(length)
+    if len(payload) < length:
+        return None
+    return json.loads(payload)
+
+
+class RpcServer:
+    """
+    Serves a set of operations over a Unix socket (if the address is a path) or a TCP socket (if it is a (host, port)
+    tuple). Each request is a message {"op": <name>, "args": {...}} answered by {"ok": true, "result": ...} or
+    {"ok": false, "error": <message>}, and a connection can carry any amount of requests, one after the other. If the
+    server is given a token, every request must carry the same token (as its "token") to be served.
+    """
+
+    def __init__(self, address, ops: dict, token=None):
+        self.address = address
+        self.ops = ops
+        self.token = token
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        handler = self.make_handler()
+        if isinstance(self.address, str):
+            if os.path.exists(self.address):
+                os.remove(self.address)
+            self.server = socketserver.ThreadingUnixStreamServer(self.address, handler)
+        else:
+            socketserver.ThreadingTCPServer.allow_reuse_address = True
+            self.server = socketserver.ThreadingTCPServer(self.address, handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name="RpcServer", daemon=True)
+        self.thread.start()
+        print("RPC server listening on %s" % (self.address,))
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)
+        print("RPC server stopped")
+
+    # runs a given operation and returns the response to send back
+    def dispatch(self, request):
+        if self.token and not (isinstance(request, dict) and isinstance(request.get("token"), str) and
+                               hmac.compare_digest(request["token"].encode(), self.token.encode())):
+            return {"ok": False, "error": "Unauthorized"}
+        op = self.ops.get(request.get("op")) if isinstance(request, dict) else None
+        if not op:
+            return {"ok": False, "error": "Unknown operation"}
+        try:
+            return {"ok": True, "result": op(**request.get("args", {}))}
+        except BaseException as e:
+            print("Error: ", e)
+            return {"ok": False, "error": str(e)}
+
+    def make_handler(self):
+        rpc_server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                try:
+                    while True:
+                        request = receive_message(self.rfile)
+                        if request is None:
+                            return
+                        send_message(self.request, rpc_server.dispatch(request))
+                except (OSError, ValueError, RpcError) as e:
+                    print("Error: ", e)
+
+        return Handler
+
+
+class RpcClient:
+    """
+    Client of an RpcServer that keeps a pool of open connections, so that each call costs a single round trip.
+    Connections are created on demand, reused once a call returns and dropped if they fail. If the server expects a
+    token, the client must be given the same one.
+    """
+
+    def __init__(self, address, pool_size=None, timeout=None, token=None):
+        self.address = address
+        self.token = token
+        self.timeout = timeout if timeout else Globals.RPC_TIMEOUT_SECS
+        self.connections = queue.LifoQueue(maxsize=pool_size if pool_size else Globals.RPC_POOL_SIZE)
+
+    # calls an operation on the server and returns its result, raising RpcError if it failed
+    # a call is only retried if it was sent through a pooled connection that the server had meanwhile closed
+    def call(self, op, **args):
+        while True:
+            connection, pooled = self.get_connection()
+            try:
+                request = {"op": op, "args": args}
+                if self.token:
+                    request["token"] = self.token
+                send_message(connection[0], request)
+                response = receive_message(connection[1])
+            except socket.timeout:
+                RpcClient.close_connection(connection)
+                raise RpcError("Call to %s timed out" % op)
+            except OSError:
+                response = None
+            if response is None:
+                RpcClient.close_connection(connection)
+                if pooled:
+                    continue
+                raise RpcError("Connection to %s was lost" % (self.address,))
+            self.put_connection(connection)
+            if not response.get("ok"):
+                raise RpcError(response.get("error"))
+            return response.get("result")
+
+    # returns a pooled connection, or a new one if there are none available, and whether it was pooled
+    def get_connection(self):
+        try:
+            return self.connections.get_nowait(), True
+        except queue.Empty:
+            family = socket.AF_UNIX if isinstance(self.address, str) else socket.AF_INET
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(self.address)
+            except OSError as e:
+                sock.close()
+                raise RpcError("Could not connect to %s: %s" % (self.address, e))
+            return (sock, sock.makefile("rb")), False
+
+    def put_connection(self, connection):
+        try:
+            self.connections.put_nowait(connection)
+        except queue.Full:
+            RpcClient.close_connection(connection)
+
+    # closes every pooled connection
+    def close(self):
+        while True:
+            try:
+                RpcClient.close_connection(self.connections.get_nowait())
+            except queue.Empty:
+                return
+
+    @staticmethod
+    def close_connection(connection):
+        connection[1].close()
+        connection[0].close()
@@ -0,0 +1,186 @@
+import math
+from collections import deque
+from datetime import datetime
+
+from globals import Globals
+
+
+class PoolStats:
+    def __init__(self, size, serving, requested, ready, provisioning, waiting=0):
+        self.size = size
+        self.serving = serving
+        self.requested = requested
+        self.ready = ready
+        self.provisioning = provisioning
+        self.waiting = waiting
+
+
+class ScalingPolicy:
+    """
+    Decides the size of the pool on each health check. Times are given in seconds since the epoch so that the same
+    policy can be driven by the manager or replayed by the simulator. Every policy keeps an average (EWMA) of the
+    session duration and of the provisioning time, which are also used to estimate how long queued requests will wait.
+    Each policy sizes a single (sub-)pool, between its base and maximum sizes.
+    """
+
+    def __init__(self, base_size=None, max_size=None, prewarm_schedule=None):
+        self.session_secs = Globals.SCALING_INITIAL_SESSION_SECS
+        self.provisioning_secs = Globals.SCALING_INITIAL_PROVISIONING_SECS
+        self.base_size = base_size if base_size is not None else Globals.POOL_BASE_SIZE
+        self.max_size = max_size if max_size is not None else Globals.POOL_MAX_SIZE
+        self.prewarm_schedule = prewarm_schedule if prewarm_schedule is not None else Globals.SCALING_PREWARM_SCHEDULE
+
+    # returns the size the pool should have now
+    def get_target_size(self, stats: PoolStats, now) -> int:
+        raise NotImplementedError
+
+    # called whenever an instance is requested, whether the request is fulfilled or not
+    def record_request(self, now):
+        pass
+
+    # called whenever a session ends, with its duration
+    def record_session(self, duration_secs):
+        self.session_secs = ScalingPolicy.ewma(self.session_secs, duration_secs)
+
+    # called whenever an instance finishes provisioning, with the time it took
+    def record_provisioning(self, duration_secs):
+        self.provisioning_secs = ScalingPolicy.ewma(self.provisioning_secs, duration_secs)
+
+    # called whenever the pool size changes
+    def record_resize(self, now):
+        pass
+
+    # estimates how long the request at a given (1-based) position of the waiting queue will wait for an instance:
+    # the instances being provisioned go to the first requests, the next ones wait for the pool to be expanded and,
+    # once it cannot grow any further, for sessions to end
+    def estimate_wait_secs(self, position, stats: PoolStats):
+        if position <= stats.provisioning:
+            return self.provisioning_secs
+        wait_secs = Globals.HEALTH_CHECK_INTERVAL_SECS + self.provisioning_secs
+        if stats.size >= self.max_size and stats.serving > 0:
+            wait_secs = max(wait_secs, (position - stats.provisioning) * self.session_secs / stats.serving)
+        return wait_secs
+
+    def describe_state(self) -> str:
+        return type(self).__name__
+
+    @staticmethod
+    def ewma(average, value):
+        return (1 - Globals.SCALING_EWMA_ALPHA) * average + Globals.SCALING_EWMA_ALPHA * value
+
+
+class ThresholdPolicy(ScalingPolicy):
+    """
+    Grows and shrinks the pool in fixed POOL_EXPAND_SIZE steps based on the current amount of serving and requested
+    instances and of queued requests, between its base and maximum sizes. A pool with nothing busy or waiting never
+    grows, so that a sub-pool with a base size of 0 stays empty until it is used.
+    """
+
+    def get_target_size(self, stats: PoolStats, now) -> int:
+        count_total = stats.serving + stats.requested + stats.waiting
+        if stats.size < self.base_size:
+            return self.base_size
+        if 0 < count_total and count_total >= self.get_expansion_threshold(stats.size) and stats.size < self.max_size:
+            return min(stats.size + Globals.POOL_EXPAND_SIZE, self.max_size)
+        if count_total < self.get_reduction_threshold(stats.size) and stats.size > self.base_size:
+            return max(stats.size - Globals.POOL_EXPAND_SIZE, self.base_size)
+        return stats.size
+
+    # calculates the amount of serving instances above/at which to expand the pool size by pool_expand_size
+    @staticmethod
+    def get_expansion_threshold(size):
+        return size - (Globals.POOL_EXPAND_SIZE // 2)
+
+    # calculates the amount of serving instances below which to reduce the pool size by pool_expand_size
+    @staticmethod
+    def get_reduction_threshold(size):
+        return ThresholdPolicy.get_expansion_threshold(size) - Globals.POOL_EXPAND_SIZE
+
+
+class ForecastPolicy(ScalingPolicy):
+    """
+    Sizes the warm pool from the observed demand: the arrival rate of requests over a sliding window (or over a
+    shorter one, if it is higher, to react to bursts), the average (EWMA) session duration and the average (EWMA)
+    provisioning time. On top of the busy instances (and queued requests), it keeps enough spare instances for the
+    probability of running out before new ones can be provisioned to stay under SCALING_MISS_PROBABILITY, assuming
+    Poisson arrivals over the provisioning lead time and discounting the sessions expected to end (and free their
+    instance) within it. The result is bounded by the base size, any pre-warm schedule active at the time and the
+    maximum size. Growth is immediate, while shrinking needs a gap of at least SCALING_HYSTERESIS instances, waits
+    SCALING_COOLDOWN_SECS after the last resize and happens at most POOL_EXPAND_SIZE instances at a time.
+    """
+
+    def __init__(self, base_size=None, max_size=None, prewarm_schedule=None):
+        super().__init__(base_size, max_size, prewarm_schedule)
+        self.arrivals = deque()
+        self.last_resize = None
+        self.last_rate = 0
+
+    def record_request(self, now):
+        self.arrivals.append(now)
+
+    def record_resize(self, now):
+        self.last_resize = now
+
+    def get_target_size(self, stats: PoolStats, now) -> int:
+        while self.arrivals and self.arrivals[0] < now - Globals.SCALING_WINDOW_SECS:
+            self.arrivals.popleft()
+        burst_start = now - Globals.SCALING_BURST_WINDOW_SECS
+        burst = 0
+        for arrival in reversed(self.arrivals):
+            if arrival < burst_start:
+                break
+            burst += 1
+        self.last_rate = max(len(self.arrivals) / Globals.SCALING_WINDOW_SECS,
+                             burst / Globals.SCALING_BURST_WINDOW_SECS)
+        busy = stats.serving + stats.requested + stats.waiting
+        lead_time = self.provisioning_secs + Globals.HEALTH_CHECK_INTERVAL_SECS
+        arrivals = ForecastPolicy.poisson_quantile(self.last_rate * lead_time, 1 - Globals.SCALING_MISS_PROBABILITY)
+        departures = math.floor(stats.serving * lead_time / self.session_secs) if self.session_secs > 0 else 0
+        target = busy + max(arrivals - departures, Globals.SCALING_MIN_SPARE)
+        target = max(target, self.get_minimum_size(now))
+        target = min(target, self.max_size)
+        if target < stats.size:
+            cooling_down = self.last_resize is not None and now - self.last_resize < Globals.SCALING_COOLDOWN_SECS
+            if cooling_down or stats.size - target < Globals.SCALING_HYSTERESIS:
+                return stats.size
+            return max(target, stats.size - Globals.POOL_EXPAND_SIZE)
+        return target
+
+    def describe_state(self) -> str:
+        info = (self.last_rate * 60, self.session_secs, self.provisioning_secs)
+        return "ForecastPolicy | Arrival rate = %.2f/min | Session = %.0f s | Provisioning = %.1f s" % info
+
+    # returns the minimum pool size at a given time, according to the base size and the pre-warm schedule
+    def get_minimum_size(self, now):
+        size = self.base_size
+        moment = datetime.fromtimestamp(now)
+        hour = moment.hour + moment.minute / 60
+        for weekdays, start_hour, end_hour, schedule_size in self.prewarm_schedule:
+            if (not weekdays or moment.weekday() in weekdays) and start_hour <= hour < end_hour:
+                size = max(size, schedule_size)
+        return size
+
+    # returns the smallest k such that P(X <= k) >= probability, for X ~ Poisson(mean)
+    @staticmethod
+    def poisson_quantile(mean, probability):
+        if mean <= 0:
+            return 0
+        if mean > 500:
+            return math.ceil(mean + 4 * math.sqrt(mean))
+        k = 0
+        pmf = math.exp(-mean)
+        cdf = pmf
+        while cdf < probability:
+            k += 1
+            pmf *= mean / k
+            cdf += pmf
+        return k
+
+
+# returns a new instance of the scaling policy selected by SCALING_POLICY, for the sub-pool of a given profile (or for
+# a pool sized by POOL_BASE_SIZE, POOL_MAX_SIZE and SCALING_PREWARM_SCHEDULE)
+def create_policy(profile=None) -> ScalingPolicy:
+    policies = {"threshold": ThresholdPolicy, "forecast": ForecastPolicy}
+    if profile is None:
+        return policies[Globals.SCALING_POLICY]()
+    return policies[Globals.SCALING_POLICY](profile.base_size, profile.max_size, profile.prewarm_schedule)
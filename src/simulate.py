@@ -0,0 +1,109 @@
+import argparse
+import csv
+
+from globals import Globals
+import scaling
+from scaling import PoolStats
+
+
+class SimulatedInstance:
+    def __init__(self, ready_at):
+        self.ready_at = ready_at
+        self.busy_since = None
+        self.busy_until = None
+
+
+# replays a request trace (csv rows of "timestamp,duration", as written by the manager when SCALING_TRACE_PATH is set)
+# against a scaling policy, ticking every HEALTH_CHECK_INTERVAL_SECS, and returns a summary of how the pool behaved
+def simulate(trace, policy: scaling.ScalingPolicy, provisioning_secs, default_duration_secs):
+    if not trace:
+        return {}
+    durations = [duration for timestamp, duration in trace if duration is not None]
+    if durations:
+        default_duration_secs = sum(durations) / len(durations)
+    trace = sorted((timestamp, duration if duration is not None else default_duration_secs)
+                   for timestamp, duration in trace)
+    pool = [SimulatedInstance(trace[0][0]) for i in range(policy.base_size)]
+    misses = 0
+    size_time = 0
+    idle_time = 0
+    max_size = len(pool)
+    now = trace[0][0]
+    end = max(timestamp + duration for timestamp, duration in trace)
+    next_request = 0
+    while now <= end:
+        tick_end = now + Globals.HEALTH_CHECK_INTERVAL_SECS
+        while next_request < len(trace) and trace[next_request][0] < tick_end:
+            timestamp, duration = trace[next_request]
+            policy.record_request(timestamp)
+            ready = [instance for instance in pool if instance.ready_at <= timestamp and
+                     (instance.busy_until is None or instance.busy_until <= timestamp)]
+            if ready:
+                ready[0].busy_since = timestamp
+                ready[0].busy_until = timestamp + duration
+            else:
+                misses += 1
+            next_request += 1
+        now = tick_end
+        serving = 0
+        ready = 0
+        provisioning = 0
+        for instance in pool:
+            if instance.ready_at > now:
+                provisioning += 1
+            elif instance.busy_until is not None and instance.busy_until > now:
+                serving += 1
+            else:
+                if instance.busy_until is not None:
+                    policy.record_session(instance.busy_until - instance.busy_since)
+                    instance.busy_since = None
+                    instance.busy_until = None
+                ready += 1
+        size_time += len(pool) * Globals.HEALTH_CHECK_INTERVAL_SECS
+        idle_time += ready * Globals.HEALTH_CHECK_INTERVAL_SECS
+        target_size = policy.get_target_size(PoolStats(len(pool), serving, 0, ready, provisioning), now)
+        if target_size > len(pool):
+            pool.extend(SimulatedInstance(now + provisioning_secs) for i in range(target_size - len(pool)))
+            policy.record_provisioning(provisioning_secs)
+            policy.record_resize(now)
+        elif target_size < len(pool):
+            idle = [instance for instance in pool if instance.busy_until is None][:len(pool) - target_size]
+            if idle:
+                pool = [instance for instance in pool if instance not in idle]
+                policy.record_resize(now)
+        max_size = max(max_size, len(pool))
+    elapsed = max(now - trace[0][0], 1)
+    return {
+        "requests": len(trace),
+        "misses": misses,
+        "miss_rate": misses / len(trace),
+        "average_pool_size": size_time / elapsed,
+        "max_pool_size": max_size,
+        "average_idle_instances": idle_time / elapsed,
+    }
+
+
+# reads a trace file into a list of (timestamp, duration or None) tuples
+def read_trace(path):
+    trace = []
+    with open(path) as f:
+        for row in csv.reader(f):
+            if row and not row[0].startswith("#"):
+                duration = float(row[1]) if len(row) > 1 and row[1] else None
+                trace.append((float(row[0]), duration))
+    return trace
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replays a recorded request trace against a scaling policy")
+    parser.add_argument("trace", help="csv file with one \"timestamp,duration\" row per request")
+    parser.add_argument("--policy", choices=["forecast", "threshold"], default=Globals.SCALING_POLICY)
+    parser.add_argument("--provisioning-secs", type=float, default=Globals.SCALING_INITIAL_PROVISIONING_SECS)
+    parser.add_argument("--default-duration-secs", type=float, default=Globals.SCALING_INITIAL_SESSION_SECS,
+                        help="session duration of requests without one, if the trace has no durations at all")
+    args = parser.parse_args()
+    Globals.SCALING_POLICY = args.policy
+    results = simulate(read_trace(args.trace), scaling.create_policy(), args.provisioning_secs,
+                       args.default_duration_secs)
+    for key in results:
+        print("%s = %s" % (key, results[key]))
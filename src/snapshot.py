@@ -0,0 +1,141 @@
+import socket
+import struct
+import subprocess
+from datetime import datetime
+
+import metrics
+
+# state codes used by the kernel in /proc/net/tcp and /proc/net/tcp6
+TCP_ESTABLISHED = "01"
+TCP_LISTEN = "0A"
+TCP_TABLES = ["/proc/net/tcp", "/proc/net/tcp6"]
+
+# sock_diag netlink protocol (see linux/sock_diag.h, linux/inet_diag.h and linux/tcp.h)
+NETLINK_SOCK_DIAG = 4
+SOCK_DIAG_BY_FAMILY = 20
+NLM_F_REQUEST_DUMP = 0x301
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+INET_DIAG_INFO = 2
+NLMSG_HEADER = struct.Struct("=IHHII")
+INET_DIAG_MSG_SIZE = 72
+# offset of tcpi_bytes_acked, followed by tcpi_bytes_received, in struct tcp_info
+TCP_INFO_BYTES_OFFSET = 120
+
+
+class HostSnapshot:
+    """
+    Point-in-time view of the host shared by every server during one health check: the VNC server listing, the TCP
+    socket table and the traffic of the established connections, all indexed by local port.
+    """
+
+    def __init__(self, vnc_servers: dict, sockets: dict, traffic: dict = None):
+        self.timestamp = datetime.now()
+        self.vnc_servers = vnc_servers
+        self.sockets = sockets
+        self.traffic = traffic
+
+    # takes a new snapshot, running "vncserver -list" once, parsing the socket table once and dumping the traffic
+    # counters of the established connections once
+    @staticmethod
+    def take():
+        return HostSnapshot(read_vnc_server_list(), read_socket_table(), read_socket_traffic())
+
+    # checks if something is listening on a given local port
+    def is_listening(self, port) -> bool:
+        return TCP_LISTEN in self.sockets.get(port, {})
+
+    # checks if a given local port has at least one established connection
+    def is_established(self, port) -> bool:
+        return TCP_ESTABLISHED in self.sockets.get(port, {})
+
+    # returns the bytes received and sent through the established connections of a given local port (or None if the
+    # traffic counters of the host could not be read)
+    def get_traffic(self, port):
+        if self.traffic is None:
+            return None
+        return self.traffic.get(port, (0, 0))
+
+
+# runs the "vncserver -list" command, formats its output, and returns it
+def read_vnc_server_list():
+    vnc_servers = {}
+    try:
+        metrics.subprocesses.inc()
+        output = subprocess.check_output(["vncserver", "-list"], text=True)
+        for line in [lin for lin in output.split("\n") if lin]:
+            elements = [elem for elem in line.split("\t") if elem]
+            if len(elements) == 3 and elements[0].startswith(":"):
+                display_index = int(elements[0].replace(":", ""))
+                vnc_port = int(elements[1])
+                if "stale" not in elements[2].lower():
+                    pid = int(elements[2])
+                    vnc_servers[display_index] = {"port": vnc_port, "pid": pid}
+    except BaseException as e:
+        print("Error: ", e)
+    return vnc_servers
+
+
+# parses the host's TCP socket tables and returns, for each local port (or only for the given ports), the number of
+# sockets in each TCP state
+def read_socket_table(ports=None):
+    sockets = {}
+    for path in TCP_TABLES:
+        try:
+            with open(path) as f:
+                next(f)
+                for line in f:
+                    fields = line.split(None, 4)
+                    port = int(fields[1].rsplit(":", 1)[1], 16)
+                    if ports is not None and port not in ports:
+                        continue
+                    states = sockets.setdefault(port, {})
+                    states[fields[3]] = states.get(fields[3], 0) + 1
+        except FileNotFoundError:
+            pass
+    return sockets
+
+
+# dumps the established TCP connections of the host through sock_diag and returns, for each local port, the bytes
+# received and sent (acknowledged) through its connections, or None if the kernel does not provide them
+def read_socket_traffic():
+    traffic = {}
+    try:
+        with socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_SOCK_DIAG) as sock:
+            for family in [socket.AF_INET, socket.AF_INET6]:
+                request = struct.pack("=BBBBI", family, socket.IPPROTO_TCP, 1 << (INET_DIAG_INFO - 1), 0,
+                                      1 << int(TCP_ESTABLISHED, 16)) + bytes(48)
+                sock.sendall(NLMSG_HEADER.pack(NLMSG_HEADER.size + len(request), SOCK_DIAG_BY_FAMILY,
+                                               NLM_F_REQUEST_DUMP, family, 0) + request)
+                read_socket_traffic_dump(sock, traffic)
+    except OSError as e:
+        print("Error: ", e)
+        return None
+    return traffic
+
+
+# reads the replies to a sock_diag dump request, adding the traffic of each connection to that of its local port
+def read_socket_traffic_dump(sock, traffic):
+    while True:
+        data = sock.recv(65536)
+        offset = 0
+        while offset < len(data):
+            length, message_type, flags, seq, pid = NLMSG_HEADER.unpack_from(data, offset)
+            if message_type == NLMSG_DONE:
+                return
+            if message_type == NLMSG_ERROR:
+                raise OSError("sock_diag dump failed")
+            end = offset + length
+            port = struct.unpack_from(">H", data, offset + NLMSG_HEADER.size + 4)[0]
+            attribute = offset + NLMSG_HEADER.size + INET_DIAG_MSG_SIZE
+            while attribute + 4 <= end:
+                attribute_length, attribute_type = struct.unpack_from("=HH", data, attribute)
+                if attribute_type == INET_DIAG_INFO and attribute_length >= 4 + TCP_INFO_BYTES_OFFSET + 16:
+                    sent, received = struct.unpack_from("=QQ", data, attribute + 4 + TCP_INFO_BYTES_OFFSET)
+                    counters = traffic.setdefault(port, [0, 0])
+                    counters[0] += received
+                    counters[1] += sent
+                if attribute_length < 4:
+                    break
+                attribute += (attribute_length + 3) & ~3
+            offset = (end + 3) & ~3
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+import json
+import os
+import signal
+import socket
+import socketserver
+import struct
+import sys
+import threading
+
+# the stubs are run on their own (as executables on the PATH), so they must not depend on the rest of the code base
+
+
+class StubHost:
+    """
+    Stand-in for the VNC servers (Xvnc) of a host, used by bench.py and loadgen.py along with the vncserver and
+    vncconfig stubs, which forward their commands here. Each server is a process forked from this one that speaks
+    just enough RFB on its port (see serve_client) for a client to reach its first frame, so that a pool of 1000
+    servers costs little more memory than a single one. Like vncserver, starting a server also creates the X lock file
+    of its display.
+    """
+
+    def __init__(self, lock_dir):
+        self.lock_dir = lock_dir
+        self.servers = {}
+
+    # starts a server for a given display, listening on a given port, and returns its pid
+    def start(self, display_index, port):
+        if display_index in self.servers and is_alive(self.servers[display_index][1]):
+            raise ValueError("A VNC server is already running as :%d" % display_index)
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(("0.0.0.0", port))
+        listener.listen(128)
+        pid = os.fork()
+        if pid == 0:
+            serve(listener)
+        listener.close()
+        open(self.get_lock_path(display_index), "w").close()
+        self.servers[display_index] = (port, pid)
+        return pid
+
+    # returns the servers that are still running, as (display index, port, pid)
+    def list(self):
+        return [(display_index, port, pid) for display_index, (port, pid) in sorted(self.servers.items())
+                if is_alive(pid)]
+
+    # disconnects every client of the server of a given display, as vncconfig -disconnect does
+    def disconnect(self, display_index):
+        port, pid = self.servers.get(display_index, (None, None))
+        if not pid or not is_alive(pid):
+            raise ValueError("No VNC server is running as :%d" % display_index)
+        os.kill(pid, signal.SIGUSR1)
+
+    def kill(self, display_index):
+        port, pid = self.servers.pop(display_index, (None, None))
+        if pid:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        try:
+            os.remove(self.get_lock_path(display_index))
+        except OSError:
+            pass
+
+    def kill_all(self):
+        for display_index in list(self.servers):
+            self.kill(display_index)
+
+    def get_lock_path(self, display_index):
+        return os.path.join(self.lock_dir, ".X%d-lock" % display_index)
+
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except OSError:
+        return False
+
+
+# runs in a forked server process: serves each connection on a thread of its own, and closes them all on SIGUSR1
+def serve(listener):
+    connections = set()
+
+    def disconnect(signum, frame):
+        for connection in list(connections):
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def run(connection):
+        try:
+            serve_client(connection)
+        finally:
+            connections.discard(connection)
+
+    try:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGUSR1, disconnect)
+        fd = listener.fileno()
+        os.closerange(3, fd)
+        os.closerange(fd + 1, 65536)
+        while True:
+            connection, address = listener.accept()
+            connections.add(connection)
+            threading.Thread(target=run, args=(connection,), daemon=True).start()
+    finally:
+        os._exit(0)
+
+
+# RFB 3.8 without security: after the handshake, each framebuffer update request is answered with a 1x1 raw update,
+# and every other client message is read and ignored, until the client disconnects
+def serve_client(connection):
+    with connection:
+        stream = connection.makefile("rb")
+        try:
+            connection.sendall(b"RFB 003.008\n")
+            read_exactly(stream, 12)
+            connection.sendall(struct.pack(">BB", 1, 1))
+            read_exactly(stream, 1)
+            connection.sendall(struct.pack(">I", 0))
+            read_exactly(stream, 1)
+            name = b"stub"
+            pixel_format = struct.pack(">BBBBHHHBBBxxx", 32, 24, 0, 1, 255, 255, 255, 16, 8, 0)
+            connection.sendall(struct.pack(">HH", 1, 1) + pixel_format + struct.pack(">I", len(name)) + name)
+            while True:
+                message_type = read_exactly(stream, 1)[0]
+                if message_type == 0:
+                    read_exactly(stream, 19)
+                elif message_type == 2:
+                    count = struct.unpack(">xH", read_exactly(stream, 3))[0]
+                    read_exactly(stream, 4 * count)
+                elif message_type == 3:
+                    read_exactly(stream, 9)
+                    connection.sendall(struct.pack(">BxHHHHHi", 0, 1, 0, 0, 1, 1, 0) + b"\0\0\0\0")
+                elif message_type == 4:
+                    read_exactly(stream, 7)
+                elif message_type == 5:
+                    read_exactly(stream, 5)
+                elif message_type == 6:
+                    length = struct.unpack(">xxxI", read_exactly(stream, 7))[0]
+                    read_exactly(stream, length)
+                else:
+                    return
+        except (OSError, EOFError):
+            pass
+
+
+def read_exactly(stream, size):
+    data = stream.read(size)
+    if len(data) < size:
+        raise EOFError()
+    return data
+
+
+def make_handler(host: StubHost):
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            request = json.loads(self.rfile.readline())
+            try:
+                if request["op"] == "start":
+                    response = {"ok": True, "pid": host.start(request["display_index"], request["port"])}
+                elif request["op"] == "list":
+                    response = {"ok": True, "servers": host.list()}
+                elif request["op"] == "disconnect":
+                    host.disconnect(request["display_index"])
+                    response = {"ok": True}
+                elif request["op"] == "kill":
+                    host.kill(request["display_index"])
+                    response = {"ok": True}
+                else:
+                    response = {"ok": False, "error": "Unknown operation"}
+            except (OSError, ValueError) as e:
+                response = {"ok": False, "error": str(e)}
+            self.wfile.write(("%s\n" % json.dumps(response)).encode())
+
+    return Handler
+
+
+# usage: stubhost.py <socket path> <X lock dir>
+if __name__ == '__main__':
+    socket_path, lock_dir = sys.argv[1], sys.argv[2]
+    stub_host = StubHost(lock_dir)
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = socketserver.UnixStreamServer(socket_path, make_handler(stub_host))
+    try:
+        server.serve_forever()
+    finally:
+        stub_host.kill_all()
+        server.server_close()
+        os.remove(socket_path)
@@ -0,0 +1,136 @@
+import os
+import selectors
+import threading
+
+from globals import Globals
+
+
+class ProcessSupervisor:
+    """
+    Reacts to process exits as soon as they happen. Each watched process gets a pidfd (Linux 5.3+) that becomes
+    readable when it exits; processes that cannot get one are polled every SUPERVISOR_POLL_SECS instead. Exited
+    children are reaped before their callback is called with (pid, return code).
+    """
+
+    class Watch:
+        def __init__(self, pid, callback, process):
+            self.pid = pid
+            self.callback = callback
+            self.process = process
+            self.pidfd = None
+
+    def __init__(self):
+        self.watches = {}
+        self.pending = []
+        self.lock = threading.Lock()
+        self.selector = None
+        self.wake_r, self.wake_w = None, None
+        self.thread = None
+
+    # calls back once a given process exits; process is the subprocess.Popen object of the pid, if it is a child
+    def watch(self, pid, callback, process=None):
+        self.ensure_running()
+        with self.lock:
+            self.pending.append(ProcessSupervisor.Watch(pid, callback, process))
+        os.write(self.wake_w, b"\0")
+
+    # stops watching a given process (its callback will not be called)
+    def unwatch(self, pid):
+        if not self.thread:
+            return
+        with self.lock:
+            self.pending.append(pid)
+        os.write(self.wake_w, b"\0")
+
+    # starts the supervisor thread, if it is not running yet
+    def ensure_running(self):
+        with self.lock:
+            if self.thread:
+                return
+            self.selector = selectors.DefaultSelector()
+            self.wake_r, self.wake_w = os.pipe()
+            os.set_blocking(self.wake_r, False)
+            self.selector.register(self.wake_r, selectors.EVENT_READ)
+            self.thread = threading.Thread(target=self.run, name="Supervisor", daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            polled = [watch for watch in self.watches.values() if watch.pidfd is None]
+            timeout = Globals.SUPERVISOR_POLL_SECS if polled else None
+            for key, events in self.selector.select(timeout):
+                if key.fd == self.wake_r:
+                    self.apply_pending()
+                else:
+                    self.handle_exit(key.data)
+            for watch in polled:
+                if watch.pid in self.watches and not ProcessSupervisor.is_alive(watch):
+                    self.handle_exit(watch)
+
+    # applies the watch and unwatch calls made by other threads since the last iteration
+    def apply_pending(self):
+        try:
+            while os.read(self.wake_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        with self.lock:
+            pending = self.pending
+            self.pending = []
+        for item in pending:
+            if isinstance(item, ProcessSupervisor.Watch):
+                self.add(item)
+            else:
+                self.remove(item)
+
+    def add(self, watch: Watch):
+        self.remove(watch.pid)
+        self.watches[watch.pid] = watch
+        try:
+            watch.pidfd = os.pidfd_open(watch.pid)
+            self.selector.register(watch.pidfd, selectors.EVENT_READ, watch)
+        except ProcessLookupError:
+            self.handle_exit(watch)
+        except (AttributeError, OSError):
+            watch.pidfd = None
+
+    def remove(self, pid):
+        watch = self.watches.pop(pid, None)
+        if watch and watch.pidfd is not None:
+            self.selector.unregister(watch.pidfd)
+            os.close(watch.pidfd)
+            watch.pidfd = None
+
+    # reaps an exited process, if it is a child, and calls back
+    def handle_exit(self, watch: Watch):
+        self.remove(watch.pid)
+        return_code = None
+        try:
+            if watch.process:
+                return_code = watch.process.poll()
+            else:
+                pid, status = os.waitpid(watch.pid, os.WNOHANG)
+                if pid:
+                    return_code = os.waitstatus_to_exitcode(status)
+        except ChildProcessError:
+            pass
+        try:
+            watch.callback(watch.pid, return_code)
+        except BaseException as e:
+            print("Error: ", e)
+
+    # checks if a watched process is still running, without reaping it
+    @staticmethod
+    def is_alive(watch: Watch):
+        if watch.process:
+            return watch.process.poll() is None
+        try:
+            os.kill(watch.pid, 0)
+            return True
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+
+
+supervisor = ProcessSupervisor()
@@ -0,0 +1,60 @@
+import os
+import socketserver
+import threading
+
+from globals import Globals
+
+
+class TokenServer:
+    """
+    Live token -> target map owned by the manager, served over a local Unix socket so that websockify can resolve a
+    token with a single in-memory lookup. The protocol is one token per line, answered by "host:port" (or an empty
+    line if the token is unknown). Websockify queries it through plugins/token_plugin.py.
+    """
+
+    def __init__(self, path=None):
+        self.path = path if path else Globals.TOKENS_SOCKET_PATH
+        self.targets = {}
+        self.server = None
+        self.thread = None
+
+    # starts serving token lookups on the unix socket
+    def start(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.server = socketserver.ThreadingUnixStreamServer(self.path, self.make_handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name="TokenServer", daemon=True)
+        self.thread.start()
+        print("Token server listening on %s" % self.path)
+
+    # stops serving token lookups and removes the unix socket
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        print("Token server stopped")
+
+    def add(self, token, host, port):
+        self.targets[token] = "%s:%d" % (host, port)
+
+    def remove(self, token):
+        self.targets.pop(token, None)
+
+    def lookup(self, token):
+        return self.targets.get(token)
+
+    def make_handler(self):
+        token_server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    target = token_server.lookup(line.decode().strip())
+                    self.wfile.write(("%s\n" % (target if target else "")).encode())
+                    self.wfile.flush()
+
+        return Handler
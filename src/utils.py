@@ -43,3 +43,9 @@ def modify_environment(changes: dict):
     return env
 
 
+# moves a directory to a given (non-existing) path, renaming it if both are on the same filesystem
+def move_dir(src, dst):
+    try:
+        os.rename(src, dst)
+    except OSError:
+        shutil.move(src, dst)
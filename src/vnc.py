@@ -1,42 +1,82 @@
 import os
+import signal
 import subprocess
+import threading
+import time
+from datetime import datetime
 
 import psutil
 
+import metrics
+import profiles
+import resources
 import utils
+from allocator import allocator
 from globals import Globals
 from iserver import IServer, State
+from snapshot import HostSnapshot, TCP_LISTEN, read_socket_table
+from supervisor import supervisor
 
 
 class VNC(IServer):
-    def __init__(self):
+    def __init__(self, on_dead=None, profile=None):
+        self.on_dead = on_dead
+        self.profile = profile or profiles.load_profiles()[Globals.VNC_DEFAULT_PROFILE]
         self.display_index = Globals.NA
         self.pid = Globals.NA
+        self.host = "localhost"
         self.port = Globals.NA
-        self.state = State.Dead
+        self.state = State.Provisioning
+        self.state_timestamp = datetime.now()
         self.running_process = None
+        self.usage = resources.Usage()
+        self.sessions = 0
+        self.started_at = None
+        self.lifecycle_lock = threading.Lock()
+        self.is_stopped = False
+        self.traffic = None
+        self.traffic_at = None
+        self.active_at = None
+        self.warning_process = None
+        self.is_warned = False
+        self.warning_lock = threading.Lock()
 
-    # start a vnc instance
+    # start a vnc instance, with the geometry and colour depth of its profile (blocks until the server has been
+    # spawned, so it is meant to run on a provisioning thread)
     def start(self):
-        res = "%dx%d" % (Globals.VNC_RESOLUTION["width"], Globals.VNC_RESOLUTION["height"])
-        self.display_index = VNC.get_available_display_index()
-        vnc = subprocess.Popen(["vncserver", ":%d" % self.display_index, "-noxstartup", "-geometry", res])
-        vnc.wait(timeout=5)
-        self.state = State.Unavailable
-        path = self.get_files_dir()
-        utils.clear_dir(path)
-        utils.ensure_dir_exists(path)
-        print("Started VNC server at index %d" % self.display_index)
+        with self.lifecycle_lock:
+            if self.is_stopped:
+                return
+            try:
+                res = "%dx%d" % (self.profile.width, self.profile.height)
+                self.display_index = allocator.acquire()
+                self.port = allocator.get_port(self.display_index)
+                metrics.subprocesses.inc()
+                vnc = subprocess.Popen(["vncserver", ":%d" % self.display_index, "-noxstartup", "-geometry", res,
+                                        "-depth", "%d" % self.profile.depth, "-rfbport", "%d" % self.port])
+                vnc.wait(timeout=5)
+                path = self.get_files_dir()
+                utils.clear_dir(path)
+                utils.ensure_dir_exists(path)
+                self.started_at = time.monotonic()
+                self.state = State.Unavailable
+                print("Started VNC server at index %d" % self.display_index)
+            except BaseException as e:
+                print("Error: ", e)
+                self.state = State.Dead
 
     # run a system command on this vnc instance
     def run_command(self, command):
         if self.state == State.Serving and not self.running_process:
             command_array = [s.strip() for s in command.split(" ") if s.strip()]
             env = utils.modify_environment({"DISPLAY": ":%d" % self.display_index})
+            metrics.subprocesses.inc()
             self.running_process = subprocess.Popen(command_array, env=env, cwd=self.get_files_dir())
+            supervisor.watch(self.running_process.pid, self.on_command_exit, self.running_process)
+            resources.limit_session(self.running_process.pid, self.get_session_name())
             print("Running new command running on VNC server at index %d (cmd = %s)" % (self.display_index, command))
 
-    # stops a system command (if any) running on the vnc instance
+    # stops a system command (if any) running on the vnc instance (the supervisor reaps it once it exits)
     def stop_command(self):
         if self.running_process:
             self.running_process.terminate()
@@ -44,83 +84,322 @@ class VNC(IServer):
             utils.clear_dir(self.get_files_dir())
             print("Stopped command running on VNC server at index %d" % self.display_index)
 
+    # kills the command running on this vnc instance (if any) along with every process it spawned, and returns
+    # whether they all exited within RECYCLE_TIMEOUT_SECS
+    def kill_command(self) -> bool:
+        process = self.running_process
+        self.running_process = None
+        if not process:
+            return True
+        try:
+            descendants = psutil.Process(process.pid).children(recursive=True)
+        except psutil.NoSuchProcess:
+            descendants = []
+        for child in descendants + [process]:
+            try:
+                child.kill()
+            except (psutil.NoSuchProcess, ProcessLookupError):
+                pass
+        try:
+            process.wait(timeout=Globals.RECYCLE_TIMEOUT_SECS)
+        except (subprocess.TimeoutExpired, psutil.TimeoutExpired):
+            return False
+        gone, alive = psutil.wait_procs(descendants, timeout=Globals.RECYCLE_TIMEOUT_SECS)
+        return not alive
+
+    # resets this vnc instance in place once its session has ended, without restarting its server: kills its command
+    # (and every process it spawned), clears its files and checks that the server is still listening
+    # returns whether the instance is ready again, otherwise (if it was unhealthy or has served RECYCLE_MAX_SESSIONS
+    # sessions) it has to be restarted
+    def recycle(self) -> bool:
+        with self.lifecycle_lock:
+            if self.is_stopped:
+                return False
+            self.sessions += 1
+            self.stop_warning()
+            if not self.kill_command():
+                print("VNC server at index %d could not be recycled as its command did not exit" % self.display_index)
+                return False
+            utils.clear_dir(self.get_files_dir())
+            if self.sessions >= Globals.RECYCLE_MAX_SESSIONS:
+                print_info = (self.display_index, self.sessions)
+                print("VNC server at index %d will not be recycled as it has served %d sessions" % print_info)
+                return False
+            if not psutil.pid_exists(self.pid) or not self.is_listening():
+                print("VNC server at index %d could not be recycled as it is no longer listening" % self.display_index)
+                return False
+            self.state_timestamp = datetime.now()
+            self.state = State.Ready
+            return True
+
+    # called by the supervisor once the command running on this vnc instance has exited (and has been reaped)
+    def on_command_exit(self, pid, return_code):
+        resources.release_session(self.get_session_name())
+        if self.running_process and self.running_process.pid == pid:
+            self.running_process = None
+            utils.clear_dir(self.get_files_dir())
+            print_info = (pid, self.display_index, return_code)
+            print("Command (PID = %d) running on VNC server at index %d exited with code %s" % print_info)
+
+    # called by the supervisor once the server of this vnc instance has exited
+    def on_server_exit(self, pid, return_code):
+        if self.is_stopped or pid != self.pid:
+            return
+        print("VNC server at index %d (PID = %d) exited unexpectedly" % (self.display_index, pid))
+        if self.on_dead:
+            self.on_dead()
+        else:
+            self.mark_dead()
+
     # stop this vnc instance
     def stop(self):
-        self.stop_command()
-        os.system("vncserver -kill :%d" % self.display_index)
-        self.state = State.Dead
-        utils.clear_and_remove_dir(self.get_files_dir())
-        print("Stopped VNC server at index %d" % self.display_index)
-
-    # checks multiple external sources and correspondingly updates the state of this VNC instance
-    def check_state(self) -> bool:
+        with self.lifecycle_lock:
+            self.is_stopped = True
+            if self.display_index == Globals.NA:
+                self.state = State.Dead
+                return
+            supervisor.unwatch(self.pid)
+            self.stop_command()
+            self.stop_warning()
+            resources.release_session(self.get_session_name())
+            try:
+                metrics.subprocesses.inc()
+                subprocess.run(["vncserver", "-kill", ":%d" % self.display_index], stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL, timeout=Globals.TEARDOWN_TIMEOUT_SECS)
+            except (OSError, subprocess.TimeoutExpired) as e:
+                print("Error: ", e)
+                if self.pid != Globals.NA:
+                    try:
+                        os.kill(self.pid, signal.SIGKILL)
+                    except OSError:
+                        pass
+            self.state = State.Dead
+            utils.clear_and_remove_dir(self.get_files_dir())
+            allocator.release(self.display_index)
+            print("Stopped VNC server at index %d" % self.display_index)
+
+    # updates the state of this VNC instance from a snapshot of the host
+    # snapshots taken before the last out-of-band state change (see mark_serving, mark_dead and recycle) are ignored
+    # as they are outdated; an instance whose session has ended is left recycling until it is recycled
+    def check_state(self, snapshot: HostSnapshot) -> bool:
+        if self.state in [State.Provisioning, State.Recycling] or snapshot.timestamp < self.state_timestamp:
+            return False
         old_state = self.state
-        servers = VNC.get_vnc_server_list()
-        if self.display_index in servers:
-            server = servers[self.display_index]
+        if self.display_index in snapshot.vnc_servers:
+            server = snapshot.vnc_servers[self.display_index]
             self.port = server["port"]
-            self.pid = server["pid"]
+            if self.pid != server["pid"]:
+                self.pid = server["pid"]
+                supervisor.watch(self.pid, self.on_server_exit)
             self.state = State.Unavailable
-            try:
-                process = psutil.Process(self.pid)
-                for connection in process.connections():
-                    if int(connection.laddr[1]) == self.port:
-                        if connection.raddr and connection.status == psutil.CONN_ESTABLISHED:
-                            self.state = State.Serving
-                            break
-                        elif not connection.raddr and connection.status == psutil.CONN_LISTEN:
-                            self.state = State.Ready
-            except BaseException as e:
-                print("Error: ", e)
-                self.state = State.Dead
+            if snapshot.is_established(self.port):
+                self.state = State.Serving
+            elif snapshot.is_listening(self.port):
+                self.state = State.Ready
         else:
             self.state = State.Dead
+        if self.state == State.Serving:
+            self.track_activity(snapshot.get_traffic(self.port))
+        else:
+            self.traffic, self.traffic_at, self.active_at = None, None, None
+        if self.state in [State.Ready, State.Unavailable] and (old_state == State.Serving or self.running_process):
+            self.state = State.Recycling
         if old_state != self.state:
             print_info = (self.display_index, old_state, self.state)
             print("Updated state of VNC server at index %d from %s to %s" % print_info)
             return True
         return False
 
+    # updates the time of the last activity of the session of this VNC instance from the bytes received and sent
+    # through its connections (the counters start over with each connection, so a drop means the client reconnected)
+    # the session is active as long as it receives more than IDLE_MIN_INPUT_BYTES_PER_SEC, and is never seen as idle
+    # if the traffic counters of the host are unavailable
+    def track_activity(self, traffic):
+        now = time.monotonic()
+        if traffic is None or self.traffic is None or traffic[0] < self.traffic[0] or \
+                traffic[0] - self.traffic[0] > Globals.IDLE_MIN_INPUT_BYTES_PER_SEC * (now - self.traffic_at):
+            self.active_at = now
+        self.traffic = traffic
+        self.traffic_at = now
+
+    # returns for how long the session of this VNC instance has been idle (0 if it is not serving)
+    def get_idle_secs(self):
+        if self.state != State.Serving or self.active_at is None:
+            return 0
+        return time.monotonic() - self.active_at
+
+    # returns whether the session of this VNC instance has been idle for IDLE_TIMEOUT_SECS and should be disconnected
+    # (see disconnect)
+    def check_idle(self) -> bool:
+        if not Globals.IDLE_TIMEOUT_SECS or self.state != State.Serving:
+            return False
+        if self.get_idle_secs() < Globals.IDLE_TIMEOUT_SECS:
+            return False
+        # the session is seen as active again so that it is only disconnected once
+        self.active_at = time.monotonic()
+        return True
+
+    # disconnects the client of this VNC instance, for its session to end (and the instance to be recycled) as if the
+    # client had left; blocks for up to RECYCLE_TIMEOUT_SECS, so it is meant to run on the recycling executor
+    def disconnect(self) -> bool:
+        process = self.run_display_command(Globals.IDLE_DISCONNECT_CMD)
+        if not process:
+            return False
+        try:
+            return process.wait(timeout=Globals.RECYCLE_TIMEOUT_SECS) == 0
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+            return False
+
+    # runs a system command on the display of this vnc instance, apart from its session, and returns its process
+    def run_display_command(self, command):
+        command_array = [s.strip() for s in command.split(" ") if s.strip()]
+        env = utils.modify_environment({"DISPLAY": ":%d" % self.display_index})
+        try:
+            metrics.subprocesses.inc()
+            return subprocess.Popen(command_array, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except OSError as e:
+            print("Error: ", e)
+            return None
+
+    # returns whether the user of this VNC instance is now to be warned, IDLE_WARNING_SECS before its session times
+    # out; the decision is taken by the health check, while the warning is shown apart from it (see show_warning), and
+    # a session is only warned once until its warning is taken down (see stop_warning)
+    def check_idle_warning(self) -> bool:
+        if not Globals.IDLE_TIMEOUT_SECS or self.state != State.Serving or self.is_warned:
+            return False
+        idle_secs = self.get_idle_secs()
+        if Globals.IDLE_TIMEOUT_SECS - Globals.IDLE_WARNING_SECS <= idle_secs < Globals.IDLE_TIMEOUT_SECS:
+            self.is_warned = True
+            return True
+        return False
+
+    # shows the idle warning on the display of this vnc instance, unless it was taken down meanwhile
+    def show_warning(self):
+        with self.warning_lock:
+            if not self.is_warned or self.warning_process:
+                return
+            idle_secs = self.get_idle_secs()
+            command = Globals.IDLE_WARNING_CMD % {"secs": max(Globals.IDLE_TIMEOUT_SECS - idle_secs, 0)}
+            self.warning_process = self.run_display_command(command)
+        print_info = (self.display_index, idle_secs)
+        print("Warned the user of VNC server at index %d after %d seconds of inactivity" % print_info)
+
+    # returns whether an idle warning is still shown on this vnc instance although its session has been used since
+    def has_stale_warning(self):
+        if not self.is_warned or not Globals.IDLE_TIMEOUT_SECS:
+            return False
+        return self.get_idle_secs() < Globals.IDLE_TIMEOUT_SECS - Globals.IDLE_WARNING_SECS
+
+    # takes down the idle warning shown on this vnc instance (if any), waiting for it to exit
+    def stop_warning(self):
+        with self.warning_lock:
+            self.is_warned = False
+            process = self.warning_process
+            self.warning_process = None
+        if process:
+            if process.poll() is None:
+                process.terminate()
+            try:
+                process.wait(timeout=Globals.RECYCLE_TIMEOUT_SECS)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    # checks if the server of this VNC instance is listening, looking up only its own port in the socket table
+    def is_listening(self) -> bool:
+        return TCP_LISTEN in read_socket_table({self.port}).get(self.port, {})
+
+    # marks this VNC instance as ready, ahead of the next health check, once its server is found listening right after
+    # being started (see is_listening)
+    def mark_ready(self):
+        if self.state == State.Unavailable:
+            self.state_timestamp = datetime.now()
+            print_info = (self.display_index, self.state, State.Ready)
+            print("Updated state of VNC server at index %d from %s to %s" % print_info)
+            self.state = State.Ready
+
+    # marks this VNC instance as serving, ahead of the next health check, once a connection to it has been detected
+    def mark_serving(self):
+        self.state_timestamp = datetime.now()
+        if self.state != State.Serving:
+            print_info = (self.display_index, self.state, State.Serving)
+            print("Updated state of VNC server at index %d from %s to %s" % print_info)
+            self.state = State.Serving
+
+    # marks this VNC instance as dead, ahead of the next health check, once its server has exited
+    def mark_dead(self):
+        self.state_timestamp = datetime.now()
+        if self.state != State.Dead:
+            print_info = (self.display_index, self.state, State.Dead)
+            print("Updated state of VNC server at index %d from %s to %s" % print_info)
+            self.state = State.Dead
+
     def describe_state(self) -> str:
         proc_info = "Running [PID = %d]" % self.running_process.pid if self.running_process else self.running_process
-        info = (self.display_index, self.pid, self.port, self.state, proc_info)
-        return "Display index = %d | PID = %d | Port = %d | State = %s | Running process = %s" % info
+        info = (self.display_index, self.profile.name, self.pid, self.port, self.state, proc_info, self.get_idle_secs(),
+                self.usage.describe())
+        return "Display index = %d | Profile = %s | PID = %d | Port = %d | State = %s | Running process = %s | " \
+               "Idle = %ds | %s" % info
 
-    # returns the path to the folder containing files used by this vnc instance
-    def get_files_dir(self):
-        return os.path.join(Globals.VNC_FILES_DIR, "%d" % self.display_index)
+    # returns what a restarted manager needs to adopt this vnc instance (see adopt)
+    def to_journal(self):
+        return {"display_index": self.display_index, "port": self.port, "pid": self.pid, "sessions": self.sessions,
+                "command_pid": self.running_process.pid if self.running_process else None, "profile": self.profile.name}
 
-    # saves files to the directory of this vnc instance
-    def store_files_to_dir(self, files):
-        path = self.get_files_dir()
-        utils.ensure_dir_exists(path)
-        utils.clear_dir(path)
-        for name in Globals.VNC_SUMO_FILES:
-            file = files[name]
-            file.save(os.path.join(path, "%s.xml" % name))
+    # rebuilds a vnc instance of a given profile from its journal entry if its server is still running, according to a
+    # snapshot of the host, along with the command running on it (if any), or returns None otherwise
+    @staticmethod
+    def adopt(entry, snapshot: HostSnapshot, on_dead=None, profile=None):
+        server = snapshot.vnc_servers.get(entry["display_index"])
+        if not server or server["port"] != entry["port"]:
+            return None
+        vnc_instance = VNC(on_dead, profile)
+        vnc_instance.display_index = entry["display_index"]
+        vnc_instance.port = server["port"]
+        vnc_instance.pid = server["pid"]
+        vnc_instance.sessions = entry["sessions"]
+        vnc_instance.started_at = time.monotonic()
+        vnc_instance.state = State.Unavailable
+        allocator.reserve(vnc_instance.display_index)
+        supervisor.watch(vnc_instance.pid, vnc_instance.on_server_exit)
+        vnc_instance.running_process = VNC.find_command(entry["command_pid"], vnc_instance.get_files_dir())
+        if vnc_instance.running_process:
+            supervisor.watch(vnc_instance.running_process.pid, vnc_instance.on_command_exit)
+        print("Adopted VNC server at index %d (PID = %d)" % (vnc_instance.display_index, vnc_instance.pid))
+        return vnc_instance
 
-    # runs the "vncserver -list" command, formats its output, and returns it
+    # returns the process with a given pid if it is still a command running in a given directory
     @staticmethod
-    def get_vnc_server_list():
-        vnc_servers = {}
+    def find_command(pid, files_dir):
+        if not pid:
+            return None
         try:
-            output = subprocess.check_output(["vncserver", "-list"], text=True)
-            for line in [lin for lin in output.split("\n") if lin]:
-                elements = [elem for elem in line.split("\t") if elem]
-                if len(elements) == 3 and elements[0].startswith(":"):
-                    display_index = int(elements[0].replace(":", ""))
-                    vnc_port = int(elements[1])
-                    if "stale" not in elements[2].lower():
-                        pid = int(elements[2])
-                        vnc_servers[display_index] = {"port": vnc_port, "pid": pid}
-        except BaseException as e:
-            print("Error: ", e)
-        return vnc_servers
+            process = psutil.Process(pid)
+            if os.path.realpath(process.cwd()) == os.path.realpath(files_dir):
+                return process
+        except psutil.Error:
+            pass
+        return None
 
-    # returns the next available display index, in ascending order and starting at 1
-    @staticmethod
-    def get_available_display_index():
-        display_index = Globals.BASE_DISPLAY_INDEX
-        while display_index in VNC.get_vnc_server_list():
-            display_index += 1
-        return display_index
+    # returns the pids at the root of the process trees of this vnc instance: its server and its running command
+    def get_pids(self):
+        pids = [self.pid] if self.pid != Globals.NA else []
+        if self.running_process:
+            pids.append(self.running_process.pid)
+        return pids
+
+    # returns the name of the cgroup in which the commands of this vnc instance run (see resources.limit_session)
+    def get_session_name(self):
+        return "vnc-%d" % self.display_index
+
+    # returns the path to the folder containing files used by this vnc instance
+    def get_files_dir(self):
+        return os.path.join(Globals.VNC_FILES_DIR, "%d" % self.display_index)
+
+    # moves a staging directory, holding the files of a request, into place as the directory of this vnc instance
+    # (the hashes of the files are only needed to send them to remote instances, see remote.py)
+    def adopt_files_dir(self, staging_dir, file_hashes=None):
+        path = self.get_files_dir()
+        utils.clear_and_remove_dir(path)
+        utils.move_dir(staging_dir, path)
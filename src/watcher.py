@@ -0,0 +1,62 @@
+import threading
+import time
+
+from globals import Globals
+from snapshot import TCP_ESTABLISHED, read_socket_table
+
+
+class ConnectionWatcher:
+    """
+    Watches the ports of claimed VNC instances at a short interval, independently of the health check, and calls back
+    as soon as one of them has an established connection. Only the watched ports are looked up in the socket table and
+    the thread sleeps while nothing is being watched.
+    """
+
+    def __init__(self, on_connected):
+        self.on_connected = on_connected
+        self.watched = {}
+        self.condition = threading.Condition()
+        self.thread = None
+        self.is_running = False
+
+    def start(self):
+        self.is_running = True
+        self.thread = threading.Thread(target=self.run, name="ConnectionWatcher", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.is_running = False
+            self.condition.notify()
+        if self.thread:
+            self.thread.join()
+
+    # starts watching the port of a given vnc instance
+    def watch(self, vnc_id, port):
+        with self.condition:
+            self.watched[vnc_id] = port
+            self.condition.notify()
+
+    # stops watching the port of a given vnc instance, if it is being watched
+    def unwatch(self, vnc_id):
+        with self.condition:
+            self.watched.pop(vnc_id, None)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.is_running and not self.watched:
+                    self.condition.wait()
+                if not self.is_running:
+                    return
+                watched = dict(self.watched)
+            sockets = read_socket_table(set(watched.values()))
+            detected_at = time.monotonic()
+            for vnc_id, port in watched.items():
+                if TCP_ESTABLISHED in sockets.get(port, {}):
+                    self.unwatch(vnc_id)
+                    try:
+                        self.on_connected(vnc_id, detected_at)
+                    except BaseException as e:
+                        print("Error: ", e)
+            time.sleep(Globals.WATCHER_INTERVAL_SECS)
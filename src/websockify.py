@@ -1,51 +1,232 @@
 import os
+import socket
 import subprocess
+import threading
 
 import psutil
 
+import metrics
+import utils
 from globals import Globals
 from iserver import IServer, State
+from snapshot import HostSnapshot
+from supervisor import supervisor
 
 
 class Websockify(IServer):
+    """
+    Group of websockify workers sharing WEBSOCKIFY_PORT, so that proxying the sessions is spread over every core and a
+    worker that fails only takes its own connections with it. Each worker is given a listening socket of its own, bound
+    with SO_REUSEPORT (through websockify's inetd mode), and the kernel balances new connections across them; each
+    worker is checked, and restarted, on its own.
+    """
+
     def __init__(self):
-        self.pid = Globals.NA
         self.port = Globals.WEBSOCKIFY_PORT
         self.state = State.Dead
+        self.workers = [WebsockifyWorker(index, self.port) for index in range(get_worker_count())]
 
-    # start a websockify instance
+    # starts every worker that is not running yet (e.g. those that were not adopted)
     def start(self):
-        websockify = subprocess.Popen(["websockify", "localhost:%d" % self.port, "--token-plugin", "TokenFile",
-                                       "--token-source", Globals.TOKENS_FILE_DIR, "--log-file", "../websockify.log",
-                                       "--verbose"])
-        self.pid = websockify.pid
-        self.state = State.Unavailable
-        print("Started Websockify server listening on port %d (PID = %d)" % (self.port, self.pid))
+        for worker in self.workers:
+            if not worker.is_running():
+                worker.start()
+
+    # adopts the workers left running by a previous manager, given their pids, and returns how many were adopted
+    def adopt(self, pids) -> int:
+        adopted = 0
+        for worker, pid in zip(self.workers, pids):
+            if worker.adopt(pid):
+                adopted += 1
+        return adopted
+
+    # leaves every worker running (for the next manager to adopt), but stops watching them
+    def detach(self):
+        for worker in self.workers:
+            worker.detach()
 
-    # stop this websockify instance
     def stop(self):
-        os.system("kill %d" % self.pid)
+        for worker in self.workers:
+            worker.stop()
         self.state = State.Dead
-        print("Stopped Websockify server listening on port %d (PID = %d)" % (self.port, self.pid))
 
-    # checks multiple external sources and correspondingly updates the state of this Websockify instance
-    def check_state(self) -> bool:
+    # starts again the workers that have exited and were not stopped on purpose
+    def restart(self):
+        for worker in self.workers:
+            worker.restart()
+
+    # updates the state of every worker from a snapshot of the host, and that of the group from theirs: it is ready as
+    # long as any worker is, and serving while it is ready and has established connections
+    def check_state(self, snapshot: HostSnapshot) -> bool:
+        changes = [worker.check_state(snapshot) for worker in self.workers]
         old_state = self.state
-        self.state = State.Unavailable
+        states = [worker.state for worker in self.workers]
+        self.state = State.Dead
+        if State.Ready in states:
+            self.state = State.Serving if snapshot.is_established(self.port) else State.Ready
+        elif State.Unavailable in states:
+            self.state = State.Unavailable
+        if old_state != self.state:
+            print("Updated state of Websockify from %s to %s" % (old_state, self.state))
+            return True
+        return any(changes)
+
+    # returns the pids of the workers, in order, for a restarted manager to adopt them (see adopt)
+    def get_pids(self):
+        return [worker.pid for worker in self.workers]
+
+    def count_ready(self):
+        return sum(1 for worker in self.workers if worker.state == State.Ready)
+
+    def describe_state(self) -> str:
+        info = (self.port, self.state, self.count_ready(), len(self.workers),
+                ", ".join("%d" % worker.pid for worker in self.workers))
+        return "Port = %d | State = %s | Workers = %d of %d ready [PIDs = %s]" % info
+
+
+class WebsockifyWorker(IServer):
+    def __init__(self, index, port):
+        self.index = index
+        self.pid = Globals.NA
+        self.port = port
+        self.state = State.Dead
+        self.process = None
+        self.socket_link = None
+        self.is_stopped = False
+        self.restart_lock = threading.Lock()
+
+    # start a websockify worker on a new listening socket, which it receives as its stdin (--inetd)
+    def start(self):
+        self.is_stopped = False
+        env = utils.modify_environment({"PYTHONPATH": Globals.WEBSOCKIFY_PLUGINS_DIR})
+        command = ["websockify", "--inetd", "--token-plugin", "token_plugin.TokenPlugin",
+                   "--token-source", os.path.abspath(Globals.TOKENS_SOCKET_PATH),
+                   "--log-file", "../websockify-%d.log" % self.index]
+        if Globals.WEBSOCKIFY_VERBOSE:
+            command.append("--verbose")
         try:
-            process = psutil.Process(self.pid)
-            self.state = State.Ready
-            if process.connections():
-                self.state = State.Serving
-        except BaseException as e:
+            with create_listener(self.port) as listener:
+                metrics.subprocesses.inc()
+                self.process = subprocess.Popen(command, stdin=listener.fileno(), env=env)
+        except OSError as e:
             print("Error: ", e)
             self.state = State.Dead
+            return
+        self.pid = self.process.pid
+        self.socket_link = read_stdin_link(self.pid)
+        self.state = State.Unavailable
+        supervisor.watch(self.pid, self.on_exit, self.process)
+        print_info = (self.index, self.port, self.pid)
+        print("Started Websockify worker %d listening on port %d (PID = %d)" % print_info)
+
+    # adopts a websockify worker left running by a previous manager, if the given pid still belongs to one
+    def adopt(self, pid) -> bool:
+        try:
+            process = psutil.Process(pid)
+            if not any("websockify" in arg for arg in process.cmdline()):
+                return False
+        except (psutil.Error, ValueError):
+            return False
+        self.is_stopped = False
+        self.process = process
+        self.pid = pid
+        self.socket_link = read_stdin_link(pid)
+        self.state = State.Unavailable
+        supervisor.watch(self.pid, self.on_exit)
+        print("Adopted Websockify worker %d listening on port %d (PID = %d)" % (self.index, self.port, self.pid))
+        return True
+
+    # leaves this websockify worker running (for the next manager to adopt), but stops watching it
+    def detach(self):
+        self.is_stopped = True
+        supervisor.unwatch(self.pid)
+
+    # stop this websockify worker
+    def stop(self):
+        self.is_stopped = True
+        if not self.process:
+            return
+        supervisor.unwatch(self.pid)
+        try:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=5)
+            except (subprocess.TimeoutExpired, psutil.TimeoutExpired):
+                self.process.kill()
+                self.process.wait()
+        except (psutil.NoSuchProcess, ProcessLookupError):
+            pass
+        self.state = State.Dead
+        print("Stopped Websockify worker %d listening on port %d (PID = %d)" % (self.index, self.port, self.pid))
+
+    # called by the supervisor once this websockify worker has exited (and has been reaped), restarting it
+    def on_exit(self, pid, return_code):
+        if self.is_stopped or pid != self.pid:
+            return
+        print_info = (self.index, pid, return_code)
+        print("Websockify worker %d (PID = %d) exited with code %s and will be restarted" % print_info)
+        self.restart()
+
+    # starts this websockify worker again if it has exited and was not stopped on purpose
+    def restart(self):
+        with self.restart_lock:
+            if self.is_stopped or self.is_running():
+                return
+            self.start()
+
+    # updates the state of this websockify worker: it is ready while it is running and still holds its listening
+    # socket (connections to the port as a whole are only known to the group, see Websockify.check_state)
+    def check_state(self, snapshot: HostSnapshot) -> bool:
+        old_state = self.state
+        self.state = State.Dead
+        if self.is_running():
+            self.state = State.Unavailable
+            if self.socket_link and read_stdin_link(self.pid) == self.socket_link and \
+                    snapshot.is_listening(self.port):
+                self.state = State.Ready
         if old_state != self.state:
-            print_info = (old_state, self.state, self.pid)
-            print("Updated state of Websockify server from %s to %s (PID = %d)" % print_info)
+            print_info = (self.index, old_state, self.state, self.pid)
+            print("Updated state of Websockify worker %d from %s to %s (PID = %d)" % print_info)
             return True
         return False
 
+    def is_running(self):
+        if isinstance(self.process, subprocess.Popen):
+            return self.process.poll() is None
+        try:
+            return self.process is not None and self.process.is_running() and \
+                self.process.status() != psutil.STATUS_ZOMBIE
+        except psutil.Error:
+            return False
+
     def describe_state(self) -> str:
-        info = (self.pid, self.port, self.state)
-        return "PID = %d | Port = %d | State = %s" % info
+        info = (self.index, self.pid, self.port, self.state)
+        return "Worker = %d | PID = %d | Port = %d | State = %s" % info
+
+
+# returns how many websockify workers to run: WEBSOCKIFY_WORKERS, or one per core if it is not set
+def get_worker_count():
+    return Globals.WEBSOCKIFY_WORKERS or os.cpu_count() or 1
+
+
+# creates a listening socket on a given local port that other sockets can listen on as well (SO_REUSEPORT), for the
+# kernel to balance the connections to that port across them
+def create_listener(port):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        listener.bind(("localhost", port))
+        listener.listen(Globals.WEBSOCKIFY_BACKLOG)
+    except OSError:
+        listener.close()
+        raise
+    return listener
+
+
+# returns what the stdin of a given process refers to (e.g. "socket:[1234]"), or None if it cannot be read
+def read_stdin_link(pid):
+    try:
+        return os.readlink("/proc/%d/fd/0" % pid)
+    except OSError:
+        return None